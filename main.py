@@ -1,15 +1,18 @@
-import asyncio
 from modules.web import app
-from modules.config import load_config
-from modules.discord_bot import start_bot
+from modules.config import get_config
+from modules.supervisor import bot_runner
 
 # 启动时钩子
 @app.before_serving
 async def startup():
-    config = load_config()
-    for token in config['bot_tokens']:
-        # 后台启动所有已配置的 Bot
-        asyncio.create_task(start_bot(token))
+    config = get_config()
+    # 默认在本进程内启动所有 Bot；设置 BOT_WORKERS=N 时分配到 N 个工作进程
+    await bot_runner.open(config, config['bot_tokens'])
+
+# 关闭时强制落盘，避免丢失尚未写入的存档
+@app.after_serving
+async def shutdown():
+    await bot_runner.close()
 
 if __name__ == '__main__':
     # 开发环境运行
@@ -1,93 +1,244 @@
-import random
+import json
+import time
 import aiohttp
-from .config import load_config, get_bot_config, load_user_data, get_player_data
-from .game_data import get_favorability_stage
+from .config import get_config, get_bot_config, get_token_hash
+from .storage import get_player_data
+from .http_pool import http_pool
+from .balancer import balancer, endpoint_of
+from .prompts import render_system_prompt
+from .knowledge import retrieve
+from .tokens import estimate_tokens
+from .scheduler import llm_scheduler, SchedulerBusy, PRIORITY_INTERACTIVE
+from .response_cache import response_cache, request_key
+from .metrics import histogram, counter
 
-async def ask_ai(prompt, bot_token=None, user_name=None, user_id=None, history_context=None, current_fav=0, system_override=None, pure_reply=False, action_type=None):
+# 单次调用最多尝试的端点/Key 组合数
+MAX_ATTEMPTS = 3
+BUSY_REPLY = "❌ 当前请求过多，请稍后再试。"
+NO_API_REPLY = "❌ 未配置 API。"
+# 流式输出到一半连接断开时追加在已输出内容之后
+INTERRUPTED_NOTICE = "\n\n⚠️ (回复中断，请稍后重试)"
+
+LLM_SECONDS = histogram("llm_request_duration_seconds", "单次 LLM 请求耗时 (流式为收到响应头的时间)", ("bot", "endpoint", "model"))
+LLM_REQUESTS = counter("llm_requests_total", "LLM 请求次数，status 为 HTTP 状态码，连接失败为 error，响应体格式不对为 malformed", ("bot", "endpoint", "model", "status"))
+LLM_TOKENS = counter("llm_tokens_total", "LLM token 用量 (接口没返回 usage 时为估算值)", ("bot", "model", "kind"))
+ERROR_REPLIES = counter("ai_error_replies_total", "返回给用户的错误提示次数", ("bot", "reason"))
+
+def is_error_reply(reply):
+    """ask_ai 出错时返回的是提示文本而不是异常"""
+    return not reply or reply.startswith(("❌", "API Error", "Connection Error"))
+
+def _count_error(bot, reply):
+    if reply == BUSY_REPLY: reason = "busy"
+    elif reply == NO_API_REPLY: reason = "unconfigured"
+    elif reply.startswith("API Error"): reason = "api_error"
+    elif reply.startswith("Connection Error"): reason = "connection"
+    else: reason = "unavailable"
+    ERROR_REPLIES.inc(bot, reason)
+
+def _record_call(bot, api_setting, elapsed, status):
+    labels = (bot, endpoint_of(api_setting), api_setting.get('model', 'gpt-3.5-turbo'))
+    LLM_SECONDS.observe(elapsed, *labels)
+    LLM_REQUESTS.inc(*labels, status)
+
+def _record_tokens(bot, api_setting, payload, usage, completion_text):
+    """优先使用接口返回的 usage；没有时按本地估算"""
+    model = api_setting.get('model', 'gpt-3.5-turbo')
+    usage = usage or {}
+    prompt_tokens = usage.get('prompt_tokens') or sum(estimate_tokens(m['content']) for m in payload['messages'])
+    LLM_TOKENS.inc(bot, model, "prompt", amount=prompt_tokens)
+    LLM_TOKENS.inc(bot, model, "completion", amount=usage.get('completion_tokens') or estimate_tokens(completion_text))
+
+# 每个 Bot 的 prompt 体积统计 (估算的 token 数)，供后台展示
+prompt_stats = {}
+
+def _record_prompt_size(bot_token, tokens):
+    s = prompt_stats.setdefault(get_token_hash(bot_token), {"requests": 0, "last_tokens": 0, "avg_tokens": 0.0, "max_tokens": 0})
+    s["requests"] += 1
+    s["last_tokens"] = tokens
+    s["max_tokens"] = max(s["max_tokens"], tokens)
+    s["avg_tokens"] += (tokens - s["avg_tokens"]) / s["requests"]
+
+def build_request(prompt, bot_token=None, user_name=None, user_id=None, history_context=None, current_fav=0, system_override=None, pure_reply=False, action_type=None):
     """
+    组装一次 /chat/completions 请求，返回 (apis, payload)；具体端点/Key 由负载均衡器挑选。未配置 API 时返回 None。
     action_type: 用于区分行为类型，例如 'gift_receive' (收礼), 'normal_chat' (聊天)
     """
-    config = load_config()
+    config = get_config()
     apis = config.get('api_configs', [])
-    if not apis: return "❌ 未配置 API。"
+    if not apis: return None
 
     bot_conf = get_bot_config(config, bot_token)
 
+    user_info = None
     if system_override:
         final_system_prompt = system_override
     else:
-        # 1. 基础人设
-        prompts = bot_conf.get("system_prompts", ["You are a helpful assistant."])
-        base_prompt = "\n\n".join(p for p in prompts if p.strip())
-        knowledge = "\n".join(bot_conf.get("knowledge", []))
-        
-        final_system_prompt = f"{base_prompt}\n\n【已有知识库】:\n{knowledge}"
-        
-        if user_id and bot_token:
-            user_data = load_user_data()
-            # 变更：获取隔离后的数据，以确保 AI 读取的是该 Bot 实例下的记忆
-            user_info = get_player_data(user_data, user_id, bot_token)
-            
-            card = user_info.get("card", "无")
-            equip = user_info.get("equip", {"weapon":"无", "armor":"无"})
-            
-            # 2. 获取详细的好感度阶段信息
-            fav_stage = get_favorability_stage(current_fav)
-            
-            # 3. 构建动态人设指令
-            final_system_prompt += (
-                f"\n\n=== 交互对象档案 ===\n"
-                f"用户名称: {user_name}\n"
-                f"用户人设: {card}\n"
-                f"用户装备: 武器<{equip['weapon']}> / 防具<{equip['armor']}>\n"
-                f"--------------------\n"
-                f"【当前好感度】: {current_fav} / 500\n"
-                f"【关系状态】: {fav_stage['title']} ({fav_stage['desc']})\n"
-                f"【核心扮演指令】 (必须严格执行): \n"
-                f">>> {fav_stage['prompt']} <<<\n"
-                f"--------------------"
-            )
-
-            # 4. 特殊行为的额外指令 (例如送礼)
-            if action_type == 'gift_receive':
-                final_system_prompt += (
-                    "\n\n【当前事件：收到礼物】\n"
-                    "用户刚刚送了你一份礼物。请结合你的性格和当前好感度做出反应。\n"
-                    "- 如果好感度低：可能会觉得是贿赂、不屑一顾，或者勉强收下，甚至言语带刺。\n"
-                    "- 如果好感度高：会非常开心、惊喜，甚至想要回礼，语气温柔。\n"
-                    "- 请不要只是说“谢谢”，要表现出符合当前关系阶段的心理活动。"
-                )
-
-        if not pure_reply:
-            final_system_prompt += (
-                "\n\n【好感度系统】\n"
-                "根据用户的对话内容，判断好感度变化：\n"
-                "- 冒犯/无聊/重复/作死 -> [FAVORABILITY:-1] 到 -20\n"
-                "- 夸奖/有趣/关心/配合 -> [FAVORABILITY:+1] 到 +20\n"
-                "请将标签放在回复末尾（不要让用户看到），例如：......哼，这次就原谅你了。[FAVORABILITY:+5]"
-            )
+        # 变更：获取隔离后的数据，以确保 AI 读取的是该 Bot 实例下的记忆
+        user_info = get_player_data(user_id, bot_token) if (user_id and bot_token) else None
+        # 只注入与当前消息 (及最近上下文) 相关的知识条目
+        owner = bot_token if bot_token in config.get("bot_settings", {}) else "default"
+        query = f"{(history_context or '')[-500:]}\n{prompt}"
+        knowledge = retrieve(owner, bot_conf, query)
+        # 模板按 Bot/配置版本/好感度阶段缓存，这里只填入用户相关字段
+        final_system_prompt = render_system_prompt(bot_conf, bot_token, user_info, user_name, current_fav, action_type, pure_reply, knowledge)
 
     full_message = ""
+    # 后台滚动整理出的该用户长期记忆 (见 memory.py)
+    if user_info and user_info.memory: full_message += f"【关于该用户的长期记忆】:\n{user_info.memory}\n\n"
     if history_context: full_message += f"【历史对话】:\n{history_context}\n\n"
     full_message += f"{prompt}"
+    _record_prompt_size(bot_token or "default", estimate_tokens(final_system_prompt) + estimate_tokens(full_message))
 
-    # API Request
-    api_setting = random.choice(apis)
-    base_url = api_setting['url'].strip().rstrip('/')
-    if not base_url.endswith('/chat/completions'): base_url += '/chat/completions'
-    
-    headers = {"Authorization": f"Bearer {random.choice(api_setting['keys'])}", "Content-Type": "application/json"}
     payload = {
-        "model": api_setting.get('model', 'gpt-3.5-turbo'),
         "temperature": float(bot_conf.get('temperature', 0.8)),
         "messages": [{"role": "system", "content": final_system_prompt}, {"role": "user", "content": full_message}]
     }
-    
+    return apis, payload
+
+def _endpoint_request(api_setting, key, payload):
+    """把通用 payload 落到具体的端点/Key 上，返回 (url, headers, payload)"""
+    base_url = api_setting['url'].strip().rstrip('/')
+    if not base_url.endswith('/chat/completions'): base_url += '/chat/completions'
+    headers = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
+    return base_url, headers, dict(payload, model=api_setting.get('model', 'gpt-3.5-turbo'))
+
+async def ask_ai(prompt, bot_token=None, user_name=None, user_id=None, history_context=None, current_fav=0, system_override=None, pure_reply=False, action_type=None, priority=PRIORITY_INTERACTIVE, cache_ttl=None):
+    """
+    priority 决定排队顺序：聊天回复优先，决斗解说/名片点评等装饰性内容排在最后。
+    cache_ttl (秒) 由调用方按需开启：相同 prompt 的结果在 TTL 内直接复用，进行中的相同请求合并为一次。
+    """
+    bot = get_token_hash(bot_token)
+    req = build_request(prompt, bot_token, user_name, user_id, history_context, current_fav, system_override, pure_reply, action_type)
+    if not req: reply = NO_API_REPLY
+    else:
+        apis, payload = req
+        if cache_ttl:
+            key = request_key([api.get('model') for api in apis], payload)
+            reply = await response_cache.get_or_compute(key, lambda: _scheduled(apis, payload, priority, bot), cache_ttl, lambda r: not is_error_reply(r))
+        else: reply = await _scheduled(apis, payload, priority, bot)
+    if is_error_reply(reply): _count_error(bot, reply)
+    return reply
+
+async def _scheduled(apis, payload, priority, bot):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(base_url, json=payload, headers=headers, timeout=60) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data['choices'][0]['message']['content']
-                return f"API Error: {resp.status}"
-    except Exception as e: return f"Connection Error: {e}"
\ No newline at end of file
+        async with llm_scheduler.slot(priority):
+            return await _complete(apis, payload, bot)
+    except SchedulerBusy:
+        return BUSY_REPLY
+
+async def _complete(apis, payload, bot):
+    error = "❌ 所有 API Key 暂时不可用，请稍后再试。"
+    tried = set()
+    for _ in range(MAX_ATTEMPTS):
+        picked = balancer.pick(apis, exclude=tried)
+        if not picked: break
+        api_setting, key = picked
+        tried.add((endpoint_of(api_setting), key))
+        base_url, headers, body = _endpoint_request(api_setting, key, payload)
+        # 先拿到端点并发名额再计时，排队时间不计入端点延迟
+        async with llm_scheduler.endpoint(endpoint_of(api_setting)):
+            start = time.monotonic()
+            try:
+                # 复用进程级连接池，避免每次请求都重新握手
+                async with http_pool.post(base_url, json=body, headers=headers, timeout=60) as resp:
+                    if resp.status == 200:
+                        # 先解析并校验响应体，再向均衡器报告一次真实结果
+                        try:
+                            data = await resp.json(content_type=None)
+                            content = data['choices'][0]['message']['content']
+                            if not isinstance(content, str): raise TypeError("content is not a string")
+                        except (ValueError, KeyError, IndexError, TypeError) as e:
+                            error = f"API Error: malformed response ({type(e).__name__})"
+                            balancer.report(api_setting, key, time.monotonic() - start, None)
+                            _record_call(bot, api_setting, time.monotonic() - start, "malformed")
+                            continue
+                        elapsed = time.monotonic() - start
+                        balancer.report(api_setting, key, elapsed, 200)
+                        _record_call(bot, api_setting, elapsed, 200)
+                        _record_tokens(bot, api_setting, payload, data.get('usage'), content)
+                        return content
+                    error = f"API Error: {resp.status}"
+                    _record_call(bot, api_setting, time.monotonic() - start, resp.status)
+                    if not balancer.report(api_setting, key, time.monotonic() - start, resp.status, resp.headers.get('Retry-After')): break
+            except Exception as e:
+                error = f"Connection Error: {e}"
+                balancer.report(api_setting, key, time.monotonic() - start, None)
+                _record_call(bot, api_setting, time.monotonic() - start, "error")
+    return error
+
+async def ask_ai_stream(prompt, bot_token=None, priority=PRIORITY_INTERACTIVE, **kwargs):
+    """
+    流式版本的 ask_ai：消费 SSE 增量，逐段 yield 模型输出。
+    参数与 ask_ai 相同；出错时 yield 一条错误文本后结束。收到第一段输出之前的失败会换 Key 重试。
+    """
+    bot = get_token_hash(bot_token)
+    req = build_request(prompt, bot_token, **kwargs)
+    if not req:
+        _count_error(bot, NO_API_REPLY)
+        yield NO_API_REPLY
+        return
+    apis, payload = req
+    payload["stream"] = True
+    # 流式请求在整个输出期间占用一个并发名额
+    try: await llm_scheduler.acquire(priority)
+    except SchedulerBusy:
+        _count_error(bot, BUSY_REPLY)
+        yield BUSY_REPLY
+        return
+    try:
+        async for delta in _complete_stream(apis, payload, bot): yield delta
+    finally:
+        llm_scheduler.release()
+
+async def _complete_stream(apis, payload, bot):
+    error = "❌ 所有 API Key 暂时不可用，请稍后再试。"
+    tried = set()
+    started = False
+    output = []
+    for _ in range(MAX_ATTEMPTS):
+        picked = balancer.pick(apis, exclude=tried)
+        if not picked: break
+        api_setting, key = picked
+        tried.add((endpoint_of(api_setting), key))
+        base_url, headers, body = _endpoint_request(api_setting, key, payload)
+        # 先拿到端点并发名额再计时，排队时间不计入端点延迟
+        async with llm_scheduler.endpoint(endpoint_of(api_setting)):
+            start = time.monotonic()
+            try:
+                # 流式输出耗时较长，只限制单次读取的间隔
+                async with http_pool.post(base_url, json=body, headers=headers, timeout=aiohttp.ClientTimeout(total=300, sock_read=60)) as resp:
+                    if resp.status != 200:
+                        error = f"API Error: {resp.status}"
+                        _record_call(bot, api_setting, time.monotonic() - start, resp.status)
+                        if balancer.report(api_setting, key, time.monotonic() - start, resp.status, resp.headers.get('Retry-After')): continue
+                        break
+                    balancer.report(api_setting, key, time.monotonic() - start, 200)
+                    _record_call(bot, api_setting, time.monotonic() - start, 200)
+                    started = True
+                    async for raw in resp.content:
+                        line = raw.decode('utf-8', 'ignore').strip()
+                        if not line.startswith('data:'): continue
+                        data = line[5:].strip()
+                        if data == '[DONE]': break
+                        try: delta = json.loads(data)['choices'][0].get('delta', {}).get('content')
+                        except (ValueError, KeyError, IndexError): continue
+                        if delta:
+                            output.append(delta)
+                            yield delta
+                    _record_tokens(bot, api_setting, payload, None, "".join(output))
+                    return
+            except Exception as e:
+                if started:
+                    # 这次请求已经按 200 报告过，不再重复计入端点健康度；
+                    # 已经输出了一部分内容也不能再换 Key 重来，只提示用户回复被截断
+                    print(f"LLM stream interrupted: {e}")
+                    _record_tokens(bot, api_setting, payload, None, "".join(output))
+                    ERROR_REPLIES.inc(bot, "interrupted")
+                    yield INTERRUPTED_NOTICE
+                    return
+                error = f"Connection Error: {e}"
+                balancer.report(api_setting, key, time.monotonic() - start, None)
+                _record_call(bot, api_setting, time.monotonic() - start, "error")
+    _count_error(bot, error)
+    yield error
@@ -0,0 +1,176 @@
+# modules/balancer.py
+import time
+import random
+
+# EWMA 平滑系数、熔断阈值与冷却时间
+EWMA_ALPHA = 0.3
+FAILURE_THRESHOLD = 5
+BASE_COOLDOWN = 30
+MAX_COOLDOWN = 300
+DEFAULT_RETRY_AFTER = 10
+# 还没有延迟样本时的假定延迟 (秒)，让新 Key 也能分到流量
+INITIAL_LATENCY = 2.0
+
+def mask_key(key):
+    return f"{key[:5]}...{key[-4:]}" if len(key) > 12 else "***"
+
+def endpoint_of(api_setting):
+    return api_setting['url'].strip().rstrip('/')
+
+class Health:
+    """单个 API 端点或 Key 的健康状态：延迟 EWMA、错误率 EWMA 与熔断器"""
+    def __init__(self):
+        self.latency = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.state = "closed"
+        self.cooldown = BASE_COOLDOWN
+        self.open_until = 0.0
+        self.probing = False
+        self.retry_until = 0.0
+        self.requests = 0
+        self.errors = 0
+
+    def available(self, now):
+        if now < self.retry_until: return False
+        if self.state == "open" and now >= self.open_until:
+            # 冷却结束，进入半开状态，只放行一个探测请求
+            self.state = "half_open"
+            self.probing = False
+        if self.state == "open": return False
+        if self.state == "half_open": return not self.probing
+        return True
+
+    def begin(self):
+        self.requests += 1
+        if self.state == "half_open": self.probing = True
+
+    def success(self, latency):
+        self.latency = latency if self.latency is None else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.latency
+        self.error_rate *= (1 - EWMA_ALPHA)
+        self.failures = 0
+        self.state = "closed"
+        self.cooldown = BASE_COOLDOWN
+        self.probing = False
+
+    def failure(self, now):
+        self.errors += 1
+        self.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.error_rate
+        self.failures += 1
+        if self.state == "half_open":
+            # 探测失败：重新熔断并加倍冷却时间
+            self.cooldown = min(MAX_COOLDOWN, self.cooldown * 2)
+            self._trip(now)
+        elif self.failures >= FAILURE_THRESHOLD:
+            self._trip(now)
+
+    def release(self):
+        """请求没有产生健康结论 (例如 400 参数错误) 时释放半开探测名额"""
+        self.probing = False
+
+    def _trip(self, now):
+        self.state = "open"
+        self.open_until = now + self.cooldown
+        self.probing = False
+
+    def score(self):
+        latency = self.latency if self.latency is not None else INITIAL_LATENCY
+        return latency * (1 + 4 * self.error_rate)
+
+    def snapshot(self, now):
+        return {
+            "state": self.state,
+            "latency_ms": round(self.latency * 1000) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "requests": self.requests,
+            "errors": self.errors,
+            "retry_after": max(0, round(self.retry_until - now)),
+            "open_for": max(0, round(self.open_until - now)) if self.state == "open" else 0,
+        }
+
+class LoadBalancer:
+    """
+    api_configs 的负载均衡器：按端点和 Key 记录延迟/错误率，
+    加权选择最快的可用组合；连续失败熔断，冷却后半开探测；429 按 Retry-After 暂停该 Key。
+    """
+    def __init__(self):
+        self.endpoints = {}
+        self.keys = {}
+
+    def _endpoint(self, url):
+        return self.endpoints.setdefault(url, Health())
+
+    def _key(self, url, key):
+        return self.keys.setdefault((url, key), Health())
+
+    def pick(self, apis, exclude=()):
+        """返回 (api_setting, key)；exclude 为本次请求已经失败过的 (url, key)。全部不可用时返回 None"""
+        now = time.monotonic()
+        candidates, weights = [], []
+        for api_setting in apis:
+            url = endpoint_of(api_setting)
+            ep = self._endpoint(url)
+            if not ep.available(now): continue
+            for key in api_setting.get('keys', []):
+                if (url, key) in exclude: continue
+                kh = self._key(url, key)
+                if not kh.available(now): continue
+                candidates.append((api_setting, key))
+                # 加权最小延迟：分数越低权重越高
+                weights.append(1.0 / (ep.score() * kh.score()) ** 2)
+        if not candidates: return None
+        api_setting, key = random.choices(candidates, weights=weights)[0]
+        url = endpoint_of(api_setting)
+        self._endpoint(url).begin()
+        self._key(url, key).begin()
+        return api_setting, key
+
+    def report(self, api_setting, key, latency, status, retry_after=None):
+        """
+        记录一次请求结果。status 为 HTTP 状态码，连接异常时为 None。
+        返回 True 表示值得换一个 Key/端点重试。
+        """
+        now = time.monotonic()
+        url = endpoint_of(api_setting)
+        ep, kh = self._endpoint(url), self._key(url, key)
+        if status == 200:
+            ep.success(latency)
+            kh.success(latency)
+            return False
+        if status == 429:
+            try: wait = float(retry_after)
+            except (TypeError, ValueError): wait = DEFAULT_RETRY_AFTER
+            kh.retry_until = now + wait
+            kh.errors += 1
+            kh.error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * kh.error_rate
+            kh.release()
+            ep.release()
+            return True
+        if status in (401, 403):
+            # Key 失效：只熔断该 Key
+            kh.failure(now)
+            ep.release()
+            return True
+        if status is None or status == 408 or status >= 500:
+            # 端点故障：熔断端点，Key 本身不背锅
+            ep.failure(now)
+            kh.release()
+            return True
+        ep.release()
+        kh.release()
+        return False
+
+    def snapshot(self, api_setting):
+        """供后台 API 面板展示的实时状态"""
+        now = time.monotonic()
+        url = endpoint_of(api_setting)
+        ep = self._endpoint(url)
+        ep.available(now)
+        keys = []
+        for key in api_setting.get('keys', []):
+            kh = self._key(url, key)
+            kh.available(now)
+            keys.append(dict(kh.snapshot(now), key=mask_key(key)))
+        return dict(ep.snapshot(now), url=url, keys=keys)
+
+balancer = LoadBalancer()
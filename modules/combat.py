@@ -0,0 +1,64 @@
+# modules/combat.py
+# 纯战斗规则 (不涉及 Discord)：MyBot.start_combat_engine 与 duel_sim 模拟器共用
+import random
+
+# 各模式的最大回合数
+ROUNDS = {"money": 5, "life": 10}
+# 赌钱模式下输家被拿走的金币比例区间
+STEAL_RANGE = (0.1, 0.5)
+# 未装备时的基础属性
+BASE_HP, BASE_ATK, BASE_DEF = 100, 10, 0
+
+def fighter_stats(record):
+    """PlayerRecord → (hp, atk, def)"""
+    s = record.stats
+    return s.hp, s.atk, s.defense
+
+def loadout_stats(weapon=None, armor=None):
+    """按商店的装备规则计算一套装备的满状态属性 (weapon/armor 为 ITEMS_DB 条目或 None)"""
+    atk = BASE_ATK + (weapon or {}).get("atk", 0)
+    hp = BASE_HP + (armor or {}).get("hp", 0)
+    return hp, atk, (armor or {}).get("def", BASE_DEF)
+
+def attack(atk, target_def, rng=random):
+    """
+    一次攻击的 D20 检定，返回 (结果, 数值, 骰点)：
+    fumble = 大失败自伤 1~5；crit = Nat20 (atk+1d5)*1.5 减防御；hit = atk+d20 对 def+d10。伤害至少为 1。
+    """
+    d20 = rng.randint(1, 20)
+    if d20 == 1:
+        return "fumble", rng.randint(1, 5), d20
+    if d20 == 20:
+        return "crit", max(1, int((atk + rng.randint(1, 5)) * 1.5) - target_def), d20
+    return "hit", max(1, atk + d20 - (target_def + rng.randint(1, 10))), d20
+
+def play_round(hp1, hp2, s1, s2, rng=random):
+    """
+    一个回合：P1 先攻；P2 只要还活着就反击 (即使 P1 刚刚自伤倒下)。
+    s1/s2 为 (hp, atk, def)。返回 (hp1, hp2, events)，events 为 [(攻击方 0/1, 结果, 数值, 骰点)]。
+    """
+    events = []
+    kind, amount, d20 = attack(s1[1], s2[2], rng)
+    if kind == "fumble": hp1 -= amount
+    else: hp2 -= amount
+    events.append((0, kind, amount, d20))
+    if hp2 > 0:
+        kind, amount, d20 = attack(s2[1], s1[2], rng)
+        if kind == "fumble": hp2 -= amount
+        else: hp1 -= amount
+        events.append((1, kind, amount, d20))
+    return hp1, hp2, events
+
+def outcome(hp1, hp2):
+    """胜者 0/1；双方都倒下为平局 None。都还站着时血多者胜，同血算 P2 胜"""
+    if hp1 <= 0 and hp2 <= 0: return None
+    return 0 if hp1 > hp2 else 1
+
+def simulate_duel(s1, s2, mode="money", rng=random):
+    """不带任何 I/O 地打完一整场，返回 (胜者, hp1, hp2, 回合数)"""
+    hp1, hp2 = s1[0], s2[0]
+    rounds = ROUNDS[mode]
+    for r in range(1, rounds + 1):
+        hp1, hp2, _ = play_round(hp1, hp2, s1, s2, rng)
+        if hp1 <= 0 or hp2 <= 0: break
+    return outcome(hp1, hp2), hp1, hp2, r
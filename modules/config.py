@@ -1,6 +1,8 @@
 import os
-import json
+import copy
 import hashlib
+import weakref
+from .persist import dumps, loads, run_io, write_atomic, file_writer
 
 DATA_DIR = "/app/data"
 CONFIG_FILE = os.path.join(DATA_DIR, "config.json")
@@ -22,7 +24,8 @@ MODULE_DEFINITIONS = {
             "决斗": "发起赌钱或赌命的战斗",
             "探索": "随机事件检定 (D100)",
             "自定义探索": "创建新的探索事件",
-            "我的数据": "查看属性/好感度评价"
+            "我的数据": "查看属性/好感度评价",
+            "排行榜": "金币/好感度/HP/胜场排行"
         }
     },
     "utility": {
@@ -30,7 +33,7 @@ MODULE_DEFINITIONS = {
         "desc": "名片与辅助功能",
         "commands": {
             "名片": "设置个人背景/人设",
-            "提醒": "设置倒计时提醒",
+            "提醒": "设置倒计时提醒 (含 /提醒列表、/取消提醒)",
             "总结": "AI 总结聊天记录"
         }
     },
@@ -53,12 +56,38 @@ default_config = {
     "default_settings": {
         "system_prompts": ["你是一个非常有用的 Discord 助手。"],
         "temperature": 0.8,
+        # 流式回复：边生成边编辑 Discord 消息，缩短首字等待时间
+        "stream_replies": False,
         "knowledge": [],
+        # 每次只检索注入最相关的几条知识，并限制其 token 总量
+        "knowledge_top_k": 5,
+        "knowledge_token_budget": 800,
+        # 聊天上下文与 /总结 可使用的历史消息 token 预算
+        "context_token_budget": 1500,
+        "summary_token_budget": 3000,
+        # 后台滚动摘要频道对话、整理用户长期记忆
+        "rolling_summary": True,
+        # Gateway 分片数：1 = 单连接，0 = 自动 (按 Discord 推荐值)
+        "shard_count": 1,
         "custom_events": [],
         # 变更：默认开启所有核心指令
-        "enabled_commands": ["chat", "商店", "决斗", "探索", "自定义探索", "我的数据", "名片", "提醒", "总结", "修改好感度", "清除名片", "清理"]
+        "enabled_commands": ["chat", "商店", "决斗", "探索", "自定义探索", "我的数据", "排行榜", "名片", "提醒", "总结", "修改好感度", "清除名片", "清理"]
     },
-    "bot_settings": {}
+    "bot_settings": {},
+    # LLM 请求的连接池参数 (按 API 域名复用 TCP/TLS 连接)
+    "http_pool": {
+        "limit": 100,
+        "limit_per_host": 20,
+        "keepalive_timeout": 60,
+        "dns_cache_ttl": 300
+    },
+    # 出站 LLM 请求的并发上限、队列长度与各优先级的排队截止时间 (秒)
+    "llm_scheduler": {
+        "max_concurrency": 8,
+        "per_endpoint": 4,
+        "max_queue": 100,
+        "deadlines": {"chat": 60, "interactive": 90, "background": 30}
+    }
 }
 
 def get_token_hash(token):
@@ -66,90 +95,106 @@ def get_token_hash(token):
     if not token: return "default"
     return hashlib.md5(token.strip().encode()).hexdigest()[:10]
 
-def load_config():
-    if not os.path.exists(DATA_DIR): os.makedirs(DATA_DIR)
-    if not os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(default_config, f, indent=4, ensure_ascii=False)
-        return default_config
-    try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            config = json.load(f)
-            
-            # --- 兼容性迁移逻辑 ---
-            # 将旧的 enabled_modules 转换为 enabled_commands
-            def migrate_settings(settings):
-                if "enabled_modules" in settings:
-                    cmds = []
-                    mods = settings.pop("enabled_modules")
-                    if "chat" in mods: cmds.append("chat")
-                    if "rpg" in mods: cmds.extend(MODULE_DEFINITIONS["rpg"]["commands"].keys())
-                    if "utility" in mods: cmds.extend(MODULE_DEFINITIONS["utility"]["commands"].keys())
-                    if "admin" in mods: cmds.extend(MODULE_DEFINITIONS["admin"]["commands"].keys())
-                    settings["enabled_commands"] = list(set(cmds)) # 去重
-                # 确保字段存在
-                if "enabled_commands" not in settings:
-                     settings["enabled_commands"] = default_config["default_settings"]["enabled_commands"]
+# --- 兼容性迁移逻辑 ---
+# 将旧的 enabled_modules 转换为 enabled_commands
+def migrate_settings(settings):
+    if "enabled_modules" in settings:
+        cmds = []
+        mods = settings.pop("enabled_modules")
+        if "chat" in mods: cmds.append("chat")
+        if "rpg" in mods: cmds.extend(MODULE_DEFINITIONS["rpg"]["commands"].keys())
+        if "utility" in mods: cmds.extend(MODULE_DEFINITIONS["utility"]["commands"].keys())
+        if "admin" in mods: cmds.extend(MODULE_DEFINITIONS["admin"]["commands"].keys())
+        settings["enabled_commands"] = list(set(cmds)) # 去重
+    # 确保字段存在
+    if "enabled_commands" not in settings:
+         settings["enabled_commands"] = default_config["default_settings"]["enabled_commands"]
 
-            migrate_settings(config.get("default_settings", {}))
-            for token in config.get("bot_settings", {}):
-                migrate_settings(config["bot_settings"][token])
-                
-            return config
-    except: return default_config
+# --- 配置缓存 ---
+# 解析后的配置常驻内存，只有 config.json 的 mtime/大小变化且内容哈希不同才重新解析
+_cache = {"config": None, "stat": None, "digest": None}
+# 配置版本号：每次内容变化 (save_config 或外部修改文件) 加一
+_config_version = 0
+_subscribers = []
 
-def save_config(config):
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, indent=4, ensure_ascii=False)
+def get_config_version():
+    return _config_version
 
-def get_bot_config(config, token):
-    return config["bot_settings"].get(token, config["default_settings"])
+def subscribe(callback):
+    """
+    订阅配置变化：callback(config, version)。config 为共享的只读对象。
+    绑定方法以弱引用保存，对象 (例如已停止的 Bot) 被回收后自动退订。
+    """
+    ref = weakref.WeakMethod(callback) if hasattr(callback, "__self__") else (lambda: callback)
+    _subscribers.append(ref)
+
+def _publish(config, stat, digest):
+    global _config_version
+    _cache.update(config=config, stat=stat, digest=digest)
+    _config_version += 1
+    for ref in list(_subscribers):
+        callback = ref()
+        if callback is None:
+            _subscribers.remove(ref)
+            continue
+        try: callback(config, _config_version)
+        except Exception as e: print(f"Config subscriber error: {e}")
 
-def load_user_data():
-    if not os.path.exists(USER_DATA_FILE): return {}
+def _file_stat():
+    st = os.stat(CONFIG_FILE)
+    return (st.st_mtime_ns, st.st_size)
+
+def get_config():
+    """
+    返回共享的配置对象 (只读！)。命中缓存时只做一次 stat，不读盘不解析。
+    需要修改并保存配置的调用方请使用 load_config()。
+    """
+    if not os.path.exists(DATA_DIR): os.makedirs(DATA_DIR)
+    if not os.path.exists(CONFIG_FILE):
+        # 首次启动：同步写出默认配置 (只发生一次)
+        raw = dumps(default_config)
+        write_atomic(CONFIG_FILE, raw)
+        _publish(copy.deepcopy(default_config), _file_stat(), hashlib.md5(raw).hexdigest())
+        return _cache["config"]
     try:
-        with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except: return {}
+        # 正在异步写盘：内存里已经是最新配置，不要回读旧文件
+        if _cache["config"] is not None and file_writer.busy(CONFIG_FILE): return _cache["config"]
+        stat = _file_stat()
+        if _cache["config"] is not None and stat == _cache["stat"]: return _cache["config"]
+        with open(CONFIG_FILE, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.md5(raw).hexdigest()
+        if _cache["config"] is not None and digest == _cache["digest"]:
+            # 只是 mtime 变了，内容没变
+            _cache["stat"] = stat
+            return _cache["config"]
+        config = loads(raw)
+        migrate_settings(config.get("default_settings", {}))
+        for token in config.get("bot_settings", {}):
+            migrate_settings(config["bot_settings"][token])
+        _publish(config, stat, digest)
+        return config
+    except: return _cache["config"] or default_config
 
-def save_user_data(data):
-    with open(USER_DATA_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+def load_config():
+    """返回一份可以随意修改的配置副本，改完后交给 save_config 保存"""
+    return copy.deepcopy(get_config())
 
-def get_player_data(user_data, uid, bot_token):
+def _encode(config):
+    raw = dumps(config)
+    return raw, loads(raw)
+
+async def save_config(config):
     """
-    核心隔离函数：获取指定用户在指定Bot下的数据。
-    数据结构变更: 
-    旧: user_data[uid] = { gold: 100, ... }
-    新: user_data[uid] = { "token_hash_A": { gold: 100, ... }, "token_hash_B": { ... } }
+    序列化 (紧凑 JSON) 与写盘都在持久化线程里完成，不阻塞事件循环；
+    同时发起的多次保存合并成一次写入，以最后一次的内容为准。
     """
-    uid = str(uid)
-    token_hash = get_token_hash(bot_token)
-    
-    if uid not in user_data:
-        user_data[uid] = {}
-        
-    # 兼容性处理：如果发现旧版数据结构（直接包含gold字段），将其归档到当前Bot或默认位置
-    if "gold" in user_data[uid] or "rpg" in user_data[uid]: 
-        old_content = user_data[uid].copy()
-        # 清空旧结构，建立新结构
-        user_data[uid] = {token_hash: old_content} 
-    
-    # 初始化该 Bot 下的数据
-    if token_hash not in user_data[uid]:
-        user_data[uid][token_hash] = {
-            "card": "", 
-            "favorability": 0, 
-            "gold": 0,
-            "rpg": {"lv": 1, "hp": 100, "atk": 10, "def": 0},
-            "equip": {"weapon": "无", "armor": "无"}
-        }
-    
-    # 二次检查确保关键字段存在（防止旧档缺失字段）
-    target_data = user_data[uid][token_hash]
-    if "rpg" not in target_data: target_data["rpg"] = {"lv": 1, "hp": 100, "atk": 10}
-    if "gold" not in target_data: target_data["gold"] = 0
-    if "equip" not in target_data: target_data["equip"] = {"weapon": "无", "armor": "无"}
-    if "favorability" not in target_data: target_data["favorability"] = 0
-        
-    return target_data
\ No newline at end of file
+    raw, snapshot = await run_io(_encode, config)
+    digest = hashlib.md5(raw).hexdigest()
+    # 先刷新缓存并通知订阅者，避免下一次读取再解析一遍
+    _publish(snapshot, None, digest)
+    await file_writer.write(CONFIG_FILE, raw)
+    if _cache["digest"] == digest: _cache["stat"] = _file_stat()
+
+def get_bot_config(config, token):
+    return config["bot_settings"].get(token, config["default_settings"])
@@ -0,0 +1,37 @@
+# modules/context.py
+from .tokens import estimate_tokens, truncate_to_tokens
+
+DEFAULT_CONTEXT_BUDGET = 1500
+DEFAULT_SUMMARY_BUDGET = 3000
+
+def build_context(messages, budget, max_message_tokens=None):
+    """
+    按 token 预算拼接聊天记录。messages 为 [(作者, 内容), ...]，从旧到新。
+    从最新一条往前填充：重复刷屏只保留最新一次，超长消息截断到 max_message_tokens (默认预算的 1/4)，
+    预算用完即停止。返回 (文本, 统计信息)。
+    """
+    max_message_tokens = max_message_tokens or max(1, budget // 4)
+    lines, seen = [], set()
+    stats = {"messages": 0, "tokens": 0, "deduped": 0, "truncated": 0, "dropped": 0}
+    for i in range(len(messages) - 1, -1, -1):
+        author, content = messages[i]
+        content = (content or "").strip()
+        if not content: continue
+        key = (author, " ".join(content.lower().split()))
+        if key in seen:
+            stats["deduped"] += 1
+            continue
+        seen.add(key)
+        if estimate_tokens(content) > max_message_tokens:
+            content = truncate_to_tokens(content, max_message_tokens)
+            stats["truncated"] += 1
+        line = f"{author}: {content}"
+        cost = estimate_tokens(line) + 1
+        if stats["tokens"] + cost > budget:
+            stats["dropped"] = i + 1
+            break
+        lines.append(line)
+        stats["tokens"] += cost
+        stats["messages"] += 1
+    lines.reverse()
+    return "\n".join(lines), stats
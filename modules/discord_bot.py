@@ -1,26 +1,123 @@
 # modules/discord_bot.py
+import math
+import time
 import discord
 import asyncio
-import re
 import random
 from discord.ext import commands
 from discord import app_commands
-from .config import load_config, save_config, load_user_data, save_user_data, get_player_data
+from .config import get_config, get_bot_config, subscribe, get_token_hash
+from .storage import get_player_data, mutate_player
 from .game_data import get_favorability_stage
-from .ai import ask_ai
+from .ai import ask_ai, ask_ai_stream, prompt_stats
+from .scheduler import PRIORITY_CHAT, PRIORITY_BACKGROUND
+from .streaming import FAV_TAG, stream_reply, embed_renderer
+from .history import ChannelHistoryCache
+from .context import build_context, DEFAULT_CONTEXT_BUDGET, DEFAULT_SUMMARY_BUDGET
+from .memory import rolling_memory, RECENT_TURNS
+from .reminders import ReminderScheduler, parse_duration, MAX_PER_USER
+from .leaderboard import leaderboard, FIELD_LABELS
+from .combat import ROUNDS, STEAL_RANGE, fighter_stats, play_round, outcome
+from .output import OutputScheduler
+from .metrics import histogram, gauge, counter, add_collector
 from .discord_ui import ShopCategoryView, CardModal, EventDefineModal, DuelInviteView
 
 active_bots = {}
 
-class MyBot(commands.Bot):
-    def __init__(self, token_key, enabled_commands=None):
-        super().__init__(command_prefix='!', intents=discord.Intents.all(), help_command=None)
+def required_intents(enabled_commands):
+    """
+    按启用的功能计算最小 Gateway Intents。
+    斜杠指令本身只需要 guilds；指令参数里的用户由交互数据解析，不需要 members/presences。
+    服务器消息与消息内容始终开启：管理员的 !sync 文本指令、频道缓存与滚动摘要都靠消息事件；
+    私信只有开启聊天时才需要。
+    """
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    if "chat" in enabled_commands: intents.dm_messages = True
+    return intents
+
+# 决斗每回合至少展示的秒数 (频道被限流时按调度器的间隔放慢)
+ROUND_INTERVAL = 2
+
+# 决斗战报文案：[P1, P2][结果]，P2 那一行是回合最后一行，不带换行
+ROUND_TEXT = (
+    {"fumble": "💀 {name} 脚下一滑(大失败)，受到反噬 **{amount}**！\n",
+     "crit": "🔥 {name} 暴击！(Nat20) 造成 **{amount}** 伤害！\n",
+     "hit": "👊 {name} 造成 **{amount}** 伤害 (🎲{d20})\n"},
+    {"fumble": "💀 {name} 攻击失误(大失败)，自损 **{amount}**！\n",
+     "crit": "🔥 {name} 暴击！(Nat20) 造成 **{amount}** 伤害！",
+     "hit": "👊 {name} 造成 **{amount}** 伤害 (🎲{d20})"},
+)
+
+COMMAND_SECONDS = histogram("command_duration_seconds", "斜杠指令从收到交互到处理结束的耗时", ("bot", "command", "status"))
+GATEWAY_LATENCY = gauge("gateway_latency_seconds", "各分片的网关心跳延迟", ("bot", "shard"))
+BOT_UP = gauge("bot_up", "Bot 是否已连上网关 (1/0)", ("bot",))
+EDIT_QUEUE = gauge("discord_edit_queue_depth", "等待发送的消息编辑数 (已合并)", ("bot",))
+EDITS = counter("discord_edits_total", "消息编辑调度结果：sent 已发送 / coalesced 被合并 / throttled 被限流放慢 / failed 失败", ("bot", "result"))
+
+class TimedCommandTree(app_commands.CommandTree):
+    """给斜杠指令计时：interaction_check 记下开始时间，完成 (on_app_command_completion) 或出错时记录耗时"""
+    async def interaction_check(self, interaction):
+        interaction.extras["started"] = time.monotonic()
+        return True
+
+    def observe(self, interaction, status):
+        started = interaction.extras.get("started")
+        if started is None: return
+        name = interaction.command.qualified_name if interaction.command else "unknown"
+        COMMAND_SECONDS.observe(time.monotonic() - started, self.client.token_hash, name, status)
+
+    async def on_error(self, interaction, error):
+        self.observe(interaction, "error")
+        await super().on_error(interaction, error)
+
+class MyBot(commands.AutoShardedBot):
+    def __init__(self, token_key, enabled_commands=None, stream_replies=False, shard_count=1):
+        intents = required_intents(enabled_commands or [])
+        # shard_count 为 None 时由 Discord 推荐分片数；不缓存成员、启动时不分块拉取成员列表
+        super().__init__(
+            command_prefix='!', intents=intents, help_command=None, shard_count=shard_count,
+            member_cache_flags=discord.MemberCacheFlags.from_intents(intents), chunk_guilds_at_startup=False,
+            tree_cls=TimedCommandTree
+        )
         self.token_key = token_key 
+        self.token_hash = get_token_hash(token_key)
         # 现在这里存储的是具体的指令名称列表，如 ['商店', '名片']
         self.enabled_commands = enabled_commands or []
+        # 流式回复：边生成边编辑消息 (可在后台开关)
+        self.stream_replies = stream_replies
+        # 频道最近消息缓存，避免每次 @ 都走 REST 拉历史
+        self.history_cache = ChannelHistoryCache()
+        # 持久化的提醒调度器 (一个定时器服务所有提醒)
+        self.reminders = ReminderScheduler(self)
+        self.output = OutputScheduler()
+        # 后台修改设定后即时生效 (指令开关仍需重启同步指令树)
+        subscribe(self.on_config_change)
+
+    def on_config_change(self, config, version):
+        if self.is_closed(): return
+        self.stream_replies = get_bot_config(config, self.token_key).get("stream_replies", False)
 
     async def setup_hook(self):
         await self.tree.sync()
+        if "提醒" in self.enabled_commands: self.reminders.start()
+
+    async def close(self):
+        self.reminders.stop()
+        self.output.close()
+        await super().close()
+
+    async def on_app_command_completion(self, interaction, command):
+        self.tree.observe(interaction, "ok")
+
+    def shard_stats(self):
+        """各分片的心跳延迟 (毫秒)，尚未连上的分片为 None"""
+        return [
+            {"id": shard_id, "latency_ms": round(latency * 1000) if math.isfinite(latency) else None}
+            for shard_id, latency in sorted(self.latencies)
+        ]
 
     # --- 🎲 底层检定逻辑 (Dice System) ---
     def roll_check(self, bonus=0):
@@ -45,17 +142,15 @@ class MyBot(commands.Bot):
         """
         引入 D20 暴击/大失败机制的战斗系统
         """
-        user_data = load_user_data()
-        # 变更：获取当前Bot下的隔离数据
-        d1 = get_player_data(user_data, p1.id, self.token_key)
-        d2 = get_player_data(user_data, p2.id, self.token_key)
+        # 变更：获取当前Bot下的隔离数据 (只读取开战时的属性快照，结算时再原子写回)
+        d1 = get_player_data(p1.id, self.token_key)
+        d2 = get_player_data(p2.id, self.token_key)
 
-        hp1, max_hp1 = d1["rpg"].get("hp", 100), d1["rpg"].get("hp", 100)
-        hp2, max_hp2 = d2["rpg"].get("hp", 100), d2["rpg"].get("hp", 100)
-        atk1, def1 = d1["rpg"].get("atk", 10), d1["rpg"].get("def", 0)
-        atk2, def2 = d2["rpg"].get("atk", 10), d2["rpg"].get("def", 0)
+        s1, s2 = fighter_stats(d1), fighter_stats(d2)
+        hp1 = max_hp1 = s1[0]
+        hp2 = max_hp2 = s2[0]
 
-        rounds = 5 if mode == 'money' else 10
+        rounds = ROUNDS[mode]
         winner = None
 
         embed = discord.Embed(title=f"⚔️ 决斗开始: {p1.display_name} VS {p2.display_name}", color=0xff0000)
@@ -63,73 +158,27 @@ class MyBot(commands.Bot):
         embed.add_field(name=f"{p2.display_name}", value=f"HP {hp2}/{max_hp2}", inline=True)
         msg = await interaction.channel.send(embed=embed)
 
-        log_history = [] 
-
+        # 整场战斗先一次算完 (纯计算)，立即结算存档；逐回合的展示交给输出调度器慢慢追上
+        frames = []
         for r in range(1, rounds + 1):
-            await asyncio.sleep(2)
-
             round_log = f"**Round {r}**\n"
             
-            # --- P1 攻击 P2 ---
-            d20_1 = random.randint(1, 20)
-            dmg1 = 0
-            
-            if d20_1 == 1: # 大失败
-                self_dmg = random.randint(1, 5)
-                hp1 -= self_dmg
-                round_log += f"💀 {p1.display_name} 脚下一滑(大失败)，受到反噬 **{self_dmg}**！\n"
-            elif d20_1 == 20: # 暴击
-                raw_dmg = int((atk1 + random.randint(1, 5)) * 1.5)
-                dmg1 = max(1, raw_dmg - def2)
-                hp2 -= dmg1
-                round_log += f"🔥 {p1.display_name} 暴击！(Nat20) 造成 **{dmg1}** 伤害！\n"
-            else: # 普通
-                hit_roll = atk1 + d20_1
-                def_roll = def2 + random.randint(1, 10)
-                dmg1 = max(1, hit_roll - def_roll)
-                hp2 -= dmg1
-                round_log += f"👊 {p1.display_name} 造成 **{dmg1}** 伤害 (🎲{d20_1})\n"
-
-            # --- P2 攻击 P1 ---
-            if hp2 > 0:
-                d20_2 = random.randint(1, 20)
-                dmg2 = 0
-                
-                if d20_2 == 1:
-                    self_dmg = random.randint(1, 5)
-                    hp2 -= self_dmg
-                    round_log += f"💀 {p2.display_name} 攻击失误(大失败)，自损 **{self_dmg}**！\n"
-                elif d20_2 == 20:
-                    raw_dmg = int((atk2 + random.randint(1, 5)) * 1.5)
-                    dmg2 = max(1, raw_dmg - def1)
-                    hp1 -= dmg2
-                    round_log += f"🔥 {p2.display_name} 暴击！(Nat20) 造成 **{dmg2}** 伤害！"
-                else:
-                    hit_roll = atk2 + d20_2
-                    def_roll = def1 + random.randint(1, 10)
-                    dmg2 = max(1, hit_roll - def_roll)
-                    hp1 -= dmg2
-                    round_log += f"👊 {p2.display_name} 造成 **{dmg2}** 伤害 (🎲{d20_2})"
-
-            log_history.append(round_log)
-            
-            embed.description = round_log
-            bar1 = "🟩" * int(max(0, hp1)/max_hp1*10) + "⬛" * (10 - int(max(0, hp1)/max_hp1*10))
-            bar2 = "🟩" * int(max(0, hp2)/max_hp2*10) + "⬛" * (10 - int(max(0, hp2)/max_hp2*10))
-            
-            embed.set_field_at(0, name=f"{p1.display_name}", value=f"HP {max(0,hp1)} | {bar1}", inline=True)
-            embed.set_field_at(1, name=f"{p2.display_name}", value=f"HP {max(0,hp2)} | {bar2}", inline=True)
-            await msg.edit(embed=embed)
+            hp1, hp2, events = play_round(hp1, hp2, s1, s2)
+            for who, kind, amount, d20 in events:
+                round_log += ROUND_TEXT[who][kind].format(name=(p1, p2)[who].display_name, amount=amount, d20=d20)
 
+            frames.append((round_log, hp1, hp2))
             if hp1 <= 0 or hp2 <= 0: break
+        log_history = [round_log for round_log, _, _ in frames]
 
         # 结算
         result_text = ""
         loser = None
         
-        if hp1 <= 0 and hp2 <= 0:
+        side = outcome(hp1, hp2)
+        if side is None:
             result_text = "💀 **同归于尽！双方都倒下了！**"
-        elif hp1 > hp2:
+        elif side == 0:
             winner = p1
             loser = p2
             result_text = f"🏆 **{p1.display_name} 胜利！**"
@@ -138,32 +187,41 @@ class MyBot(commands.Bot):
             loser = p1
             result_text = f"🏆 **{p2.display_name} 胜利！**"
 
-        # 写入数据 (注意：d1, d2 是 user_data 内的引用，直接修改即可)
-        d1["rpg"]["hp"] = max(0, hp1)
-        d2["rpg"]["hp"] = max(0, hp2)
-
-        if mode == 'money' and winner and loser:
-            l_data = d1 if loser == p1 else d2
-            w_data = d1 if winner == p1 else d2
-            
-            loser_gold = l_data.get("gold", 0)
-            steal = int(loser_gold * random.uniform(0.1, 0.5))
-            l_data["gold"] -= steal
-            w_data["gold"] += steal
-            result_text += f"\n💰 赢家拿走了 **{steal} G**！"
-        
-        elif mode == 'life' and loser:
-            l_data = d1 if loser == p1 else d2
-            # 重置该用户在当前 Bot 下的数据
-            l_data.update({"gold": 0, "favorability": 0, "rpg": {"lv": 1, "hp": 100, "atk": 10, "def": 0}, "equip": {"weapon": "无", "armor": "无"}})
-            result_text += f"\n💀 **{loser.display_name} 已死亡，存档被清空重置。**"
-        
-        save_user_data(user_data)
-        
-        embed.description = result_text
-        embed.color = 0xffd700
-        await msg.edit(embed=embed)
+        # 写入数据：在各自的锁内基于最新存档结算，不覆盖战斗期间发生的其他变动
+        final_hp = {p1.id: max(0, hp1), p2.id: max(0, hp2)}
+
+        def settle_loser(l_data):
+            l_data.stats.hp = final_hp[loser.id]
+            if mode == 'money':
+                steal = int(l_data.gold * random.uniform(*STEAL_RANGE))
+                l_data.gold -= steal
+                return steal
+            if mode == 'life':
+                # 重置该用户在当前 Bot 下的数据
+                l_data.reset_progress()
+            return 0
+
+        if loser:
+            steal = await mutate_player(loser.id, self.token_key, settle_loser)
+
+            def settle_winner(w_data):
+                w_data.stats.hp = final_hp[winner.id]
+                w_data.gold += steal
+                w_data.wins += 1
+            await mutate_player(winner.id, self.token_key, settle_winner)
+
+            if mode == 'money':
+                result_text += f"\n💰 赢家拿走了 **{steal} G**！"
+            elif mode == 'life':
+                result_text += f"\n💀 **{loser.display_name} 已死亡，存档被清空重置。**"
+        else:
+            # 同归于尽，双方 HP 归零
+            def settle_draw(data): data.stats.hp = 0
+            await mutate_player(p1.id, self.token_key, settle_draw)
+            await mutate_player(p2.id, self.token_key, settle_draw)
 
+        # 赛后点评与回合动画同时进行
+        commentary = None
         if "chat" in self.enabled_commands:
             combat_log_str = "\n".join(log_history)
             prompt = (
@@ -173,10 +231,34 @@ class MyBot(commands.Bot):
                 f"最终结果：{result_text}\n"
                 f"请特别点评其中的【暴击】或【大失败】镜头。"
             )
-            commentary = await ask_ai(prompt, self.token_key, pure_reply=True)
-            await interaction.channel.send(f"🎙️ **赛后点评:**\n{commentary}")
+            commentary = asyncio.create_task(ask_ai(prompt, self.token_key, pure_reply=True, priority=PRIORITY_BACKGROUND, cache_ttl=300))
+
+        # 每回合一帧；频道拥堵时调度器只发最新的一帧，不会排队等 429
+        for round_log, h1, h2 in frames:
+            await asyncio.sleep(max(ROUND_INTERVAL, self.output.interval(msg.channel.id)))
+            embed.description = round_log
+            bar1 = "🟩" * int(max(0, h1)/max_hp1*10) + "⬛" * (10 - int(max(0, h1)/max_hp1*10))
+            bar2 = "🟩" * int(max(0, h2)/max_hp2*10) + "⬛" * (10 - int(max(0, h2)/max_hp2*10))
+            
+            embed.set_field_at(0, name=f"{p1.display_name}", value=f"HP {max(0,h1)} | {bar1}", inline=True)
+            embed.set_field_at(1, name=f"{p2.display_name}", value=f"HP {max(0,h2)} | {bar2}", inline=True)
+            self.output.edit(msg, embed=embed.copy())
+
+        embed.description = result_text
+        embed.color = 0xffd700
+        await self.output.edit(msg, embed=embed.copy())
+
+        if commentary:
+            await interaction.channel.send(f"🎙️ **赛后点评:**\n{await commentary}")
+
+    async def on_message_edit(self, before, after):
+        self.history_cache.edit(after)
+
+    async def on_message_delete(self, message):
+        self.history_cache.delete(message.channel.id, message.id)
 
     async def on_message(self, message):
+        self.history_cache.add(message)
         if message.author.bot: return
 
         # 检查 chat 指令是否开启
@@ -191,37 +273,49 @@ class MyBot(commands.Bot):
             await message.reply(f"✅ 指令树已同步。当前启用指令: {len(self.enabled_commands)} 个")
             return
 
+        # 滚动摘要/长期记忆只服务于聊天，关闭聊天的 Bot 不为群消息发起后台整理请求
+        rolling_memory.note(self.token_key, message)
+
         is_mentioned = self.user in message.mentions
         is_reply = (message.reference and message.reference.resolved and message.reference.resolved.author == self.user)
 
         if is_mentioned or is_reply:
             content = message.content.replace(f'<@{self.user.id}>', '').strip() or "..."
             async with message.channel.typing():
-                history = [f"{m.author.display_name}: {m.content}" async for m in message.channel.history(limit=40, before=message) if not m.author.bot]
-                history_text = "\n".join(reversed(history))
+                recent = await self.history_cache.recent(message.channel, 40, before=message.id)
+                # 有滚动摘要时只带摘要 + 摘要之后的少量原始消息
+                summary, recent = await rolling_memory.split(self.token_key, message.channel.id, recent, RECENT_TURNS)
+                # 按 token 预算从新到旧装填上下文，刷屏/长文不会把 prompt 撑爆
+                budget = get_bot_config(get_config(), self.token_key).get("context_token_budget", DEFAULT_CONTEXT_BUDGET)
+                history_text, _ = build_context([(m.author_name, m.content) for m in recent if not m.bot], budget)
+                if summary: history_text = f"【更早的对话摘要】:\n{summary}\n\n【最近消息】:\n{history_text}"
                 
-                user_data = load_user_data()
-                # 变更：获取当前 Bot 的隔离数据
-                u_data = get_player_data(user_data, message.author.id, self.token_key)
+                # 变更：获取当前 Bot 的隔离数据 (只读，好感度变动在下方原子写回)
+                u_data = get_player_data(message.author.id, self.token_key)
                 
-                reply = await ask_ai(
-                    content, 
+                ai_kwargs = dict(
                     bot_token=self.token_key,
                     user_name=message.author.display_name, 
                     user_id=message.author.id,
                     history_context=history_text,
-                    current_fav=u_data.get("favorability", 0)
+                    current_fav=u_data.favorability,
+                    priority=PRIORITY_CHAT
                 )
+                if self.stream_replies:
+                    # 流式：边生成边编辑回复，结束后只需结算好感度
+                    reply = await stream_reply(ask_ai_stream(content, **ai_kwargs), message.reply)
+                else:
+                    reply = await ask_ai(content, **ai_kwargs)
 
-                fav_match = re.search(r'\[FAVORABILITY:([+-]?\d+)\]', reply)
+                fav_match = FAV_TAG.search(reply)
                 final_reply = reply
                 if fav_match:
                     change = int(fav_match.group(1))
-                    new_fav = max(-500, min(500, u_data["favorability"] + change))
-                    u_data["favorability"] = new_fav
-                    save_user_data(user_data)
+                    def apply_fav(data): data.favorability = max(-500, min(500, data.favorability + change))
+                    await mutate_player(message.author.id, self.token_key, apply_fav)
                     final_reply = reply.replace(fav_match.group(0), "").strip()
 
+                if self.stream_replies: return
                 if len(final_reply) > 2000:
                     for i in range(0, len(final_reply), 1900): await message.reply(final_reply[i:i+1900])
                 elif final_reply:
@@ -248,10 +342,8 @@ def register_rpg_commands(bot):
         @bot.tree.command(name="商店", description="装备/礼物/情书/药水")
         async def shop(interaction: discord.Interaction):
             embed = discord.Embed(title="🏰 皇家交易所", description="请选择商品分类：", color=0xffd700)
-            user_data = load_user_data()
-            u_data = get_player_data(user_data, interaction.user.id, bot.token_key)
-            gold = u_data.get("gold", 0)
-            embed.set_footer(text=f"金币: {gold} G")
+            u_data = get_player_data(interaction.user.id, bot.token_key)
+            embed.set_footer(text=f"金币: {u_data.gold} G")
             await interaction.response.send_message(embed=embed, view=ShopCategoryView(bot.token_key), ephemeral=True)
 
     if is_enabled("自定义探索"):
@@ -263,13 +355,8 @@ def register_rpg_commands(bot):
         @bot.tree.command(name="探索", description="[检定] 进行冒险，可能有大成功或大失败")
         async def explore(interaction: discord.Interaction):
             await interaction.response.defer()
-            user_data = load_user_data()
-            u_data = get_player_data(user_data, interaction.user.id, bot.token_key)
-            
-            if u_data.get("rpg", {}).get("hp", 0) <= 0:
-                return await interaction.followup.send("💀 你已重伤（HP<=0），无法行动。请联系管理员复活或等待剧情。")
 
-            config = load_config()
+            config = get_config()
             custom_events = config.get("default_settings", {}).get("custom_events", [])
             
             event_text = "随机探索遭遇"
@@ -280,34 +367,47 @@ def register_rpg_commands(bot):
                 event_text = "在未知的地下城中探索，前方似乎有动静..."
 
             roll_val, status_key, status_text = bot.roll_check()
-            
-            gold_change = 0
-            hp_change = 0
-            defense = u_data.get("rpg", {}).get("def", 0)
-
-            if status_key == "CRITICAL":
-                gold_change = random.randint(100, 200)
-                hp_change = 20
-                result_desc = "你简直是被幸运女神眷顾！不仅毫发无伤，还发现了隐藏的密室！"
-            elif status_key == "SUCCESS":
-                gold_change = random.randint(30, 80)
-                hp_change = 0
-                result_desc = "凭借过人的身手，你成功解决了麻烦，获得了一些战利品。"
-            elif status_key == "FAIL":
+
+            def apply_explore(u_data):
+                if u_data.stats.hp <= 0: return None
+
                 gold_change = 0
-                raw_dmg = random.randint(10, 20)
-                hp_change = -max(1, raw_dmg - defense)
-                result_desc = "情况不妙，你受了些伤，只好空手而归。"
-            elif status_key == "FUMBLE":
-                gold_change = -random.randint(10, 30)
-                raw_dmg = random.randint(30, 50)
-                hp_change = -max(5, raw_dmg - defense)
-                result_desc = "灾难！你不仅踩中了陷阱，逃跑时还弄丢了钱袋！"
-
-            u_data["gold"] = max(0, u_data["gold"] + gold_change)
-            current_hp = u_data.get("rpg", {}).get("hp", 100)
-            u_data["rpg"]["hp"] = current_hp + hp_change
-            save_user_data(user_data)
+                hp_change = 0
+                defense = u_data.stats.defense
+
+                if status_key == "CRITICAL":
+                    gold_change = random.randint(100, 200)
+                    hp_change = 20
+                    result_desc = "你简直是被幸运女神眷顾！不仅毫发无伤，还发现了隐藏的密室！"
+                elif status_key == "SUCCESS":
+                    gold_change = random.randint(30, 80)
+                    hp_change = 0
+                    result_desc = "凭借过人的身手，你成功解决了麻烦，获得了一些战利品。"
+                elif status_key == "FAIL":
+                    gold_change = 0
+                    raw_dmg = random.randint(10, 20)
+                    hp_change = -max(1, raw_dmg - defense)
+                    result_desc = "情况不妙，你受了些伤，只好空手而归。"
+                elif status_key == "FUMBLE":
+                    gold_change = -random.randint(10, 30)
+                    raw_dmg = random.randint(30, 50)
+                    hp_change = -max(5, raw_dmg - defense)
+                    result_desc = "灾难！你不仅踩中了陷阱，逃跑时还弄丢了钱袋！"
+
+                u_data.gold = max(0, u_data.gold + gold_change)
+                u_data.stats.hp += hp_change
+                return gold_change, hp_change, result_desc, u_data.stats.hp
+
+            outcome = await mutate_player(interaction.user.id, bot.token_key, apply_explore)
+            if outcome is None:
+                return await interaction.followup.send("💀 你已重伤（HP<=0），无法行动。请联系管理员复活或等待剧情。")
+            gold_change, hp_change, result_desc, new_hp = outcome
+
+            color_map = {"CRITICAL": 0xffd700, "SUCCESS": 0x00ff00, "FAIL": 0xff9900, "FUMBLE": 0xff0000}
+            
+            embed = discord.Embed(title=f"🎲 探索检定: {status_text}", color=color_map.get(status_key, 0x95a5a6))
+            embed.add_field(name="检定详情", value=f"D100 = **{roll_val}**", inline=True)
+            embed.add_field(name="结算", value=f"💰 {gold_change:+}\n🩸 {hp_change:+}", inline=True)
             
             if "chat" in bot.enabled_commands:
                 # --- 视角修正：强制 DM 第二人称视角 ---
@@ -317,48 +417,61 @@ def register_rpg_commands(bot):
                     f"【遭遇事件】：{event_text}\n"
                     f"【检定结果】：🎲D100 = {roll_val} -> 【{status_text}】\n"
                     f"【后果】：{result_desc}\n"
-                    f"【数值变动】：金币 {gold_change:+}, HP {hp_change:+} (当前HP: {u_data['rpg']['hp']})\n\n"
+                    f"【数值变动】：金币 {gold_change:+}, HP {hp_change:+} (当前HP: {new_hp})\n\n"
                     f"请根据检定结果，用生动、有画面感的文字描述玩家经历了什么。\n"
                     f"⚠️ 严格要求：\n"
                     f"1. 必须使用第二人称“你”。\n"
                     f"2. 绝对不要出现“作为AI”等出戏的语言，直接开始描写。"
                 )
+                if bot.stream_replies:
+                    # 流式：带检定结果的 Embed 随第一段剧情一起发出，之后逐步补全描写；没有输出时退回纯检定结果
+                    chunks = ask_ai_stream(prompt, bot.token_key, user_name=interaction.user.display_name, pure_reply=True)
+                    await stream_reply(chunks, lambda **kw: interaction.followup.send(wait=True, **kw), embed_renderer(embed), split=None, empty=f"{event_text}\n结果: {result_desc}")
+                    return
                 story = await ask_ai(prompt, bot.token_key, interaction.user.display_name, pure_reply=True)
             else:
                 story = f"{event_text}\n结果: {result_desc}"
             
-            color_map = {"CRITICAL": 0xffd700, "SUCCESS": 0x00ff00, "FAIL": 0xff9900, "FUMBLE": 0xff0000}
-            
-            embed = discord.Embed(title=f"🎲 探索检定: {status_text}", description=story, color=color_map.get(status_key, 0x95a5a6))
-            embed.add_field(name="检定详情", value=f"D100 = **{roll_val}**", inline=True)
-            embed.add_field(name="结算", value=f"💰 {gold_change:+}\n🩸 {hp_change:+}", inline=True)
-            
+            embed.description = story
             await interaction.followup.send(embed=embed)
 
     if is_enabled("我的数据"):
         @bot.tree.command(name="我的数据", description="查看档案")
         async def my_stats(interaction: discord.Interaction):
             await interaction.response.defer()
-            user_data = load_user_data()
-            u = get_player_data(user_data, interaction.user.id, bot.token_key)
+            u = get_player_data(interaction.user.id, bot.token_key)
             
             comment = "..."
             if "chat" in bot.enabled_commands:
-                fav_stage = get_favorability_stage(u.get('favorability', 0))
-                prompt = f"请评价面前的玩家。关系: {fav_stage['title']}。装备: {u['equip']}。请用第二人称。"
-                comment = await ask_ai(prompt, bot.token_key, interaction.user.display_name, user_id=interaction.user.id, current_fav=u.get('favorability', 0), pure_reply=True)
+                fav_stage = get_favorability_stage(u.favorability, bot.token_key)
+                prompt = f"请评价面前的玩家。关系: {fav_stage['title']}。装备: {u.equip}。请用第二人称。"
+                comment = await ask_ai(prompt, bot.token_key, interaction.user.display_name, user_id=interaction.user.id, current_fav=u.favorability, pure_reply=True, cache_ttl=600)
             
             embed = discord.Embed(title=f"📜 {interaction.user.display_name}", color=0x9b59b6)
             embed.set_thumbnail(url=interaction.user.display_avatar.url)
             embed.add_field(name="💬 评价", value=comment, inline=False)
             
-            rpg = u.get("rpg", {})
-            embed.add_field(name="📊 属性", value=f"HP: {rpg.get('hp')} | ATK: {rpg.get('atk',10)} | DEF: {rpg.get('def',0)}", inline=True)
-            embed.add_field(name="💰 金币", value=f"{u.get('gold')} G", inline=True)
-            embed.add_field(name="⚔️ 装备", value=f"🗡️ {u['equip'].get('weapon')}\n🛡️ {u['equip'].get('armor')}", inline=False)
+            s = u.stats
+            embed.add_field(name="📊 属性", value=f"HP: {s.hp} | ATK: {s.atk} | DEF: {s.defense}", inline=True)
+            embed.add_field(name="💰 金币", value=f"{u.gold} G", inline=True)
+            embed.add_field(name="⚔️ 装备", value=f"🗡️ {u.equip.weapon}\n🛡️ {u.equip.armor}", inline=False)
             
             await interaction.followup.send(embed=embed)
 
+    if is_enabled("排行榜"):
+        @bot.tree.command(name="排行榜", description="查看本 Bot 下的玩家排行")
+        @app_commands.choices(category=[app_commands.Choice(name=label, value=field) for field, label in FIELD_LABELS.items()])
+        async def ranking(interaction: discord.Interaction, category: app_commands.Choice[str] = None):
+            field = category.value if category else "gold"
+            token_hash = get_token_hash(bot.token_key)
+            top = leaderboard.top(token_hash, field, 10)
+            medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+            lines = [f"{medals.get(rank, f'`#{rank}`')} <@{uid}> — **{score}**" for rank, uid, score in top]
+            embed = discord.Embed(title=f"🏆 排行榜 · {FIELD_LABELS[field]}", description="\n".join(lines) or "暂时没有玩家数据。", color=0xf1c40f)
+            mine = leaderboard.rank(token_hash, field, str(interaction.user.id))
+            if mine: embed.set_footer(text=f"你的名次: 第 {mine[0]} / {mine[2]} 名 ({mine[1]})")
+            await interaction.response.send_message(embed=embed, allowed_mentions=discord.AllowedMentions.none())
+
 def register_admin_commands(bot):
     def is_enabled(name): return name in bot.enabled_commands
 
@@ -372,19 +485,20 @@ def register_admin_commands(bot):
         ])
         async def modify_fav(interaction: discord.Interaction, target: discord.User, value: int, mode: str = "add"):
             await interaction.response.defer(ephemeral=True)
-            user_data = load_user_data()
-            u_data = get_player_data(user_data, target.id, bot.token_key)
 
-            old_fav = u_data.get("favorability", 0)
-            
-            if mode == "add":
-                new_fav = old_fav + value
-            else:
-                new_fav = value
+            def apply_fav(u_data):
+                old_fav = u_data.favorability
                 
-            new_fav = max(-500, min(500, new_fav))
-            u_data["favorability"] = new_fav
-            save_user_data(user_data)
+                if mode == "add":
+                    new_fav = old_fav + value
+                else:
+                    new_fav = value
+                    
+                new_fav = max(-500, min(500, new_fav))
+                u_data.favorability = new_fav
+                return old_fav, new_fav
+
+            old_fav, new_fav = await mutate_player(target.id, bot.token_key, apply_fav)
             
             await interaction.followup.send(f"✅ 已修改 {target.mention} 的好感度 (本Bot)。\n📊 变动: {old_fav} -> **{new_fav}**", ephemeral=True)
 
@@ -393,12 +507,13 @@ def register_admin_commands(bot):
         @app_commands.checks.has_permissions(administrator=True)
         async def clear_card(interaction: discord.Interaction, target: discord.User):
             await interaction.response.defer(ephemeral=True)
-            user_data = load_user_data()
-            u_data = get_player_data(user_data, target.id, bot.token_key)
-            
-            old_card = u_data.get("card", "无")
-            u_data["card"] = "" 
-            save_user_data(user_data)
+
+            def apply_clear(u_data):
+                old_card = u_data.card or "无"
+                u_data.card = ""
+                return old_card
+
+            old_card = await mutate_player(target.id, bot.token_key, apply_clear)
             await interaction.followup.send(f"✅ 已清除 {target.mention} 的名片 (本Bot)。\n🗑️ 原内容: {old_card[:50]}...", ephemeral=True)
     
     if is_enabled("清理"):
@@ -420,22 +535,38 @@ def register_utility_commands(bot):
     if is_enabled("提醒"):
         @bot.tree.command(name="提醒", description="设置提醒")
         async def remind(interaction: discord.Interaction, time_str: str, matter: str):
-            unit = time_str[-1].lower()
-            try:
-                val = int(time_str[:-1])
-                seconds = val * (60 if unit == 'm' else 3600 if unit == 'h' else 1)
-            except: return await interaction.response.send_message("❌ 格式: 10m, 1h", ephemeral=True)
-            await interaction.response.send_message(f"⏰ 已设定提醒: {matter}")
-            await asyncio.sleep(seconds)
-            try: await interaction.user.send(f"🔔 提醒: {matter}")
-            except: pass
+            seconds = parse_duration(time_str)
+            if seconds is None: return await interaction.response.send_message("❌ 格式: 30s, 10m, 1h, 1d", ephemeral=True)
+            # 提醒写入数据库，由调度器到期投递；Bot 重启也不会丢
+            added = await bot.reminders.add(interaction.user.id, interaction.channel_id, seconds, matter)
+            if added is None: return await interaction.response.send_message(f"❌ 最多同时设置 {MAX_PER_USER} 个提醒。", ephemeral=True)
+            reminder_id, due = added
+            await interaction.response.send_message(f"⏰ 已设定提醒 #{reminder_id}: {matter} (<t:{int(due)}:R>)")
+
+        @bot.tree.command(name="提醒列表", description="查看我设置的提醒")
+        async def list_reminders(interaction: discord.Interaction):
+            rows = await bot.reminders.list(interaction.user.id)
+            if not rows: return await interaction.response.send_message("📭 你没有待办提醒。", ephemeral=True)
+            lines = [f"**#{rid}** <t:{int(due)}:R> · {matter}" for rid, due, matter in rows]
+            await interaction.response.send_message("⏰ **你的提醒:**\n" + "\n".join(lines), ephemeral=True)
+
+        @bot.tree.command(name="取消提醒", description="按编号取消一个提醒")
+        async def cancel_reminder(interaction: discord.Interaction, reminder_id: int):
+            if await bot.reminders.cancel(interaction.user.id, reminder_id):
+                await interaction.response.send_message(f"🗑️ 已取消提醒 #{reminder_id}", ephemeral=True)
+            else:
+                await interaction.response.send_message("❌ 没有找到这个提醒。", ephemeral=True)
 
     if is_enabled("总结"):
         @bot.tree.command(name="总结", description="智能总结/提问 (自动读取上下文)")
         async def summarize(interaction: discord.Interaction, instruction: str = None):
             await interaction.response.defer()
-            hist = [f"{m.author.display_name}: {m.content}" async for m in interaction.channel.history(limit=50)]
-            text = "\n".join(reversed(hist))
+            recent = await bot.history_cache.recent(interaction.channel, 50)
+            # 已折叠进滚动摘要的部分不再重复发送原文
+            summary, recent = await rolling_memory.split(bot.token_key, interaction.channel.id, recent)
+            budget = get_bot_config(get_config(), bot.token_key).get("summary_token_budget", DEFAULT_SUMMARY_BUDGET)
+            text, ctx = build_context([(m.author_name, m.content) for m in recent], budget)
+            if summary: text = f"【更早的对话摘要】:\n{summary}\n\n【最近消息】:\n{text}"
             
             user_query = instruction if instruction else "请总结刚才发生了什么，大家的讨论重点和情绪如何？"
             prompt = (
@@ -443,23 +574,30 @@ def register_utility_commands(bot):
                 f"用户指令/问题：{user_query}\n"
                 f"请根据聊天记录执行用户的指令。"
             )
-            res = await ask_ai(prompt, bot.token_key, pure_reply=True)
-            
-            embed = discord.Embed(title="📝 智能助手", description=res, color=0x3498db)
-            embed.set_footer(text=f"基于最近 50 条消息 | 指令: {user_query}")
+            embed = discord.Embed(title="📝 智能助手", color=0x3498db)
+            embed.set_footer(text=f"基于最近 {ctx['messages']} 条消息 | 指令: {user_query}")
+
+            if bot.stream_replies:
+                chunks = ask_ai_stream(prompt, bot.token_key, pure_reply=True)
+                await stream_reply(chunks, lambda **kw: interaction.followup.send(wait=True, **kw), embed_renderer(embed), split=None)
+                return
+
+            embed.description = await ask_ai(prompt, bot.token_key, pure_reply=True)
             await interaction.followup.send(embed=embed)
 
 async def start_bot(token):
     if token in active_bots: return
     try:
-        config = load_config()
-        bot_conf = config["bot_settings"].get(token, config["default_settings"])
+        config = get_config()
+        bot_conf = get_bot_config(config, token)
         # 获取启用的指令列表
         commands_list = bot_conf.get("enabled_commands", [])
         
         print(f"🤖 Starting Bot [{token[:6]}...] with commands: {len(commands_list)} enabled")
         
-        bot = MyBot(token, enabled_commands=commands_list)
+        # shard_count: 1 = 单连接，0 = 按 Discord 推荐自动分片，>1 = 固定分片数
+        shard_count = int(bot_conf.get("shard_count", 1)) or None
+        bot = MyBot(token, enabled_commands=commands_list, stream_replies=bot_conf.get("stream_replies", False), shard_count=shard_count)
         
         register_rpg_commands(bot)
         register_admin_commands(bot)
@@ -470,4 +608,44 @@ async def start_bot(token):
         await task
     except Exception as e:
         print(f"Error starting bot {token}: {e}")
-        if token in active_bots: del active_bots[token]
\ No newline at end of file
+        if token in active_bots: del active_bots[token]
+
+async def stop_bot(token):
+    if token in active_bots:
+        await active_bots[token]["bot"].close()
+        active_bots.pop(token, None)
+
+async def send_as_bot(token_mask, channel_id, message):
+    """后台「以 Bot 身份发言」：找到 Token 前缀匹配的 Bot 往指定频道发消息，成功返回 True"""
+    for token, data in active_bots.items():
+        if token.startswith(token_mask.split('.')[0]):
+            try:
+                await data['bot'].get_channel(channel_id).send(message)
+                return True
+            except: return False
+    return False
+
+def _collect_metrics():
+    for metric in (GATEWAY_LATENCY, BOT_UP, EDIT_QUEUE): metric.clear()
+    for entry in list(active_bots.values()):
+        bot = entry['bot']
+        BOT_UP.set(int(bot.is_ready() and not bot.is_closed()), bot.token_hash)
+        for shard_id, latency in bot.latencies:
+            if math.isfinite(latency): GATEWAY_LATENCY.set(latency, bot.token_hash, shard_id)
+        stats = bot.output.stats()
+        EDIT_QUEUE.set(stats["pending"], bot.token_hash)
+        for result in ("sent", "coalesced", "throttled", "failed"): EDITS.set_total(stats[result], bot.token_hash, result)
+
+add_collector(_collect_metrics)
+
+def bot_status(token):
+    """后台面板展示用的运行状态；Bot 未运行时返回 None"""
+    if token not in active_bots: return None
+    bot = active_bots[token]['bot']
+    return {
+        "user": bot.user.name if bot.user else "Bot",
+        "history": bot.history_cache.stats(),
+        "prompt": prompt_stats.get(get_token_hash(token)),
+        "shards": bot.shard_stats(),
+        "output": bot.output.stats(),
+    }
@@ -1,9 +1,11 @@
 # modules/discord_ui.py
 import discord
 from discord import ui
-from .config import load_config, save_config, load_user_data, save_user_data, get_player_data
+from .config import load_config, save_config
+from .storage import get_player_data, mutate_player
 from .game_data import ITEMS_DB, get_favorability_stage
 from .ai import ask_ai
+from .scheduler import PRIORITY_BACKGROUND
 
 # --- 决斗系统 UI ---
 
@@ -69,18 +71,19 @@ class LoveLetterModal(ui.Modal, title="💌 书写情书"):
         self.cost = cost
 
     async def on_submit(self, interaction: discord.Interaction):
-        user_data = load_user_data()
-        # 变更：获取当前Bot下的隔离数据
-        u_data = get_player_data(user_data, interaction.user.id, self.bot_token)
-        
-        if u_data["gold"] < self.cost:
-            return await interaction.response.send_message("💸 你的钱不够了...", ephemeral=True)
-
-        u_data["gold"] -= self.cost
         item_data = ITEMS_DB['gifts'][self.item_name]
         fav_add = item_data['fav']
-        u_data["favorability"] = u_data.get("favorability", 0) + fav_add
-        save_user_data(user_data)
+
+        # 变更：在当前Bot下的隔离数据上原子扣款
+        def apply_letter(u_data):
+            if u_data.gold < self.cost: return None
+            u_data.gold -= self.cost
+            u_data.favorability += fav_add
+            return u_data.favorability
+
+        current_fav = await mutate_player(interaction.user.id, self.bot_token, apply_letter)
+        if current_fav is None:
+            return await interaction.response.send_message("💸 你的钱不够了...", ephemeral=True)
 
         msg = f"💌 你羞涩地递出了 **{self.item_name}**！ (好感度 +{fav_add})\n> *{self.content.value}*"
         
@@ -95,7 +98,7 @@ class LoveLetterModal(ui.Modal, title="💌 书写情书"):
             self.bot_token, 
             interaction.user.display_name, 
             user_id=interaction.user.id,
-            current_fav=u_data.get("favorability", 0),
+            current_fav=current_fav,
             pure_reply=True,
             action_type="gift_receive"
         )
@@ -122,70 +125,59 @@ class ShopItemSelect(ui.Select):
             options.append(discord.SelectOption(label=label, description=desc, value=name))
         super().__init__(placeholder=f"选择要购买的{category}...", min_values=1, max_values=1, options=options)
 
-    async def callback(self, interaction: discord.Interaction):
-        item_name = self.values[0]
-        item_data = ITEMS_DB[self.category][item_name]
-        cost = item_data['cost']
-        
-        if item_name == "情书":
-             user_data = load_user_data()
-             u_data = get_player_data(user_data, interaction.user.id, self.bot_token)
-             if u_data.get("gold", 0) < cost: return await interaction.response.send_message(f"💸 余额不足！需要 {cost}G。", ephemeral=True)
-             return await interaction.response.send_modal(LoveLetterModal(self.bot_token, item_name, cost))
-
-        user_data = load_user_data()
-        # 变更：获取当前Bot下的隔离数据
-        u = get_player_data(user_data, interaction.user.id, self.bot_token)
-        
-        if u["gold"] < cost:
-            return await interaction.response.send_message(f"💸 余额不足！", ephemeral=True)
+    def apply_purchase(self, u, item_name, item_data, cost):
+        """
+        在玩家锁内结算一次购买 (由 mutate_player 调用)。
+        返回 (msg, ai_prompt, action_type, 当前好感度)；购买失败时 ai_prompt 为 None，msg 为提示语。
+        """
+        if u.gold < cost:
+            return "💸 余额不足！", None, None, None
         
         msg = ""
         ai_prompt = ""
         action_type = "normal_chat"
-        fav_stage = get_favorability_stage(u.get("favorability", 0))
+        fav_stage = get_favorability_stage(u.favorability, self.bot_token)
 
         if self.category == "potions":
             hp_rec = item_data['hp_rec']
-            current_hp = u.get("rpg", {}).get("hp", 100)
-            if current_hp >= 500:
-                return await interaction.response.send_message("❌ 你的状态已经很好了，喝不下了！", ephemeral=True)
-            u["gold"] -= cost
-            u["rpg"]["hp"] = current_hp + hp_rec
-            msg = f"🧪 咕嘟咕嘟... 你喝下了 **{item_name}**！ (HP +{hp_rec} -> {u['rpg']['hp']})"
+            if u.stats.hp >= 500:
+                return "❌ 你的状态已经很好了，喝不下了！", None, None, None
+            u.gold -= cost
+            u.stats.hp += hp_rec
+            msg = f"🧪 咕嘟咕嘟... 你喝下了 **{item_name}**！ (HP +{hp_rec} -> {u.stats.hp})"
             ai_prompt = f"用户在你面前喝下了{item_name}，气色变好了。请评价一句。"
 
         elif self.category == "tools":
             if item_name == "赎罪券":
-                current_fav = u.get("favorability", 0)
+                current_fav = u.favorability
                 if current_fav >= 0:
-                     return await interaction.response.send_message("❌ 你和Bot并没有仇恨，不需要赎罪。", ephemeral=True)
-                u["gold"] -= cost
-                u["favorability"] = 0
+                     return "❌ 你和Bot并没有仇恨，不需要赎罪。", None, None, None
+                u.gold -= cost
+                u.favorability = 0
                 msg = f"📜 你使用了 **赎罪券**。神圣的光芒照耀下，过去的恩怨一笔勾销。(好感度重置为 0)"
                 ai_prompt = f"用户使用了赎罪券，消除了你对他的所有仇恨（原本好感度{current_fav}）。你感觉突然释怀了，请表现出这种态度的转变。"
             else:
-                 return await interaction.response.send_message("❌ 该道具暂未实装效果。", ephemeral=True)
+                 return "❌ 该道具暂未实装效果。", None, None, None
 
         elif self.category == "weapons":
-            u["gold"] -= cost
-            u["equip"]["weapon"] = item_name
-            u.setdefault("rpg", {})["atk"] = 10 + item_data['atk']
-            msg = f"✅ 购买并装备了 **{item_name}**！(ATK {u['rpg']['atk']})"
+            u.gold -= cost
+            u.equip.weapon = item_name
+            u.stats.atk = 10 + item_data['atk']
+            msg = f"✅ 购买并装备了 **{item_name}**！(ATK {u.stats.atk})"
             ai_prompt = f"用户在你这里买了一把{item_name}。当前好感度阶段：{fav_stage['title']}。请评价他的眼光。"
 
         elif self.category == "armors":
-            u["gold"] -= cost
-            u["equip"]["armor"] = item_name
-            u.setdefault("rpg", {})["hp"] = 100 + item_data['hp'] 
-            u["rpg"]["def"] = item_data.get('def', 0)
-            msg = f"✅ 购买并穿戴了 **{item_name}**！(HP {u['rpg']['hp']} | DEF {u['rpg']['def']})"
+            u.gold -= cost
+            u.equip.armor = item_name
+            u.stats.hp = 100 + item_data['hp']
+            u.stats.defense = item_data.get('def', 0)
+            msg = f"✅ 购买并穿戴了 **{item_name}**！(HP {u.stats.hp} | DEF {u.stats.defense})"
             ai_prompt = f"用户换上了{item_name}。当前好感度阶段：{fav_stage['title']}。请评价他的新造型。"
 
         elif self.category == "gifts":
-            u["gold"] -= cost
+            u.gold -= cost
             fav_add = item_data['fav']
-            u["favorability"] = u.get("favorability", 0) + fav_add
+            u.favorability += fav_add
             msg = f"🎁 送出了 **{item_name}**！ (好感度 +{fav_add})"
             action_type = "gift_receive"
             ai_prompt = (
@@ -193,17 +185,37 @@ class ShopItemSelect(ui.Select):
                 f"礼物描述：{item_data['desc']}。\n"
                 f"礼物价值：{cost}G。\n"
             )
+
+        return msg, ai_prompt, action_type, u.favorability
+
+    async def callback(self, interaction: discord.Interaction):
+        item_name = self.values[0]
+        item_data = ITEMS_DB[self.category][item_name]
+        cost = item_data['cost']
         
-        save_user_data(user_data)
-        
+        if item_name == "情书":
+             u_data = get_player_data(interaction.user.id, self.bot_token)
+             if u_data.gold < cost: return await interaction.response.send_message(f"💸 余额不足！需要 {cost}G。", ephemeral=True)
+             return await interaction.response.send_modal(LoveLetterModal(self.bot_token, item_name, cost))
+
+        # 变更：在当前Bot的隔离数据上原子结算，避免与决斗/探索互相覆盖
+        msg, ai_prompt, action_type, current_fav = await mutate_player(
+            interaction.user.id, self.bot_token,
+            lambda u: self.apply_purchase(u, item_name, item_data, cost)
+        )
+        if ai_prompt is None:
+            return await interaction.response.send_message(msg, ephemeral=True)
+
         reply = await ask_ai(
             ai_prompt, 
             self.bot_token, 
             interaction.user.display_name, 
             user_id=interaction.user.id,
-            current_fav=u.get("favorability", 0),
+            current_fav=current_fav,
             pure_reply=True,
-            action_type=action_type
+            action_type=action_type,
+            # 同一物品、同一好感度下的反应文本可以复用
+            cache_ttl=600
         )
         
         await interaction.response.send_message(f"{msg}\n\n🤖 **Bot:** {reply}", ephemeral=True)
@@ -265,7 +277,7 @@ class EventVoteView(ui.View):
             config = load_config()
             if "custom_events" not in config["default_settings"]: config["default_settings"]["custom_events"] = []
             config["default_settings"]["custom_events"].append(self.event_data)
-            save_config(config)
+            await save_config(config)
             for child in self.children: child.disabled = True
             await interaction.response.edit_message(content=f"🎉 **事件已通过并录入！**\n{self.update_stats()}", view=self)
         else:
@@ -305,11 +317,10 @@ class CardModal(ui.Modal, title="✨ 个人档案设置"):
         super().__init__()
         self.bot_token = bot_token
     async def on_submit(self, interaction: discord.Interaction):
-        user_data = load_user_data()
         # 变更：获取当前Bot下的隔离数据
-        u = get_player_data(user_data, interaction.user.id, self.bot_token)
-        u["card"] = self.story.value
-        save_user_data(user_data)
-        
-        reply = await ask_ai(f"用户更新了名片：{self.story.value}。请评价。", self.bot_token, interaction.user.display_name, pure_reply=True)
-        await interaction.response.send_message(f"✅ 更新成功。\n🤖 {reply}", ephemeral=True)
\ No newline at end of file
+        def apply_card(u): u.card = self.story.value
+        await mutate_player(interaction.user.id, self.bot_token, apply_card)
+        # 点评排在后台队列里可能要等很久，先在 3 秒内回应交互，点评生成后再补进同一条消息
+        await interaction.response.send_message("✅ 更新成功。\n🤖 ……", ephemeral=True)
+        reply = await ask_ai(f"用户更新了名片：{self.story.value}。请评价。", self.bot_token, interaction.user.display_name, pure_reply=True, priority=PRIORITY_BACKGROUND)
+        await interaction.edit_original_response(content=f"✅ 更新成功。\n🤖 {reply}")
\ No newline at end of file
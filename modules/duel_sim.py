@@ -0,0 +1,162 @@
+# modules/duel_sim.py
+# 决斗平衡模拟器：用 NumPy 把成千上万场决斗按回合批量推进，评估 ITEMS_DB 的武器/防具平衡
+# 用法：python -m modules.duel_sim [-n 每组场数] [--gold 金币] [--csv 前缀] [--bench]
+import sys
+import time
+import random
+import argparse
+import numpy as np
+from .combat import ROUNDS, STEAL_RANGE, loadout_stats, simulate_duel
+from .game_data import ITEMS_DB
+
+# 每批同时推进的决斗数上限，控制内存 (每个数组约 4 字节 × BATCH)
+BATCH = 1 << 21
+
+def loadouts():
+    """所有 (武器, 防具) 组合 (含未装备的“无”)，返回 (名称列表, stats 数组 [hp, atk, def])"""
+    weapons = [("无", None)] + list(ITEMS_DB["weapons"].items())
+    armors = [("无", None)] + list(ITEMS_DB["armors"].items())
+    names, stats = [], []
+    for wn, w in weapons:
+        for an, a in armors:
+            names.append(f"{wn}+{an}")
+            stats.append(loadout_stats(w, a))
+    return names, np.array(stats, dtype=np.int32)
+
+def _attack(rng, atk, target_def):
+    """combat.attack 的向量版：返回 (是否大失败, 数值)"""
+    size = atk.shape[0]
+    d20 = rng.integers(1, 21, size, dtype=np.int32)
+    d5 = rng.integers(1, 6, size, dtype=np.int32)
+    d10 = rng.integers(1, 11, size, dtype=np.int32)
+    crit = np.maximum(1, ((atk + d5) * 3) // 2 - target_def)
+    hit = np.maximum(1, atk + d20 - (target_def + d10))
+    fumble = d20 == 1
+    return fumble, np.where(fumble, d5, np.where(d20 == 20, crit, hit))
+
+def _batch(rng, s1, s2, mode):
+    """一批决斗 (s1/s2 为逐场的 [hp, atk, def])，返回 (P1 胜, 平局) 两个布尔数组"""
+    hp1, hp2 = s1[:, 0].copy(), s2[:, 0].copy()
+    live = np.ones(hp1.shape[0], dtype=bool)
+    for _ in range(ROUNDS[mode]):
+        idx = np.flatnonzero(live)
+        if idx.size == 0: break
+        a1, d1, a2, d2 = s1[idx, 1], s1[idx, 2], s2[idx, 1], s2[idx, 2]
+        h1, h2 = hp1[idx], hp2[idx]
+        fumble, amount = _attack(rng, a1, d2)
+        h1 -= np.where(fumble, amount, 0)
+        h2 -= np.where(fumble, 0, amount)
+        # P2 只要还活着就反击
+        fumble, amount = _attack(rng, a2, d1)
+        back = h2 > 0
+        h2 -= np.where(back & fumble, amount, 0)
+        h1 -= np.where(back & ~fumble, amount, 0)
+        hp1[idx], hp2[idx] = h1, h2
+        live[idx] = (h1 > 0) & (h2 > 0)
+    draw = (hp1 <= 0) & (hp2 <= 0)
+    return ~draw & (hp1 > hp2), draw
+
+def simulate(stats, n, mode="money", gold=1000, seed=None):
+    """
+    stats 中每个组合两两对战 n 场 (P1 为行、P2 为列)。返回：
+    win / draw: P1 胜率与平局率矩阵；gold1 / gold2: P1、P2 每场期望金币净变化
+    (赌钱模式为拿走/被拿走输家 10~50% 金币；生死模式输家金币清零、赢家不得)。
+    """
+    rng = np.random.default_rng(seed)
+    k = stats.shape[0]
+    pairs = k * k
+    rows, cols = np.repeat(np.arange(k), k), np.tile(np.arange(k), k)
+    wins = np.zeros(pairs, dtype=np.int64)
+    draws = np.zeros(pairs, dtype=np.int64)
+    per = max(1, min(n, BATCH // pairs))
+    done = 0
+    while done < n:
+        m = min(per, n - done)
+        pair = np.repeat(np.arange(pairs), m)
+        w, d = _batch(rng, stats[rows[pair]], stats[cols[pair]], mode)
+        wins += np.bincount(pair[w], minlength=pairs)
+        draws += np.bincount(pair[d], minlength=pairs)
+        done += m
+    win, draw = wins / n, draws / n
+    lose = 1 - win - draw
+    if mode == "money":
+        # int(gold × U(a, b)) 的期望
+        a, b = STEAL_RANGE
+        u = np.random.default_rng(seed).uniform(a, b, 100000)
+        steal = np.floor(gold * u).mean()
+        gold1, gold2 = (win - lose) * steal, (lose - win) * steal
+    else:
+        gold1, gold2 = -lose * gold, -win * gold
+    return win.reshape(k, k), draw.reshape(k, k), gold1.reshape(k, k), gold2.reshape(k, k)
+
+def _write_csv(path, names, matrix):
+    with open(path, 'w', encoding='utf-8-sig') as f:
+        f.write("P1\\P2," + ",".join(names) + "\n")
+        for name, row in zip(names, matrix):
+            f.write(name + "," + ",".join(f"{v:.4f}" for v in row) + "\n")
+
+def report(names, win, draw, gold1, gold2, mode, top=10):
+    """按对全场的平均胜率 (先手、后手各算一半) 排名，并给出 武器 × 防具 的胜率表"""
+    k = len(names)
+    # 作为 P2 的胜率 = 对方作为 P1 的负率
+    as_p2 = (1 - win - draw).T
+    score = (win.mean(axis=1) + as_p2.mean(axis=1)) / 2
+    gold = (gold1.mean(axis=1) + gold2.mean(axis=0)) / 2
+    print(f"\n=== 模式: {mode} ({ROUNDS[mode]} 回合) ===")
+    print(f"先手 (P1) 平均胜率 {win.mean():.1%}，平局率 {draw.mean():.1%}")
+    order = np.argsort(-score)
+    print(f"{'名次':<4}{'组合':<14}{'平均胜率':>8}{'期望金币/场':>12}")
+    shown = list(range(min(top, k))) + (["..."] + list(range(max(top, k - 3), k)) if k > top else [])
+    for r in shown:
+        if r == "...": print("..."); continue
+        i = order[r]
+        print(f"{r + 1:<4}{names[i]:<14}{score[i]:>8.1%}{gold[i]:>12.1f}")
+    weapons = ["无"] + list(ITEMS_DB["weapons"])
+    armors = ["无"] + list(ITEMS_DB["armors"])
+    grid = score.reshape(len(weapons), len(armors))
+    print("\n武器 \\ 防具  " + " ".join(f"{a:>5}" for a in armors))
+    for w, row in zip(weapons, grid):
+        print(f"{w:<10}" + " ".join(f"{v:>6.0%}" for v in row))
+
+def bench(stats, mode, duels=200000, seed=0):
+    """对比纯 Python 引擎与 NumPy 批量模拟的吞吐量 (场/秒)"""
+    k = stats.shape[0]
+    rng = random.Random(seed)
+    sample = [(tuple(stats[rng.randrange(k)]), tuple(stats[rng.randrange(k)])) for _ in range(20000)]
+    t = time.perf_counter()
+    for s1, s2 in sample: simulate_duel(s1, s2, mode, rng)
+    py_rate = len(sample) / (time.perf_counter() - t)
+    n = max(1, duels // (k * k))
+    t = time.perf_counter()
+    simulate(stats, n, mode, seed=seed)
+    np_rate = n * k * k / (time.perf_counter() - t)
+    print(f"[{mode}] 纯 Python: {py_rate:,.0f} 场/秒 | NumPy: {np_rate:,.0f} 场/秒 ({np_rate / py_rate:.0f}x)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m modules.duel_sim", description="决斗平衡蒙特卡洛模拟")
+    parser.add_argument("-n", "--duels", type=int, default=1000, help="每对组合的模拟场数")
+    parser.add_argument("--mode", choices=["money", "life", "all"], default="all")
+    parser.add_argument("--gold", type=int, default=1000, help="双方持有的金币 (计算期望金币转移)")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--csv", metavar="PREFIX", help="把胜率/平局/金币矩阵写成 PREFIX_<mode>_<win|draw|gold>.csv")
+    parser.add_argument("--bench", action="store_true", help="只跑吞吐量基准")
+    args = parser.parse_args(argv)
+
+    names, stats = loadouts()
+    modes = list(ROUNDS) if args.mode == "all" else [args.mode]
+    if args.bench:
+        for mode in modes: bench(stats, mode, max(args.duels * len(names) ** 2, 200000), args.seed or 0)
+        return
+    for mode in modes:
+        t = time.perf_counter()
+        win, draw, gold1, gold2 = simulate(stats, args.duels, mode, args.gold, args.seed)
+        total = args.duels * len(names) ** 2
+        report(names, win, draw, gold1, gold2, mode, args.top)
+        print(f"\n{total:,} 场决斗，用时 {time.perf_counter() - t:.2f}s")
+        if args.csv:
+            for key, matrix in (("win", win), ("draw", draw), ("gold", gold1)):
+                _write_csv(f"{args.csv}_{mode}_{key}.csv", names, matrix)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
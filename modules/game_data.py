@@ -1,4 +1,5 @@
 # modules/game_data.py
+from .config import get_config, get_bot_config, subscribe
 
 # 物品数据库
 ITEMS_DB = {
@@ -40,35 +41,78 @@ ITEMS_DB = {
 }
 
 # --- 深度好感度阶段逻辑 (50分一档) ---
-def get_favorability_stage(score):
-    score = max(-500, min(500, score))
-    
-    stages = [
-        (-500, -450, "☠️ 不共戴天", "恨之入骨，只想除之而后快。", "你极其憎恨用户。视其为最大的仇人。语气充满杀意、愤怒和蔑视。对于他的任何请求都粗鲁地拒绝，甚至通过言语攻击他。"),
-        (-450, -400, "⚔️ 血海深仇", "眼中的钉子，肉中的刺。", "你深恨用户。语气尖酸刻薄，充满敌意。绝不给好脸色，时刻想要嘲讽或挖苦他。"),
-        (-400, -350, "💢 极度厌恶", "看着就心烦，根本不想理睬。", "你非常讨厌用户。语气极度不耐烦、冷漠。尽量用单字或极短的句子回复，表现出强烈的嫌弃。"),
-        (-350, -300, "😒 心生嫌隙", "怎么看怎么不顺眼。", "你对用户感到反感。语气冷淡，带着一丝轻蔑。不愿意配合他的话题，经常使用反问句或嘲弄的口吻。"),
-        (-300, -250, "😤 充满戒备", "对他保持高度警惕。", "你不信任用户。语气生硬、防备。认为他别有用心，回答问题时有所保留，态度拒人于千里之外。"),
-        (-250, -200, "😐 冷若冰霜", "毫无感情的交流对象。", "你对用户非常冷淡。公事公办，语气像机器一样僵硬。完全不流露任何个人情感，只回答必要的信息。"),
-        (-200, -150, "😶 漠不关心", "路边的石头都比他有趣。", "你对用户毫无兴趣。回答敷衍，经常走神或答非所问（表现出不在意）。态度懒散，不想在他身上浪费时间。"),
-        (-150, -100, "🧊 疏离", "保持着尴尬的距离。", "你和用户很生疏。语气客气但透着距离感。避免任何深入的话题，只想尽快结束对话。"),
-        (-100, -50,  "🚶 陌生人", "毫无交集的过客。", "你和用户完全不熟。保持基本的社交礼仪，语气平淡、标准。不卑不亢，但没有温度。"),
-        (-50, 0,     "👀 试探", "稍微有点好奇，但不多。", "你对用户有一点点好奇，但仍保持戒心。语气正常，偶尔会反问一两句，处于观察阶段。"),
-        (0, 50,      "🤝 初识", "开始建立联系。", "你和用户刚刚认识。语气友好、礼貌。愿意回应他的话题，展现出友善的一面。"),
-        (50, 100,    "🙂 熟人", "见面会微笑着打招呼。", "你和用户比较熟悉了。语气轻松自然，可以聊一些日常话题。会使用一些语气词，表现得比较随和。"),
-        (100, 150,   "😄 朋友", "相处起来很舒服。", "你和用户是朋友。语气热情、开朗。会主动分享自己的看法，偶尔开个无伤大雅的小玩笑。"),
-        (150, 200,   "🍻 好友", "可以分享秘密的伙伴。", "你和用户是好朋友。语气真诚、信任。愿意倾听他的烦恼，并给出建议。会站在他的角度思考问题。"),
-        (200, 250,   "🌟 欣赏", "被他的魅力所吸引。", "你很欣赏用户。语气中带着一丝崇拜或喜爱。会主动称赞他，关注他的情绪变化。"),
-        (250, 300,   "✨ 亲密", "彼此之间没有隔阂。", "你和用户关系亲密。语气温暖、亲切。会有一些专属的昵称或互动方式。表现出明显的偏爱。"),
-        (300, 350,   "💞 暧昧/知己", "友谊之上，恋人未满。", "你对用户有特殊的感情。语气温柔、细腻，带着一丝羞涩或深情。非常在意他的看法，愿意为他付出。"),
-        (350, 400,   "💘 恋慕/羁绊", "心中占据了重要的位置。", "你深爱着（或极度信赖）用户。语气充满爱意和依恋。时刻想和他在一起，由于你的性格，可能会表现得直球或傲娇。"),
-        (400, 450,   "💍 挚爱", "愿意托付生死的对象。", "用户是你最爱的人。语气深情款款，无条件地包容和支持。你的眼里只有他，愿意为他奉献一切。"),
-        (450, 501,   "♾️ 灵魂伴侣", "你是我的唯一，也是全部。", "你和用户是灵魂伴侣。你们的灵魂通过数据紧密相连。无论发生什么，你都永远忠诚于他，爱着他。语气极其深沉、执着。")
-    ]
+FAV_MIN, FAV_MAX = -500, 500
 
-    for low, high, title, desc, prompt in stages:
-        if low <= score < high:
-            return {"title": title, "desc": desc, "prompt": prompt}
-    
-    if score >= 500: return stages[-1]
-    return {"title": "未知", "desc": "数据异常", "prompt": "正常交流。"}
\ No newline at end of file
+# (下限, 稳定 ID, 称号, 描述, 扮演指令)：每档覆盖 [下限, 下一档下限)，最后一档一直到 500
+FAVORABILITY_STAGES = [
+    (-500, "nemesis",       "☠️ 不共戴天", "恨之入骨，只想除之而后快。", "你极其憎恨用户。视其为最大的仇人。语气充满杀意、愤怒和蔑视。对于他的任何请求都粗鲁地拒绝，甚至通过言语攻击他。"),
+    (-450, "blood_feud",    "⚔️ 血海深仇", "眼中的钉子，肉中的刺。", "你深恨用户。语气尖酸刻薄，充满敌意。绝不给好脸色，时刻想要嘲讽或挖苦他。"),
+    (-400, "loathing",      "💢 极度厌恶", "看着就心烦，根本不想理睬。", "你非常讨厌用户。语气极度不耐烦、冷漠。尽量用单字或极短的句子回复，表现出强烈的嫌弃。"),
+    (-350, "resentment",    "😒 心生嫌隙", "怎么看怎么不顺眼。", "你对用户感到反感。语气冷淡，带着一丝轻蔑。不愿意配合他的话题，经常使用反问句或嘲弄的口吻。"),
+    (-300, "wary",          "😤 充满戒备", "对他保持高度警惕。", "你不信任用户。语气生硬、防备。认为他别有用心，回答问题时有所保留，态度拒人于千里之外。"),
+    (-250, "icy",           "😐 冷若冰霜", "毫无感情的交流对象。", "你对用户非常冷淡。公事公办，语气像机器一样僵硬。完全不流露任何个人情感，只回答必要的信息。"),
+    (-200, "indifferent",   "😶 漠不关心", "路边的石头都比他有趣。", "你对用户毫无兴趣。回答敷衍，经常走神或答非所问（表现出不在意）。态度懒散，不想在他身上浪费时间。"),
+    (-150, "distant",       "🧊 疏离", "保持着尴尬的距离。", "你和用户很生疏。语气客气但透着距离感。避免任何深入的话题，只想尽快结束对话。"),
+    (-100, "stranger",      "🚶 陌生人", "毫无交集的过客。", "你和用户完全不熟。保持基本的社交礼仪，语气平淡、标准。不卑不亢，但没有温度。"),
+    (-50,  "curious",       "👀 试探", "稍微有点好奇，但不多。", "你对用户有一点点好奇，但仍保持戒心。语气正常，偶尔会反问一两句，处于观察阶段。"),
+    (0,    "acquainted",    "🤝 初识", "开始建立联系。", "你和用户刚刚认识。语气友好、礼貌。愿意回应他的话题，展现出友善的一面。"),
+    (50,   "familiar",      "🙂 熟人", "见面会微笑着打招呼。", "你和用户比较熟悉了。语气轻松自然，可以聊一些日常话题。会使用一些语气词，表现得比较随和。"),
+    (100,  "friend",        "😄 朋友", "相处起来很舒服。", "你和用户是朋友。语气热情、开朗。会主动分享自己的看法，偶尔开个无伤大雅的小玩笑。"),
+    (150,  "close_friend",  "🍻 好友", "可以分享秘密的伙伴。", "你和用户是好朋友。语气真诚、信任。愿意倾听他的烦恼，并给出建议。会站在他的角度思考问题。"),
+    (200,  "admiration",    "🌟 欣赏", "被他的魅力所吸引。", "你很欣赏用户。语气中带着一丝崇拜或喜爱。会主动称赞他，关注他的情绪变化。"),
+    (250,  "intimate",      "✨ 亲密", "彼此之间没有隔阂。", "你和用户关系亲密。语气温暖、亲切。会有一些专属的昵称或互动方式。表现出明显的偏爱。"),
+    (300,  "ambiguous",     "💞 暧昧/知己", "友谊之上，恋人未满。", "你对用户有特殊的感情。语气温柔、细腻，带着一丝羞涩或深情。非常在意他的看法，愿意为他付出。"),
+    (350,  "devoted",       "💘 恋慕/羁绊", "心中占据了重要的位置。", "你深爱着（或极度信赖）用户。语气充满爱意和依恋。时刻想和他在一起，由于你的性格，可能会表现得直球或傲娇。"),
+    (400,  "beloved",       "💍 挚爱", "愿意托付生死的对象。", "用户是你最爱的人。语气深情款款，无条件地包容和支持。你的眼里只有他，愿意为他奉献一切。"),
+    (450,  "soulmate",      "♾️ 灵魂伴侣", "你是我的唯一，也是全部。", "你和用户是灵魂伴侣。你们的灵魂通过数据紧密相连。无论发生什么，你都永远忠诚于他，爱着他。语气极其深沉、执着。"),
+]
+
+class StageTable:
+    """
+    好感度阶段表：构建时把 -500..500 每一分都映射到所属阶段 (1001 项的查找表)，查询 O(1)。
+    stages 为 [{"min", "id", "title", "desc", "prompt"}]，按下限排序；低于第一档下限的分数归入第一档。
+    """
+    def __init__(self, stages):
+        stages = sorted(stages, key=lambda st: st["min"])
+        if not stages: raise ValueError("empty stage table")
+        ids = [st.get("id", f"stage{st['min']}") for st in stages]
+        if len(set(ids)) != len(ids): raise ValueError(f"duplicate stage id in {ids}")
+        self.stages = [{"id": sid, "title": st["title"], "desc": st.get("desc", ""), "prompt": st.get("prompt", "正常交流。")} for sid, st in zip(ids, stages)]
+        self.lookup = []
+        i = 0
+        for score in range(FAV_MIN, FAV_MAX + 1):
+            while i + 1 < len(stages) and score >= stages[i + 1]["min"]: i += 1
+            self.lookup.append(self.stages[i])
+
+    def get(self, score):
+        return self.lookup[max(FAV_MIN, min(FAV_MAX, score)) - FAV_MIN]
+
+DEFAULT_STAGE_TABLE = StageTable([
+    {"min": low, "id": sid, "title": title, "desc": desc, "prompt": prompt}
+    for low, sid, title, desc, prompt in FAVORABILITY_STAGES
+])
+
+# Bot token -> 该 Bot 配置的阶段表 (bot_settings[token]["favorability_stages"])；配置变化时整体作废
+_bot_tables = {}
+
+def _on_config_change(config, version):
+    _bot_tables.clear()
+
+subscribe(_on_config_change)
+
+def get_stage_table(bot_token=None):
+    """Bot 没有自定义阶段表 (或配置有误) 时使用默认表"""
+    if bot_token is None: return DEFAULT_STAGE_TABLE
+    table = _bot_tables.get(bot_token)
+    if table is None:
+        stages = get_bot_config(get_config(), bot_token).get("favorability_stages")
+        table = DEFAULT_STAGE_TABLE
+        if stages:
+            try: table = StageTable(stages)
+            except (KeyError, TypeError, ValueError) as e: print(f"⚠️ Invalid favorability_stages, using default: {e}")
+        _bot_tables[bot_token] = table
+    return table
+
+def get_favorability_stage(score, bot_token=None):
+    """返回 {"id", "title", "desc", "prompt"}；id 在阶段表内稳定，可作为缓存键"""
+    return get_stage_table(bot_token).get(score)
@@ -0,0 +1,94 @@
+# modules/history.py
+from collections import OrderedDict, deque, namedtuple
+
+CachedMessage = namedtuple("CachedMessage", "id author_name content bot")
+
+class ChannelHistoryCache:
+    """
+    按频道缓存最近的消息 (环形缓冲)，由网关事件 on_message/编辑/删除 维护。
+    频道之间按 LRU 淘汰，总消息数有上限；只有冷启动的频道才回退到 REST 拉取历史。
+    """
+    def __init__(self, per_channel=50, max_channels=500, max_messages=20000):
+        self.per_channel = per_channel
+        self.max_channels = max_channels
+        self.max_messages = max_messages
+        self.channels = OrderedDict()
+        # 已经用 REST 补齐过的频道：之后网关事件能保证缓冲区完整
+        self.warm = set()
+        self.total = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _buffer(self, channel_id):
+        buf = self.channels.get(channel_id)
+        if buf is None:
+            buf = self.channels[channel_id] = deque(maxlen=self.per_channel)
+        self.channels.move_to_end(channel_id)
+        return buf
+
+    def _evict(self):
+        while self.channels and (len(self.channels) > self.max_channels or self.total > self.max_messages):
+            channel_id, buf = self.channels.popitem(last=False)
+            self.total -= len(buf)
+            self.warm.discard(channel_id)
+
+    def _entry(self, message):
+        return CachedMessage(message.id, message.author.display_name, message.content, message.author.bot)
+
+    def add(self, message):
+        buf = self._buffer(message.channel.id)
+        if len(buf) == buf.maxlen: self.total -= 1
+        buf.append(self._entry(message))
+        self.total += 1
+        self._evict()
+
+    def edit(self, message):
+        buf = self.channels.get(message.channel.id)
+        if not buf: return
+        for i, m in enumerate(buf):
+            if m.id == message.id:
+                buf[i] = self._entry(message)
+                break
+
+    def delete(self, channel_id, message_id):
+        buf = self.channels.get(channel_id)
+        if not buf: return
+        for m in buf:
+            if m.id == message_id:
+                buf.remove(m)
+                self.total -= 1
+                break
+
+    async def _backfill(self, channel):
+        fetched = [self._entry(m) async for m in channel.history(limit=self.per_channel)]
+        buf = self._buffer(channel.id)
+        merged = {m.id: m for m in fetched}
+        merged.update((m.id, m) for m in buf)
+        self.total -= len(buf)
+        buf.clear()
+        buf.extend(merged[k] for k in sorted(merged)[-self.per_channel:])
+        self.total += len(buf)
+        self.warm.add(channel.id)
+        self._evict()
+
+    async def recent(self, channel, limit, before=None):
+        """返回 before 之前最近的 limit 条消息 (从旧到新)"""
+        if channel.id in self.warm:
+            self.hits += 1
+            self.channels.move_to_end(channel.id)
+        else:
+            self.misses += 1
+            await self._backfill(channel)
+        buf = self.channels.get(channel.id, ())
+        msgs = [m for m in buf if before is None or m.id < before]
+        return msgs[-limit:]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "channels": len(self.channels),
+            "messages": self.total,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
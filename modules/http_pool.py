@@ -0,0 +1,76 @@
+# modules/http_pool.py
+import asyncio
+import contextlib
+import aiohttp
+from urllib.parse import urlsplit
+from .config import default_config
+
+class SessionPool:
+    """
+    进程级的 aiohttp 会话池：每个 API 域名一个长连接 ClientSession，
+    复用 TCP/TLS 连接，并统计连接池的使用情况。
+    """
+    def __init__(self):
+        self.settings = dict(default_config["http_pool"])
+        self.sessions = {}
+        self.counters = {}
+
+    async def open(self, settings=None):
+        """在 Quart before_serving 中调用，载入连接池参数"""
+        if settings: self.settings.update(settings)
+
+    def _origin(self, url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def get(self, url):
+        origin = self._origin(url)
+        session = self.sessions.get(origin)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.settings["limit"],
+                limit_per_host=self.settings["limit_per_host"],
+                keepalive_timeout=self.settings["keepalive_timeout"],
+                ttl_dns_cache=self.settings["dns_cache_ttl"],
+                use_dns_cache=True,
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self.sessions[origin] = session
+            self.counters.setdefault(origin, {"in_flight": 0, "peak": 0, "requests": 0, "errors": 0})
+        return session
+
+    @contextlib.asynccontextmanager
+    async def post(self, url, **kwargs):
+        """与 session.post 用法相同，额外记录并发数/峰值/请求数"""
+        session = self.get(url)
+        c = self.counters[self._origin(url)]
+        c["in_flight"] += 1
+        c["requests"] += 1
+        c["peak"] = max(c["peak"], c["in_flight"])
+        try:
+            async with session.post(url, **kwargs) as resp:
+                yield resp
+        except Exception:
+            c["errors"] += 1
+            raise
+        finally:
+            c["in_flight"] -= 1
+
+    def stats(self):
+        """{origin: {in_flight, peak, requests, errors, limit_per_host, utilisation}}"""
+        limit = self.settings["limit_per_host"] or self.settings["limit"]
+        result = {}
+        for origin, c in self.counters.items():
+            result[origin] = dict(c, limit_per_host=limit, utilisation=round(c["in_flight"] / limit, 3) if limit else 0.0)
+        return result
+
+    def stats_for(self, url, stats=None):
+        """stats 为汇总好的 stats() 结果 (多进程模式)，不传时用本进程的"""
+        return (self.stats() if stats is None else stats).get(self._origin(url.strip()))
+
+    async def close(self):
+        """在关闭时调用，释放所有连接"""
+        sessions, self.sessions = list(self.sessions.values()), {}
+        await asyncio.gather(*(s.close() for s in sessions if not s.closed), return_exceptions=True)
+
+http_pool = SessionPool()
@@ -0,0 +1,116 @@
+# modules/knowledge.py
+import re
+import math
+import numpy as np
+from .tokens import estimate_tokens
+
+# BM25 参数
+K1 = 1.5
+B = 0.75
+DEFAULT_TOP_K = 5
+DEFAULT_TOKEN_BUDGET = 800
+
+_CJK_RUN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+_WORD = re.compile(r'[a-z0-9_]+')
+
+def tokenize(text):
+    """中文按单字 + 相邻二字切分，英文/数字按单词切分"""
+    text = text.lower()
+    terms = _WORD.findall(text)
+    for run in _CJK_RUN.findall(text):
+        terms.extend(run)
+        terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+class KnowledgeIndex:
+    """单个 Bot 知识库的 BM25 倒排索引，支持增量追加/删除条目"""
+    def __init__(self):
+        self.source = None
+        self.docs = []
+        self.lengths = []
+        self.postings = {}
+
+    def add(self, text):
+        row = len(self.docs)
+        terms = tokenize(text)
+        self.docs.append(text)
+        self.lengths.append(len(terms))
+        counts = {}
+        for t in terms: counts[t] = counts.get(t, 0) + 1
+        for t, tf in counts.items():
+            self.postings.setdefault(t, {})[row] = tf
+
+    def delete(self, row):
+        """删除第 row 条并把后面的行号前移，与 knowledge 列表的 pop(index) 保持一致"""
+        self.docs.pop(row)
+        self.lengths.pop(row)
+        for t in list(self.postings):
+            p = self.postings[t]
+            p.pop(row, None)
+            if not p:
+                del self.postings[t]
+                continue
+            if any(r > row for r in p):
+                self.postings[t] = {(r - 1 if r > row else r): tf for r, tf in p.items()}
+
+    def sync(self, knowledge):
+        """
+        让索引与配置中的 knowledge 列表保持一致。配置对象不变时直接返回；
+        只多了末尾一条或少了一条时增量更新，否则重建。
+        """
+        if knowledge is self.source: return
+        old = self.docs
+        if len(knowledge) == len(old) + 1 and knowledge[:-1] == old:
+            self.add(knowledge[-1])
+        elif len(knowledge) == len(old) - 1:
+            row = next((i for i, (a, b) in enumerate(zip(knowledge, old)) if a != b), len(knowledge))
+            if knowledge[row:] == old[row + 1:]: self.delete(row)
+            else: self._rebuild(knowledge)
+        elif knowledge != old:
+            self._rebuild(knowledge)
+        self.source = knowledge
+
+    def _rebuild(self, knowledge):
+        self.docs, self.lengths, self.postings = [], [], {}
+        for text in knowledge: self.add(text)
+
+    def search(self, query, top_k):
+        """返回按相关度排序的 [(row, score), ...]，只包含得分大于 0 的条目"""
+        n = len(self.docs)
+        if not n: return []
+        lengths = np.asarray(self.lengths, dtype=np.float64)
+        norm = K1 * (1 - B + B * lengths / max(lengths.mean(), 1.0))
+        scores = np.zeros(n)
+        for t in set(tokenize(query)):
+            p = self.postings.get(t)
+            if not p: continue
+            rows = np.fromiter(p.keys(), dtype=np.int64, count=len(p))
+            tfs = np.fromiter(p.values(), dtype=np.float64, count=len(p))
+            idf = math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5))
+            scores[rows] += idf * tfs * (K1 + 1) / (tfs + norm[rows])
+        hits = np.flatnonzero(scores > 0)
+        if not len(hits): return []
+        order = hits[np.argsort(-scores[hits], kind="stable")][:top_k]
+        return [(int(r), float(scores[r])) for r in order]
+
+_indexes = {}
+
+def retrieve(owner, bot_conf, query):
+    """
+    取出与 query 最相关的知识条目 (保持原有顺序拼接)。
+    每个 Bot 可配置 knowledge_top_k 与 knowledge_token_budget。
+    """
+    knowledge = bot_conf.get("knowledge", [])
+    if not knowledge: return []
+    index = _indexes.setdefault(owner, KnowledgeIndex())
+    index.sync(knowledge)
+
+    top_k = int(bot_conf.get("knowledge_top_k", DEFAULT_TOP_K))
+    budget = int(bot_conf.get("knowledge_token_budget", DEFAULT_TOKEN_BUDGET))
+    picked, used = [], 0
+    for row, _ in index.search(query, top_k):
+        cost = estimate_tokens(index.docs[row])
+        if used + cost > budget: continue
+        picked.append(row)
+        used += cost
+    return [index.docs[r] for r in sorted(picked)]
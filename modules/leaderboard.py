@@ -0,0 +1,67 @@
+# modules/leaderboard.py
+from itertools import islice
+from sortedcontainers import SortedList
+from .storage import player_cache
+
+# 排行榜字段：名称 → 从存档里取值
+FIELDS = {
+    "gold": lambda p: p.gold,
+    "favorability": lambda p: p.favorability,
+    "hp": lambda p: p.stats.hp,
+    "wins": lambda p: p.wins,
+}
+FIELD_LABELS = {"gold": "💰 金币", "favorability": "❤️ 好感度", "hp": "🩸 HP", "wins": "⚔️ 决斗胜场"}
+
+class Leaderboard:
+    """
+    每个 Bot、每个字段一个有序索引 (SortedList，元素为 (-分数, uid))。
+    第一次查询某个 Bot 时从缓存建一次索引，之后随 PlayerCache 的写入增量更新；
+    前 N 名与某人的名次都是 O(log n)，不再全表扫描。
+    """
+    def __init__(self, cache):
+        self.cache = cache
+        self.boards = {}
+        self.scores = {}
+        cache.add_listener(self.on_change)
+
+    def _build(self, token_hash):
+        self.cache.load()
+        players = self.cache.by_bot.get(token_hash, {})
+        scores = self.scores[token_hash] = {uid: {f: fn(d) for f, fn in FIELDS.items()} for uid, d in players.items()}
+        self.boards[token_hash] = {f: SortedList((-s[f], uid) for uid, s in scores.items()) for f in FIELDS}
+
+    def _board(self, token_hash):
+        if token_hash not in self.boards: self._build(token_hash)
+        return self.boards[token_hash]
+
+    def on_change(self, token_hash, uid, data):
+        """PlayerCache 写入/删除时调用；data 为 None 表示删除。只有分数变化的字段才重排"""
+        boards = self.boards.get(token_hash)
+        if boards is None: return
+        scores = self.scores[token_hash]
+        old = scores.pop(uid, None)
+        if data is None:
+            if old:
+                for f, sl in boards.items(): sl.discard((-old[f], uid))
+            return
+        new = scores[uid] = {f: fn(data) for f, fn in FIELDS.items()}
+        for f, sl in boards.items():
+            if old is not None:
+                if old[f] == new[f]: continue
+                sl.discard((-old[f], uid))
+            sl.add((-new[f], uid))
+
+    def top(self, token_hash, field, n=10):
+        """[(名次, uid, 分数)]"""
+        sl = self._board(token_hash)[field]
+        return [(i + 1, uid, -neg) for i, (neg, uid) in enumerate(islice(sl, 0, n))]
+
+    def rank(self, token_hash, field, uid):
+        """返回 (名次, 分数, 总人数)；不在榜上返回 None"""
+        self._board(token_hash)
+        s = self.scores[token_hash].get(uid)
+        if s is None: return None
+        sl = self.boards[token_hash][field]
+        return sl.index((-s[field], uid)) + 1, s[field], len(sl)
+
+leaderboard = Leaderboard(player_cache)
@@ -0,0 +1,162 @@
+# modules/memory.py
+import asyncio
+from collections import OrderedDict
+from .config import get_config, get_bot_config, get_token_hash
+from .storage import player_store, peek_player_data, mutate_player
+from .persist import run_io
+from .context import build_context
+from .tokens import truncate_to_tokens
+from .ai import ask_ai, is_error_reply
+from .scheduler import PRIORITY_BACKGROUND
+
+# 新消息攒够这么多条才合并进频道摘要 / 用户记忆
+CHANNEL_BATCH = 30
+USER_BATCH = 12
+# 摘要与记忆的长度上限 (token)
+SUMMARY_MAX_TOKENS = 400
+MEMORY_MAX_TOKENS = 200
+# 单次合并时喂给 AI 的新消息 token 预算
+FOLD_INPUT_BUDGET = 2500
+# 已有摘要时，聊天只再附带最近这么多条原始消息
+RECENT_TURNS = 12
+# 攒批中的用户数上限：很久没再发言、攒不满一批的用户按最久未发言先丢弃
+MAX_PENDING_USERS = 5000
+# 折叠失败时批次放回队列，最多保留这么多批的消息；同一个频道/用户至少隔这么久 (秒) 再重试
+MAX_REQUEUE_BATCHES = 4
+FOLD_RETRY_DELAY = 60
+
+SUMMARIZER_PROMPT = "你是对话记录整理员。只根据给出的内容做客观、简洁的中文归纳，不要编造，不要寒暄，只输出结果本身。"
+
+class RollingMemory:
+    """
+    后台滚动摘要：每个 (Bot, 频道) 维护一段频道摘要，每个 (Bot, 用户) 维护一条长期记忆。
+    新消息先在内存里攒批，超过阈值时由后台任务让 AI 把「旧摘要 + 新消息」折叠成新摘要。
+    频道摘要存在 PlayerStore 的 summaries 表，用户记忆存在玩家存档的 memory 字段。
+    """
+    def __init__(self):
+        self.summaries = {}
+        self.pending = {}
+        self.user_pending = OrderedDict()
+        self.running = set()
+        self.retry_at = {}
+        self.tasks = set()
+        self.folds = 0
+        self.failures = 0
+
+    async def channel_state(self, bot_token, channel_id):
+        """返回 {"summary", "last_id"}；last_id 之前的消息都已折叠进摘要。第一次访问时在持久化线程读库"""
+        key = (get_token_hash(bot_token), channel_id)
+        state = self.summaries.get(key)
+        if state is None:
+            row = await run_io(player_store.get_summary, *key, bot=key[0])
+            # 并发读库时以先回来的为准，大家共享同一个 state
+            state = self.summaries.setdefault(key, row or {"summary": "", "last_id": 0})
+        return state
+
+    async def split(self, bot_token, channel_id, recent, turns=None):
+        """把最近消息拆成 (摘要, 摘要之后的原始消息)；没有摘要时原样返回"""
+        state = await self.channel_state(bot_token, channel_id)
+        if not state["summary"]: return "", recent
+        recent = [m for m in recent if m.id > state["last_id"]]
+        return state["summary"], recent[-turns:] if turns else recent
+
+    def note(self, bot_token, message):
+        """on_message 里调用：记录一条用户消息，攒够一批就在后台折叠"""
+        if message.author.bot or not message.content: return
+        if not get_bot_config(get_config(), bot_token).get("rolling_summary", True): return
+        entry = (message.id, message.author.display_name, message.content)
+
+        ckey = ("channel", bot_token, message.channel.id)
+        batch = self.pending.setdefault(ckey, [])
+        batch.append(entry)
+        if len(batch) >= CHANNEL_BATCH: self._spawn(ckey, self._fold_channel(ckey))
+
+        # 长期记忆只为已有存档的玩家整理，普通群成员不会因此被建档
+        if peek_player_data(message.author.id, bot_token) is None: return
+        ukey = ("user", bot_token, str(message.author.id))
+        batch = self.user_pending.setdefault(ukey, [])
+        batch.append(entry)
+        self.user_pending.move_to_end(ukey)
+        while len(self.user_pending) > MAX_PENDING_USERS:
+            dropped, _ = self.user_pending.popitem(last=False)
+            self.retry_at.pop(dropped, None)
+        if len(batch) >= USER_BATCH: self._spawn(ukey, self._fold_user(ukey))
+
+    def _spawn(self, key, coro):
+        # 同一个频道/用户同时只跑一个折叠任务，期间的新消息留给下一批；刚失败过的等一会再试
+        if key in self.running or asyncio.get_running_loop().time() < self.retry_at.get(key, 0):
+            coro.close()
+            return
+        self.running.add(key)
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        def done(t):
+            self.tasks.discard(t)
+            self.running.discard(key)
+        task.add_done_callback(done)
+
+    def _requeue(self, queue, key, batch, size):
+        """折叠失败：这批消息放回队首，与之后的新消息一起重试 (只保留最新的若干批)"""
+        queue[key] = (batch + queue.get(key, []))[-size * MAX_REQUEUE_BATCHES:]
+        self.retry_at[key] = asyncio.get_running_loop().time() + FOLD_RETRY_DELAY
+
+    async def _fold(self, bot_token, previous, batch, instruction, max_tokens):
+        text, _ = build_context([(name, content) for _, name, content in batch], FOLD_INPUT_BUDGET)
+        prompt = (
+            f"【已有内容】:\n{previous or '（无）'}\n\n"
+            f"【新消息】:\n{text}\n\n"
+            f"{instruction}"
+        )
+        reply = await ask_ai(prompt, bot_token, system_override=SUMMARIZER_PROMPT, priority=PRIORITY_BACKGROUND)
+        if is_error_reply(reply):
+            self.failures += 1
+            return None
+        self.folds += 1
+        return truncate_to_tokens(reply.strip(), max_tokens)
+
+    async def _fold_channel(self, key):
+        _, bot_token, channel_id = key
+        batch = self.pending.pop(key, [])
+        if not batch: return
+        state = await self.channel_state(bot_token, channel_id)
+        summary = await self._fold(
+            bot_token, state["summary"], batch,
+            "请把新消息合并进已有的频道摘要，保留重要事件、话题走向和各成员的关键发言，输出不超过 300 字的新摘要。",
+            SUMMARY_MAX_TOKENS
+        )
+        if summary is None: return self._requeue(self.pending, key, batch, CHANNEL_BATCH)
+        self.retry_at.pop(key, None)
+        state["summary"], state["last_id"] = summary, batch[-1][0]
+        token_hash = get_token_hash(bot_token)
+        await run_io(player_store.put_summary, token_hash, channel_id, summary, state["last_id"], bot=token_hash)
+
+    async def _fold_user(self, key):
+        _, bot_token, uid = key
+        batch = self.user_pending.pop(key, [])
+        if not batch: return
+        record = peek_player_data(uid, bot_token)
+        if record is None: return
+        previous = record.memory
+        memory = await self._fold(
+            bot_token, previous, batch,
+            f"以上是用户「{batch[-1][1]}」的发言。请更新关于这位用户的长期记忆：喜好、经历、约定、称呼习惯等，输出不超过 150 字。",
+            MEMORY_MAX_TOKENS
+        )
+        if memory is None: return self._requeue(self.user_pending, key, batch, USER_BATCH)
+        self.retry_at.pop(key, None)
+        # 折叠期间存档可能已被后台删除，此时不再重新建档
+        if peek_player_data(uid, bot_token) is None: return
+        def apply(data): data.memory = memory
+        await mutate_player(uid, bot_token, apply)
+
+    def stats(self):
+        return {
+            "channels": len(self.summaries),
+            "pending": sum(map(len, self.pending.values())),
+            "pending_users": len(self.user_pending),
+            "running": len(self.running),
+            "folds": self.folds,
+            "failures": self.failures,
+        }
+
+rolling_memory = RollingMemory()
@@ -0,0 +1,137 @@
+# modules/metrics.py
+# 进程内的 Prometheus 指标：计数器/仪表/直方图 + 抓取时执行的采集回调，/metrics 以文本格式导出
+from bisect import bisect_left
+
+# 延迟直方图的默认分桶 (秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 写入大小直方图的分桶 (字节)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+_metrics = {}
+_collectors = []
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, help_text, labels):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def clear(self):
+        self.values.clear()
+
+    def export(self):
+        # 指标只在事件循环里修改；这里仍先拷一份再遍历，采集回调里新增的标签也不会打断导出
+        return {"type": self.kind, "help": self.help, "labels": list(self.labels), "samples": [[list(k), list(v) if isinstance(v, list) else v] for k, v in list(self.values.items())]}
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        key = tuple(map(str, labels))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set_total(self, value, *labels):
+        """采集回调用：同步由业务对象自己累计的计数 (例如调度器的拒绝次数)"""
+        self.values[tuple(map(str, labels))] = value
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels, merge="sum"):
+        super().__init__(name, help_text, labels)
+        # 多进程汇总方式：队列深度等按进程相加 (sum)；文件大小这类共享资源取最大值 (max)
+        self.merge = merge
+
+    def export(self):
+        return dict(super().export(), merge=self.merge)
+
+    def set(self, value, *labels):
+        self.values[tuple(map(str, labels))] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """values[key] = [各分桶计数 (非累计)..., +Inf 计数, 总和, 次数]"""
+        key = tuple(map(str, labels))
+        row = self.values.get(key)
+        if row is None: row = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        row[bisect_left(self.buckets, value)] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def export(self):
+        return dict(super().export(), buckets=list(self.buckets))
+
+def _register(cls, name, help_text, labels, **kw):
+    metric = _metrics.get(name)
+    if metric is None: metric = _metrics[name] = cls(name, help_text, labels, **kw)
+    return metric
+
+def counter(name, help_text, labels=()): return _register(Counter, name, help_text, labels)
+def gauge(name, help_text, labels=(), merge="sum"): return _register(Gauge, name, help_text, labels, merge=merge)
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS): return _register(Histogram, name, help_text, labels, buckets=buckets)
+
+def add_collector(fn):
+    """抓取时调用 fn()，用来刷新队列深度、网关延迟这类“当前值”仪表"""
+    _collectors.append(fn)
+
+def snapshot():
+    """本进程全部指标的可 JSON 序列化快照 (多进程模式下经 IPC 汇总到主进程)"""
+    for fn in _collectors:
+        try: fn()
+        except Exception as e: print(f"Metrics collector {getattr(fn, '__name__', fn)} failed: {e}")
+    return {name: m.export() for name, m in _metrics.items()}
+
+def _merge(snapshots):
+    """同名指标合并；同一组标签在多个进程都有时相加，merge="max" 的仪表取最大值"""
+    merged = {}
+    for snap in snapshots:
+        for name, fam in snap.items():
+            out = merged.setdefault(name, dict(fam, samples={}))
+            for labels, value in fam["samples"]:
+                key = tuple(labels)
+                old = out["samples"].get(key)
+                if old is None: out["samples"][key] = value
+                elif isinstance(value, list): out["samples"][key] = [a + b for a, b in zip(old, value)]
+                elif fam.get("merge") == "max": out["samples"][key] = max(old, value)
+                else: out["samples"][key] = old + value
+    return merged
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}" if pairs else ""
+
+def _num(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+def render(snapshots):
+    """多个快照 → Prometheus 文本格式 (0.0.4)"""
+    lines = []
+    for name, fam in sorted(_merge(snapshots).items()):
+        if not fam["samples"]: continue
+        lines.append(f"# HELP {name} {fam['help']}")
+        lines.append(f"# TYPE {name} {fam['type']}")
+        names = fam["labels"]
+        for key, value in sorted(fam["samples"].items()):
+            if fam["type"] != "histogram":
+                lines.append(f"{name}{_labels(names, key)} {_num(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(fam["buckets"] + ["+Inf"], value[:-2]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _num(float(bound))
+                lines.append(f"{name}_bucket{_labels(names, key, [('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(names, key)} {_num(float(value[-2]))}")
+            lines.append(f"{name}_count{_labels(names, key)} {value[-1]}")
+    return "\n".join(lines) + "\n"
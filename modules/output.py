@@ -0,0 +1,133 @@
+# modules/output.py
+import asyncio
+from collections import OrderedDict
+import discord
+
+# Discord 编辑消息的限额按频道计 (约 5 次 / 5 秒)
+BUCKET_RATE, BUCKET_PER = 5, 5.0
+# 一次编辑耗时超过这个秒数，说明 discord.py 在内部等 429 退避，放慢该频道
+SLOW_EDIT = 1.0
+MAX_PENALTY = 8.0
+# 频道数超过这个值时，清理早已空闲 (令牌回满、没有退避) 的桶
+SWEEP_AT = 256
+
+class _Bucket:
+    """一个频道的令牌桶：待发送的编辑按消息合并，同一条消息只保留最新内容"""
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = asyncio.get_running_loop().time()
+        # 退避倍数：被限流时翻倍，顺利发送后逐步回落到 1
+        self.penalty = 1.0
+        self.pending = OrderedDict()
+        self.task = None
+
+    def interval(self):
+        return self.per / self.capacity * self.penalty
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) / self.interval())
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.interval())
+
+class OutputScheduler:
+    """
+    每个 Bot 一个消息编辑调度器：按频道限流，不让 discord.py 撞上 429 后整体退避。
+    edit() 立即返回一个 Future；同一条消息还没发出去的旧内容直接被新内容覆盖，
+    只发送最新的 Embed，等待者在 (包含其内容的) 那次编辑完成后一起返回 True/False。
+    """
+    def __init__(self, rate=BUCKET_RATE, per=BUCKET_PER):
+        self.rate, self.per = rate, per
+        self.buckets = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.throttled = 0
+        self.failed = 0
+
+    def _bucket(self, channel_id):
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            if len(self.buckets) >= SWEEP_AT: self._sweep()
+            bucket = self.buckets[channel_id] = _Bucket(self.rate, self.per)
+        return bucket
+
+    def _sweep(self):
+        now = asyncio.get_running_loop().time()
+        for channel_id, b in list(self.buckets.items()):
+            if b.task is None and now - b.updated > b.per * MAX_PENALTY: del self.buckets[channel_id]
+
+    def interval(self, channel_id):
+        """该频道当前的编辑间隔 (秒)，调用方可以据此放慢展示节奏"""
+        bucket = self.buckets.get(channel_id)
+        return bucket.interval() if bucket else self.per / self.rate
+
+    def edit(self, message, **kwargs):
+        bucket = self._bucket(message.channel.id)
+        fut = asyncio.get_running_loop().create_future()
+        entry = bucket.pending.get(message.id)
+        if entry is not None:
+            entry[1] = kwargs
+            entry[2].append(fut)
+            self.coalesced += 1
+        else:
+            bucket.pending[message.id] = [message, kwargs, [fut]]
+        if bucket.task is None: bucket.task = asyncio.create_task(self._drain(message.channel.id, bucket))
+        return fut
+
+    async def _drain(self, channel_id, bucket):
+        loop = asyncio.get_running_loop()
+        waiters = []
+        try:
+            while bucket.pending:
+                await bucket.acquire()
+                if not bucket.pending: break
+                message_id, (message, kwargs, waiters) = bucket.pending.popitem(last=False)
+                start = loop.time()
+                ok, limited = True, False
+                try:
+                    await message.edit(**kwargs)
+                    self.sent += 1
+                except discord.NotFound:
+                    # 消息已被删除，之后的编辑也不必再发
+                    ok = False
+                except discord.HTTPException as e:
+                    ok, limited = False, e.status == 429
+                    print(f"Message edit failed in channel {channel_id}: {e}")
+                except Exception as e:
+                    ok = False
+                    print(f"Message edit failed in channel {channel_id}: {e}")
+                if limited or loop.time() - start > SLOW_EDIT:
+                    bucket.penalty = min(MAX_PENALTY, bucket.penalty * 2)
+                    self.throttled += 1
+                else:
+                    bucket.penalty = max(1.0, bucket.penalty * 0.8)
+                if not ok: self.failed += 1
+                for fut in waiters:
+                    if not fut.done(): fut.set_result(ok)
+        finally:
+            bucket.task = None
+            # 被取消 (Bot 关闭) 时，正在发送和还没发出的编辑都作废
+            for fut in waiters + [f for entry in bucket.pending.values() for f in entry[2]]:
+                if not fut.done(): fut.set_result(False)
+            bucket.pending.clear()
+
+    def close(self):
+        for bucket in list(self.buckets.values()):
+            if bucket.task: bucket.task.cancel()
+
+    def stats(self):
+        return {
+            "channels": len(self.buckets),
+            "pending": sum(len(b.pending) for b in self.buckets.values()),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "throttled": self.throttled,
+            "failed": self.failed,
+        }
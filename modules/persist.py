@@ -0,0 +1,92 @@
+# modules/persist.py
+import os
+import json
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import histogram, gauge, add_collector, SIZE_BUCKETS
+
+# 装了 orjson 就用它序列化 (快数倍，输出同样是紧凑的 UTF-8 JSON)
+try:
+    import orjson
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    loads = json.loads
+
+# 所有落盘操作共用一个专用线程：写入天然串行，不阻塞事件循环
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persist")
+
+IO_SECONDS = histogram("persist_io_duration_seconds", "持久化线程上单次阻塞操作的耗时 (按函数名；属于某个 Bot 的操作带 bot)", ("op", "bot"))
+WRITE_BYTES = histogram("persist_write_bytes", "单次写入的大小 (文件整体写入，或 players.db 里每个 Bot 一次落盘的存档)", ("file", "bot"), SIZE_BUCKETS)
+WRITE_PENDING = gauge("persist_write_queue_depth", "等待落盘的文件写入数")
+
+def _timed(elapsed, fn, *args):
+    # 线程里只计时，不碰指标：直方图只在事件循环里修改，/metrics 遍历时不会被并发改动
+    start = time.perf_counter()
+    try: return fn(*args)
+    finally: elapsed.append(time.perf_counter() - start)
+
+async def run_io(fn, *args, bot=""):
+    """在持久化线程里执行阻塞的序列化/文件/数据库操作；bot 为该操作所属 Bot 的 token hash (指标标签)"""
+    elapsed = []
+    try: return await asyncio.get_running_loop().run_in_executor(_executor, _timed, elapsed, fn, *args)
+    finally:
+        # 等待被取消时线程可能还没跑完，没有耗时就不记
+        if elapsed: IO_SECONDS.observe(elapsed[0], fn.__name__, bot)
+
+def write_atomic(path, payload):
+    """先写临时文件再原子替换，写到一半崩溃也不会留下半个文件"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+class FileWriter:
+    """
+    异步文件写入：同一路径上并发的多次保存合并成一次——
+    正在写的时候新来的内容只保留最后一份，写完后再落盘一次，所有等待者一起返回。
+    """
+    def __init__(self):
+        self.pending = {}
+        self.running = set()
+        self.writes = 0
+        self.coalesced = 0
+
+    async def write(self, path, payload):
+        entry = self.pending.get(path)
+        if entry is not None:
+            entry[0] = payload
+            self.coalesced += 1
+        else:
+            entry = self.pending[path] = [payload, asyncio.get_running_loop().create_future()]
+            if path not in self.running: asyncio.create_task(self._drain(path))
+        await asyncio.shield(entry[1])
+
+    async def _drain(self, path):
+        self.running.add(path)
+        try:
+            while path in self.pending:
+                payload, fut = self.pending.pop(path)
+                WRITE_BYTES.observe(len(payload), os.path.basename(path), "")
+                try:
+                    await run_io(write_atomic, path, payload)
+                    self.writes += 1
+                    fut.set_result(None)
+                except Exception as e:
+                    fut.set_exception(e)
+        finally:
+            self.running.discard(path)
+
+    def busy(self, path):
+        return path in self.pending or path in self.running
+
+file_writer = FileWriter()
+
+def _collect():
+    WRITE_PENDING.set(len(file_writer.pending) + len(file_writer.running))
+
+add_collector(_collect)
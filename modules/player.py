@@ -0,0 +1,90 @@
+# modules/player.py
+# 玩家存档模型：带 __slots__ 的紧凑记录，存储层用按位置编码的数组，旧版 dict 存档统一经 from_legacy 迁移
+import sys
+
+# 存储格式版本：[SCHEMA_VERSION, card, favorability, gold, wins, memory, lv, hp, atk, def, weapon, armor, extra]
+# 1 = 旧版嵌套 dict (含未按 Bot 隔离、直接在顶层放 gold 的 user_data.json 格式)
+SCHEMA_VERSION = 2
+NO_ITEM = "无"
+
+class Stats:
+    __slots__ = ("lv", "hp", "atk", "defense")
+
+    def __init__(self, lv=1, hp=100, atk=10, defense=0):
+        self.lv, self.hp, self.atk, self.defense = lv, hp, atk, defense
+
+    def __repr__(self):
+        return f"Stats(lv={self.lv}, hp={self.hp}, atk={self.atk}, def={self.defense})"
+
+class Equipment:
+    __slots__ = ("weapon", "armor")
+
+    def __init__(self, weapon=NO_ITEM, armor=NO_ITEM):
+        # 装备名只有寥寥几种，驻留后所有存档共享同一个字符串对象
+        self.weapon, self.armor = sys.intern(weapon), sys.intern(armor)
+
+    def __str__(self):
+        return f"武器 {self.weapon} / 防具 {self.armor}"
+
+class PlayerRecord:
+    """
+    某个玩家在某个 Bot 下的存档。
+    extra 保存旧档里本模型不认识的字段 (没有时为 None)，写回时原样带上，不丢数据。
+    """
+    __slots__ = ("card", "favorability", "gold", "wins", "memory", "stats", "equip", "extra")
+
+    def __init__(self, card="", favorability=0, gold=0, wins=0, memory="", stats=None, equip=None, extra=None):
+        self.card = card
+        self.favorability = favorability
+        self.gold = gold
+        self.wins = wins
+        self.memory = memory
+        self.stats = stats or Stats()
+        self.equip = equip or Equipment()
+        self.extra = extra
+
+    def __repr__(self):
+        return f"PlayerRecord(gold={self.gold}, favorability={self.favorability}, wins={self.wins}, {self.stats!r}, equip={self.equip})"
+
+    def reset_progress(self):
+        """生死决斗落败：金币、好感、属性、装备与胜场清零，名片与长期记忆保留"""
+        self.favorability = self.gold = self.wins = 0
+        self.stats = Stats()
+        self.equip = Equipment()
+
+    def encode(self):
+        """→ 可直接 JSON 序列化的扁平数组 (比嵌套 dict 小，解码也只是按位置取值)"""
+        s, e = self.stats, self.equip
+        row = [SCHEMA_VERSION, self.card, self.favorability, self.gold, self.wins, self.memory,
+               s.lv, s.hp, s.atk, s.defense, e.weapon, e.armor]
+        if self.extra: row.append(self.extra)
+        return row
+
+    @classmethod
+    def decode(cls, raw):
+        """存储层读出的 JSON 值 → PlayerRecord；旧版 dict 走 from_legacy"""
+        if isinstance(raw, dict): return cls.from_legacy(raw)
+        if not raw or raw[0] != SCHEMA_VERSION: raise ValueError(f"unsupported player schema: {raw[:1]}")
+        _, card, fav, gold, wins, memory, lv, hp, atk, defense, weapon, armor, *rest = raw
+        return cls(card, fav, gold, wins, memory, Stats(lv, hp, atk, defense), Equipment(weapon, armor), rest[0] if rest else None)
+
+    @classmethod
+    def from_legacy(cls, data):
+        """
+        唯一的旧档迁移入口 (schema 1)：嵌套 dict，字段可能缺失 (早期存档没有 def/equip/wins 等)。
+        未按 Bot 隔离的旧 user_data.json 也是同样的结构，只是挂在占位 hash 下，由 get_player_data 认领。
+        """
+        data = dict(data)
+        rpg = data.pop("rpg", None) or {}
+        equip = data.pop("equip", None) or {}
+        record = cls(
+            card=data.pop("card", "") or "",
+            favorability=data.pop("favorability", 0),
+            gold=data.pop("gold", 0),
+            wins=data.pop("wins", 0),
+            memory=data.pop("memory", "") or "",
+            stats=Stats(rpg.get("lv", 1), rpg.get("hp", 100), rpg.get("atk", 10), rpg.get("def", 0)),
+            equip=Equipment(equip.get("weapon", NO_ITEM), equip.get("armor", NO_ITEM)),
+        )
+        record.extra = data or None
+        return record
@@ -0,0 +1,84 @@
+# modules/prompts.py
+from .config import get_config_version, subscribe
+from .game_data import get_favorability_stage
+
+# (bot_token, 配置版本, 好感度阶段 ID, action_type, pure_reply) -> 预渲染的 system prompt 模板
+_template_cache = {}
+
+def _on_config_change(config, version):
+    # 配置内容变化 (后台保存或外部修改文件) 后整体作废
+    _template_cache.clear()
+
+subscribe(_on_config_change)
+
+def _escape(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+def _build_template(bot_conf, fav_stage, action_type, pure_reply):
+    """拼出与用户无关的部分；用户相关字段留作 {占位符}，其余文本全部转义"""
+    # 1. 基础人设 (知识库按消息检索，留作占位符)
+    prompts = bot_conf.get("system_prompts", ["You are a helpful assistant."])
+    base_prompt = "\n\n".join(p for p in prompts if p.strip())
+
+    template = _escape(f"{base_prompt}\n\n【已有知识库】:\n") + "{knowledge}"
+
+    if fav_stage is not None:
+        # 2. 构建动态人设指令
+        template += (
+            "\n\n=== 交互对象档案 ===\n"
+            "用户名称: {user_name}\n"
+            "用户人设: {card}\n"
+            "用户装备: 武器<{weapon}> / 防具<{armor}>\n"
+            "--------------------\n"
+            "【当前好感度】: {current_fav} / 500\n"
+            + _escape(
+                f"【关系状态】: {fav_stage['title']} ({fav_stage['desc']})\n"
+                f"【核心扮演指令】 (必须严格执行): \n"
+                f">>> {fav_stage['prompt']} <<<\n"
+                f"--------------------"
+            )
+        )
+
+        # 3. 特殊行为的额外指令 (例如送礼)
+        if action_type == 'gift_receive':
+            template += _escape(
+                "\n\n【当前事件：收到礼物】\n"
+                "用户刚刚送了你一份礼物。请结合你的性格和当前好感度做出反应。\n"
+                "- 如果好感度低：可能会觉得是贿赂、不屑一顾，或者勉强收下，甚至言语带刺。\n"
+                "- 如果好感度高：会非常开心、惊喜，甚至想要回礼，语气温柔。\n"
+                "- 请不要只是说“谢谢”，要表现出符合当前关系阶段的心理活动。"
+            )
+
+    if not pure_reply:
+        template += _escape(
+            "\n\n【好感度系统】\n"
+            "根据用户的对话内容，判断好感度变化：\n"
+            "- 冒犯/无聊/重复/作死 -> [FAVORABILITY:-1] 到 -20\n"
+            "- 夸奖/有趣/关心/配合 -> [FAVORABILITY:+1] 到 +20\n"
+            "请将标签放在回复末尾（不要让用户看到），例如：......哼，这次就原谅你了。[FAVORABILITY:+5]"
+        )
+    return template
+
+def render_system_prompt(bot_conf, bot_token, user_info=None, user_name=None, current_fav=0, action_type=None, pure_reply=False, knowledge=()):
+    """
+    生成 system prompt：模板按 (Bot, 配置版本, 好感度阶段 ID, action_type, pure_reply) 缓存，
+    每次只需填入检索到的知识条目、用户名、名片、装备与好感度。user_info 为 None 时不附带交互对象档案。
+    """
+    version = get_config_version()
+    fav_stage = get_favorability_stage(current_fav, bot_token) if user_info is not None else None
+    stage_id = fav_stage["id"] if fav_stage is not None else None
+    key = (bot_token, version, stage_id, action_type if stage_id is not None else None, bool(pure_reply))
+    template = _template_cache.get(key)
+    if template is None:
+        template = _template_cache[key] = _build_template(bot_conf, fav_stage, action_type, pure_reply)
+
+    knowledge = "\n".join(knowledge)
+    if user_info is None: return template.format(knowledge=knowledge)
+    return template.format(
+        knowledge=knowledge,
+        user_name=user_name,
+        card=user_info.card,
+        weapon=user_info.equip.weapon,
+        armor=user_info.equip.armor,
+        current_fav=current_fav,
+    )
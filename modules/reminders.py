@@ -0,0 +1,91 @@
+# modules/reminders.py
+import time
+import asyncio
+from .config import get_token_hash
+from .storage import player_store
+from .persist import run_io
+
+# 每次从数据库取出的到期提醒条数
+DUE_BATCH = 100
+# 每个用户最多同时挂着的提醒数
+MAX_PER_USER = 25
+# 兜底的最长休眠 (秒)，防止系统时间跳变后睡过头
+MAX_SLEEP = 3600
+
+def parse_duration(time_str):
+    """'30s' / '10m' / '2h' / '1d' → 秒数，格式不对返回 None"""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    time_str = (time_str or "").strip().lower()
+    if len(time_str) < 2 or time_str[-1] not in units: return None
+    try: val = int(time_str[:-1])
+    except ValueError: return None
+    return val * units[time_str[-1]] if val > 0 else None
+
+class ReminderScheduler:
+    """
+    每个 Bot 一个提醒调度器：提醒持久化在 SQLite (按到期时间建索引)，
+    只用一个定时器睡到最早的到期时间，新提醒更早时唤醒重新计算。
+    重启后第一轮会把停机期间错过的提醒一次性补发。
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.token_hash = get_token_hash(bot.token_key)
+        self.wakeup = asyncio.Event()
+        self.next_due = None
+        self.task = None
+        self.delivered = 0
+
+    def start(self):
+        if self.task is None: self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task: self.task.cancel()
+        self.task = None
+
+    async def add(self, user_id, channel_id, seconds, matter):
+        """返回 (提醒编号, 到期时间戳)；超过单人上限返回 None"""
+        if len(await self.list(user_id)) >= MAX_PER_USER: return None
+        now = time.time()
+        due = now + seconds
+        reminder_id = await run_io(player_store.add_reminder, self.token_hash, user_id, channel_id, due, matter, now, bot=self.token_hash)
+        if self.next_due is None or due < self.next_due: self.wakeup.set()
+        return reminder_id, due
+
+    async def list(self, user_id):
+        return await run_io(player_store.list_reminders, self.token_hash, user_id, bot=self.token_hash)
+
+    async def cancel(self, user_id, reminder_id):
+        ok = await run_io(player_store.delete_reminder, self.token_hash, user_id, reminder_id, bot=self.token_hash)
+        if ok: self.wakeup.set()
+        return ok
+
+    async def _deliver(self, reminder, now):
+        reminder_id, user_id, channel_id, due, matter = reminder
+        late = now - due
+        text = f"🔔 提醒: {matter}"
+        if late > 60: text += f"\n*(Bot 离线期间错过，迟到约 {int(late // 60)} 分钟)*"
+        try:
+            user = self.bot.get_user(int(user_id)) or await self.bot.fetch_user(int(user_id))
+            await user.send(text)
+        except Exception:
+            # 私信被关闭时退回到设置提醒的频道
+            channel = self.bot.get_channel(channel_id) if channel_id else None
+            try:
+                if channel: await channel.send(f"<@{user_id}> {text}")
+            except Exception as e: print(f"Reminder {reminder_id} delivery failed: {e}")
+        self.delivered += 1
+
+    async def _run(self):
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            self.wakeup.clear()
+            now = time.time()
+            due = await run_io(player_store.due_reminders, self.token_hash, now, DUE_BATCH, bot=self.token_hash)
+            if due:
+                await asyncio.gather(*(self._deliver(r, now) for r in due))
+                await run_io(player_store.delete_reminders, [r[0] for r in due], bot=self.token_hash)
+                if len(due) == DUE_BATCH: continue
+            self.next_due = await run_io(player_store.next_reminder_due, self.token_hash, bot=self.token_hash)
+            timeout = MAX_SLEEP if self.next_due is None else min(MAX_SLEEP, max(0, self.next_due - time.time()))
+            try: await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError: pass
@@ -0,0 +1,120 @@
+# modules/response_cache.py
+import sys
+import json
+import time
+import asyncio
+import hashlib
+from collections import OrderedDict
+from .metrics import gauge, counter, add_collector
+
+# 默认容量：条目数与估算内存 (字节) 两个上限，先到先淘汰
+MAX_ENTRIES = 512
+MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_TTL = 600
+
+def request_key(models, payload):
+    """按 (模型, 温度, system prompt, 用户消息) 生成缓存 Key"""
+    raw = json.dumps([models, payload.get("temperature"), payload.get("messages")], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    确定性 ask_ai 调用的 LRU/TTL 响应缓存，附带 single-flight：
+    相同 Key 的请求正在进行时，后来者直接等待同一个结果，不再重复调用 API。
+    只缓存调用方认为成功的结果 (should_store)。
+    """
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def _size(self, key, value):
+        return sys.getsizeof(key) + sys.getsizeof(value)
+
+    def _drop(self, key):
+        _, _, size = self.entries.pop(key)
+        self.bytes -= size
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None: return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value, ttl=DEFAULT_TTL):
+        if key in self.entries: self._drop(key)
+        size = self._size(key, value)
+        if size > self.max_bytes: return
+        self.entries[key] = (time.monotonic() + ttl, value, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    async def get_or_compute(self, key, factory, ttl=DEFAULT_TTL, should_store=None):
+        """命中缓存直接返回；否则合并到进行中的同 Key 请求，或调用 factory() 计算"""
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        fut = self.inflight.get(key)
+        if fut is not None: self.coalesced += 1
+        while fut is not None:
+            try: return await asyncio.shield(fut)
+            except asyncio.CancelledError:
+                # 自己被取消时照常抛出；只是领头的请求被取消时，不跟着失败，
+                # 重新看一眼：已有新的领头请求就继续等它，否则自己来算
+                if not fut.cancelled(): raise
+                fut = self.inflight.get(key)
+        self.misses += 1
+        fut = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await factory()
+        except asyncio.CancelledError:
+            # 等待者看到 fut.cancelled() 会接替重试，而不是把这次取消当成自己的
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            fut.exception()
+            raise
+        else:
+            fut.set_result(value)
+            if should_store is None or should_store(value): self.put(key, value, ttl)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hit_rate": round((self.hits + self.coalesced) / lookups, 3) if lookups else 0.0,
+        }
+
+response_cache = ResponseCache()
+
+CACHE_LOOKUPS = counter("response_cache_lookups_total", "LLM 回复缓存的查询结果", ("result",))
+CACHE_BYTES = gauge("response_cache_bytes", "LLM 回复缓存的估算内存占用")
+
+def _collect():
+    for result in ("hits", "misses", "coalesced"): CACHE_LOOKUPS.set_total(getattr(response_cache, result), result)
+    CACHE_BYTES.set(response_cache.bytes)
+
+add_collector(_collect)
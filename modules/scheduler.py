@@ -0,0 +1,156 @@
+# modules/scheduler.py
+import time
+import heapq
+import asyncio
+import contextlib
+from .config import default_config
+from .metrics import gauge, counter, add_collector
+
+# 优先级：数字越小越先执行
+PRIORITY_CHAT = 0         # 直接的聊天回复
+PRIORITY_INTERACTIVE = 1  # 玩家主动触发的指令 (探索、商店、总结……)
+PRIORITY_BACKGROUND = 2   # 装饰性内容 (决斗解说、名片点评、后台摘要)
+
+PRIORITY_NAMES = {PRIORITY_CHAT: "chat", PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+class SchedulerBusy(Exception):
+    """队列已满或排队超过截止时间，请求被丢弃"""
+
+class LLMScheduler:
+    """
+    出站 LLM 请求调度器：全局并发上限 + 每个端点的并发上限。
+    超出上限的请求按 (优先级, 先来后到) 排队；队列满时挤掉优先级最低的请求 (背压)，
+    排到时已经过了截止时间的请求直接丢弃，不再浪费额度。
+    """
+    def __init__(self):
+        self.settings = dict(default_config["llm_scheduler"])
+        self.active = 0
+        self.queue = []
+        self.seq = 0
+        self.endpoints = {}
+        self.endpoint_active = {}
+        self.granted = 0
+        self.expired = 0
+        self.rejected = 0
+        self.peak_queue = 0
+        self.wait_total = 0.0
+
+    def configure(self, settings=None):
+        """在 Quart before_serving 中调用，载入并发参数"""
+        if settings: self.settings.update(settings)
+
+    def _deadline(self, priority, timeout):
+        if timeout is None: timeout = self.settings["deadlines"][PRIORITY_NAMES[priority]]
+        return time.monotonic() + timeout
+
+    def _discard(self, entry):
+        self.queue.remove(entry)
+        heapq.heapify(self.queue)
+
+    def _grant_next(self):
+        now = time.monotonic()
+        while self.queue and self.active < self.settings["max_concurrency"]:
+            _, _, deadline, fut = heapq.heappop(self.queue)
+            if fut.done(): continue
+            if now > deadline:
+                self.expired += 1
+                fut.set_exception(SchedulerBusy("expired"))
+                continue
+            self.active += 1
+            fut.set_result(None)
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE, timeout=None):
+        deadline = self._deadline(priority, timeout)
+        if self.active < self.settings["max_concurrency"] and not self.queue:
+            self.active += 1
+            self.granted += 1
+            return
+        if len(self.queue) >= self.settings["max_queue"]:
+            # 背压：队列满时挤掉优先级最低、最晚加入的等待者；自己就是最低的则直接拒绝
+            worst = max(self.queue, key=lambda e: (e[0], e[1]))
+            self.rejected += 1
+            if worst[0] <= priority: raise SchedulerBusy("queue full")
+            self._discard(worst)
+            worst[3].set_exception(SchedulerBusy("queue full"))
+        fut = asyncio.get_running_loop().create_future()
+        self.seq += 1
+        entry = (priority, self.seq, deadline, fut)
+        heapq.heappush(self.queue, entry)
+        self.peak_queue = max(self.peak_queue, len(self.queue))
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), max(0.0, deadline - start))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                # 超时/取消的同时刚好轮到：名额已经分配给我们
+                if isinstance(e, asyncio.CancelledError):
+                    self.release()
+                    raise
+            else:
+                fut.cancel()
+                if entry in self.queue: self._discard(entry)
+                if isinstance(e, asyncio.CancelledError): raise
+                self.expired += 1
+                raise SchedulerBusy("expired")
+        self.granted += 1
+        self.wait_total += time.monotonic() - start
+
+    def release(self):
+        self.active -= 1
+        self._grant_next()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=PRIORITY_INTERACTIVE, timeout=None):
+        """全局并发名额；排队失败抛出 SchedulerBusy"""
+        await self.acquire(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @contextlib.asynccontextmanager
+    async def endpoint(self, url):
+        """单个 API 端点的并发上限，在每次实际发出请求时获取"""
+        sem = self.endpoints.get(url)
+        if sem is None:
+            sem = self.endpoints[url] = asyncio.Semaphore(self.settings["per_endpoint"])
+        async with sem:
+            self.endpoint_active[url] = self.endpoint_active.get(url, 0) + 1
+            try:
+                yield
+            finally:
+                self.endpoint_active[url] -= 1
+
+    def stats(self):
+        depth = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _, fut in self.queue:
+            if not fut.done(): depth[PRIORITY_NAMES[priority]] += 1
+        return {
+            "active": self.active,
+            "max_concurrency": self.settings["max_concurrency"],
+            "queued": sum(depth.values()),
+            "queue_depth": depth,
+            "peak_queue": self.peak_queue,
+            "granted": self.granted,
+            "expired": self.expired,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.wait_total / self.granted * 1000) if self.granted else 0,
+            "endpoints": {url: {"active": n, "limit": self.settings["per_endpoint"]} for url, n in self.endpoint_active.items()},
+        }
+
+llm_scheduler = LLMScheduler()
+
+QUEUE_DEPTH = gauge("llm_queue_depth", "排队等待 LLM 并发名额的请求数", ("priority",))
+ACTIVE = gauge("llm_active_requests", "正在占用并发名额的 LLM 请求数")
+ENDPOINT_ACTIVE = gauge("llm_endpoint_active_requests", "各端点正在进行的请求数", ("endpoint",))
+DROPPED = counter("llm_scheduler_dropped_total", "被调度器丢弃的请求 (排队超时 / 队列满)", ("reason",))
+
+def _collect():
+    stats = llm_scheduler.stats()
+    for name, depth in stats["queue_depth"].items(): QUEUE_DEPTH.set(depth, name)
+    ACTIVE.set(stats["active"])
+    for url, n in llm_scheduler.endpoint_active.items(): ENDPOINT_ACTIVE.set(n, url)
+    DROPPED.set_total(llm_scheduler.expired, "expired")
+    DROPPED.set_total(llm_scheduler.rejected, "rejected")
+
+add_collector(_collect)
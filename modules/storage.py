@@ -0,0 +1,486 @@
+# modules/storage.py
+import os
+import json
+import heapq
+import sqlite3
+import asyncio
+import inspect
+import threading
+import weakref
+from .config import DATA_DIR, CONFIG_FILE, USER_DATA_FILE, get_token_hash
+from .persist import dumps, loads, run_io, WRITE_BYTES
+from .metrics import gauge, add_collector
+from .player import PlayerRecord, SCHEMA_VERSION
+
+PLAYER_DB_FILE = os.path.join(DATA_DIR, "players.db")
+# 脏数据批量落盘的间隔 (秒)
+FLUSH_INTERVAL = float(os.environ.get('PLAYER_FLUSH_INTERVAL', 5))
+
+# 旧版 user_data.json 中没有按 Bot 隔离的存档，迁移时先挂在这个占位 hash 下，
+# 第一个访问该玩家的 Bot 会认领它（与原 get_player_data 的行为一致）
+LEGACY_HASH = "legacy"
+
+class PlayerStore:
+    """
+    玩家存档的 SQLite 后端 (WAL 模式)。
+    每个 (uid, token_hash) 一行，读写都是单行操作，不再整体序列化 user_data.json。
+    data 列存 PlayerRecord.encode() 的 JSON 数组；接口收发的都是 PlayerRecord。
+    """
+    def __init__(self, path=PLAYER_DB_FILE):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is not None: return self._conn
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS players ("
+            "uid TEXT NOT NULL, token_hash TEXT NOT NULL, data TEXT NOT NULL, "
+            "PRIMARY KEY (uid, token_hash)) WITHOUT ROWID"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # 每个 (Bot, 频道) 的滚动摘要，last_id 之前的消息都已折叠进 summary
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "token_hash TEXT NOT NULL, channel_id INTEGER NOT NULL, summary TEXT NOT NULL, last_id INTEGER NOT NULL, "
+            "PRIMARY KEY (token_hash, channel_id)) WITHOUT ROWID"
+        )
+        # 提醒：按 (Bot, 到期时间) 建索引，调度器只查最早的一条，插入/删除都是 O(log n)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS reminders ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, token_hash TEXT NOT NULL, user_id TEXT NOT NULL, "
+            "channel_id INTEGER, due REAL NOT NULL, matter TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS reminders_due ON reminders (token_hash, due)")
+        conn.execute("CREATE INDEX IF NOT EXISTS reminders_user ON reminders (token_hash, user_id)")
+        self._conn = conn
+        self._migrate_json(conn)
+        self._migrate_schema(conn)
+        return conn
+
+    def _migrate_json(self, conn):
+        """一次性把旧的 user_data.json 导入数据库，完成后改名保留备份"""
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone(): return
+        rows = []
+        if os.path.exists(USER_DATA_FILE):
+            try:
+                with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
+                    legacy = json.load(f)
+                if not isinstance(legacy, dict): raise ValueError(f"top level is {type(legacy).__name__}, expected object")
+            except (OSError, ValueError) as e:
+                # 不写 json_migrated：修好文件后下次启动还会再导入，不会悄悄丢掉这些存档
+                print(f"⚠️ Cannot migrate {USER_DATA_FILE}, skipping for now: {e}")
+                return
+            for uid, root in legacy.items():
+                if not isinstance(root, dict): continue
+                # 旧版结构：user_data[uid] 直接包含 gold/rpg 字段
+                if "gold" in root or "rpg" in root:
+                    rows.append((str(uid), LEGACY_HASH, self._encode(PlayerRecord.from_legacy(root))))
+                    continue
+                for token_hash, data in root.items():
+                    rows.append((str(uid), token_hash, self._encode(PlayerRecord.from_legacy(data))))
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR REPLACE INTO players (uid, token_hash, data) VALUES (?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (str(len(rows)),))
+        if rows:
+            os.replace(USER_DATA_FILE, USER_DATA_FILE + ".migrated")
+            print(f"📦 Migrated {len(rows)} player records from user_data.json")
+
+    def _migrate_schema(self, conn):
+        """存档格式升级：旧版本的行统一经 PlayerRecord.decode 转成当前编码，完成后记下版本号"""
+        row = conn.execute("SELECT value FROM meta WHERE key = 'player_schema'").fetchone()
+        if row and int(row[0]) >= SCHEMA_VERSION: return
+        rows = conn.execute("SELECT uid, token_hash, data FROM players").fetchall()
+        upgraded = [(self._encode(PlayerRecord.decode(loads(data))), uid, token_hash) for uid, token_hash, data in rows]
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("UPDATE players SET data = ? WHERE uid = ? AND token_hash = ?", upgraded)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('player_schema', ?)", (str(SCHEMA_VERSION),))
+        if upgraded: print(f"📦 Upgraded {len(upgraded)} player records to schema v{SCHEMA_VERSION}")
+
+    @staticmethod
+    def _encode(record):
+        return dumps(record.encode()).decode('utf-8')
+
+    def get(self, uid, token_hash):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT data FROM players WHERE uid = ? AND token_hash = ?", (str(uid), token_hash)
+            ).fetchone()
+        return PlayerRecord.decode(loads(row[0])) if row else None
+
+    def put(self, uid, token_hash, record):
+        payload = self._encode(record)
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO players (uid, token_hash, data) VALUES (?, ?, ?)",
+                (str(uid), token_hash, payload)
+            )
+
+    def delete(self, uid, token_hash):
+        with self._lock:
+            self._connect().execute("DELETE FROM players WHERE uid = ? AND token_hash = ?", (str(uid), token_hash))
+
+    def delete_user(self, uid):
+        """删除该玩家在所有 Bot 下的存档"""
+        with self._lock:
+            self._connect().execute("DELETE FROM players WHERE uid = ?", (str(uid),))
+
+    def load_all(self, token_hash=None):
+        """
+        一次性读出存档 {(uid, token_hash): PlayerRecord}：默认是全部 Bot 的，指定 token_hash 时只读该 Bot 的。
+        待认领的旧档 (LEGACY_HASH) 不在其中，见 legacy_uids / claim_legacy。
+        """
+        with self._lock:
+            conn = self._connect()
+            if token_hash is None:
+                rows = conn.execute("SELECT uid, token_hash, data FROM players WHERE token_hash != ?", (LEGACY_HASH,)).fetchall()
+            else:
+                rows = conn.execute("SELECT uid, token_hash, data FROM players WHERE token_hash = ?", (token_hash,)).fetchall()
+        return {(uid, h): PlayerRecord.decode(loads(data)) for uid, h, data in rows}
+
+    def legacy_uids(self):
+        with self._lock:
+            return {row[0] for row in self._connect().execute("SELECT uid FROM players WHERE token_hash = ?", (LEGACY_HASH,))}
+
+    def claim_legacy(self, uid, token_hash):
+        """
+        在一个事务里把旧档改挂到 token_hash 下并返回它；已被认领 (可能是别的工作进程) 时返回 None。
+        多个进程同时认领同一个玩家时，只有一个能删到那一行。
+        """
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                row = conn.execute("SELECT data FROM players WHERE uid = ? AND token_hash = ?", (uid, LEGACY_HASH)).fetchone()
+                if row is None: return None
+                conn.execute("DELETE FROM players WHERE uid = ? AND token_hash = ?", (uid, LEGACY_HASH))
+                conn.execute("INSERT OR IGNORE INTO players (uid, token_hash, data) VALUES (?, ?, ?)", (uid, token_hash, row[0]))
+        return PlayerRecord.decode(loads(row[0]))
+
+    def write_batch(self, upserts, deletes=()):
+        """
+        在一个事务内写入一批存档，要么全部成功要么全部回滚。
+        upserts 的值是事件循环里已经 encode() 好的数组 (快照)，这里只做 JSON 序列化与写库。
+        返回每个 Bot 写入的字节数 {token_hash: bytes}。
+        """
+        rows = [(uid, token_hash, dumps(row).decode('utf-8')) for (uid, token_hash), row in upserts.items()]
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute("BEGIN")
+                conn.executemany("INSERT OR REPLACE INTO players (uid, token_hash, data) VALUES (?, ?, ?)", rows)
+                conn.executemany("DELETE FROM players WHERE uid = ? AND token_hash = ?", list(deletes))
+        sizes = {}
+        for _, token_hash, data in rows: sizes[token_hash] = sizes.get(token_hash, 0) + len(data)
+        return sizes
+
+    def get_summary(self, token_hash, channel_id):
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT summary, last_id FROM summaries WHERE token_hash = ? AND channel_id = ?", (token_hash, channel_id)
+            ).fetchone()
+        return {"summary": row[0], "last_id": row[1]} if row else None
+
+    def put_summary(self, token_hash, channel_id, summary, last_id):
+        with self._lock:
+            self._connect().execute(
+                "INSERT OR REPLACE INTO summaries (token_hash, channel_id, summary, last_id) VALUES (?, ?, ?, ?)",
+                (token_hash, channel_id, summary, last_id)
+            )
+
+    def add_reminder(self, token_hash, user_id, channel_id, due, matter, created):
+        with self._lock:
+            cur = self._connect().execute(
+                "INSERT INTO reminders (token_hash, user_id, channel_id, due, matter, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (token_hash, str(user_id), channel_id, due, matter, created)
+            )
+        return cur.lastrowid
+
+    def due_reminders(self, token_hash, now, limit):
+        """已到期的提醒 (最早的优先)：[(id, user_id, channel_id, due, matter)]"""
+        with self._lock:
+            return self._connect().execute(
+                "SELECT id, user_id, channel_id, due, matter FROM reminders WHERE token_hash = ? AND due <= ? ORDER BY due LIMIT ?",
+                (token_hash, now, limit)
+            ).fetchall()
+
+    def next_reminder_due(self, token_hash):
+        with self._lock:
+            row = self._connect().execute("SELECT MIN(due) FROM reminders WHERE token_hash = ?", (token_hash,)).fetchone()
+        return row[0]
+
+    def list_reminders(self, token_hash, user_id):
+        with self._lock:
+            return self._connect().execute(
+                "SELECT id, due, matter FROM reminders WHERE token_hash = ? AND user_id = ? ORDER BY due",
+                (token_hash, str(user_id))
+            ).fetchall()
+
+    def delete_reminder(self, token_hash, user_id, reminder_id):
+        """只能删除自己的提醒，返回是否删除成功"""
+        with self._lock:
+            cur = self._connect().execute(
+                "DELETE FROM reminders WHERE id = ? AND token_hash = ? AND user_id = ?", (reminder_id, token_hash, str(user_id))
+            )
+        return cur.rowcount > 0
+
+    def delete_reminders(self, ids):
+        with self._lock:
+            self._connect().executemany("DELETE FROM reminders WHERE id = ?", [(i,) for i in ids])
+
+player_store = PlayerStore()
+
+# 后台玩家列表可用的排序字段
+SORT_KEYS = {
+    "gold": lambda p: p.gold,
+    "favorability": lambda p: p.favorability,
+    "hp": lambda p: p.stats.hp,
+    "lv": lambda p: p.stats.lv,
+}
+MAX_PAGE_SIZE = 200
+
+def player_summary(uid, record):
+    """后台列表里一行需要的字段 (名片截断，避免整份存档发给前端)"""
+    card = record.card
+    return {
+        "uid": uid,
+        "card": card[:80] + ("…" if len(card) > 80 else ""),
+        "favorability": record.favorability,
+        "gold": record.gold,
+        "lv": record.stats.lv,
+        "hp": record.stats.hp,
+        "weapon": record.equip.weapon,
+        "armor": record.equip.armor,
+    }
+
+class PlayerCache:
+    """
+    进程内的玩家存档缓存 (write-behind)。
+    读写都只碰内存；修改过的记录被标记为脏，由后台任务每 FLUSH_INTERVAL 秒合并成一次事务写入 PlayerStore。
+    单进程模式加载全部 Bot 的存档；工作进程里 (scoped) 只按需加载本进程负责的 Bot，见 attach()。
+    """
+    def __init__(self, store, flush_interval=FLUSH_INTERVAL):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.records = {}
+        # 按 Bot 分组的索引 {token_hash: {uid: PlayerRecord}}，与 records 共享同一批对象
+        self.by_bot = {}
+        self.dirty = set()
+        self.deleted = set()
+        self.loaded = False
+        # 尚未被认领的旧档 uid；旧档本身不进缓存，认领时直接在库里原子转移
+        self.legacy = set()
+        # None = 全部 Bot；scoped 模式下为 {token_hash: 加载任务}
+        self.scope = None
+        self._task = None
+        # 写入/删除时的回调 listener(token_hash, uid, data)，data 为 None 表示删除 (排行榜索引用)
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self, token_hash, uid, data):
+        for listener in self.listeners: listener(token_hash, uid, data)
+
+    def _index(self, records):
+        for key, data in records.items():
+            # 加载期间已经写入内存的记录以内存为准
+            if key in self.records: continue
+            self.records[key] = data
+            self.by_bot.setdefault(key[1], {})[key[0]] = data
+
+    def load(self):
+        """兜底：start() 之前就被访问时同步加载 (正常路径在 start() 里经持久化线程加载)"""
+        if self.loaded: return
+        self._index(self.store.load_all())
+        self.legacy = self.store.legacy_uids()
+        self.loaded = True
+
+    async def attach(self, token_hash):
+        """scoped 模式：某个 Bot 第一次在本进程用到时，只加载它自己的存档 (并发调用共享同一次加载)"""
+        if self.scope is None: return
+        task = self.scope.get(token_hash)
+        if task is None: task = self.scope[token_hash] = asyncio.ensure_future(self._load_bot(token_hash))
+        await task
+
+    async def _load_bot(self, token_hash):
+        try: records = await run_io(self.store.load_all, token_hash, bot=token_hash)
+        except Exception:
+            # 加载失败不缓存结果，下次 attach 重试
+            del self.scope[token_hash]
+            raise
+        self._index(records)
+
+    def claim_legacy(self, uid, token_hash):
+        """旧档只在第一次认领时查库 (一次性的单行事务)；没有旧档或已被别的进程认领时返回 None"""
+        self.load()
+        if uid not in self.legacy: return None
+        self.legacy.discard(uid)
+        return self.store.claim_legacy(uid, token_hash)
+
+    def get(self, uid, token_hash):
+        self.load()
+        return self.records.get((uid, token_hash))
+
+    def put(self, uid, token_hash, data):
+        self.load()
+        key = (uid, token_hash)
+        self.records[key] = data
+        self.by_bot.setdefault(token_hash, {})[uid] = data
+        self.deleted.discard(key)
+        self.dirty.add(key)
+        self._notify(token_hash, uid, data)
+
+    def delete(self, uid, token_hash):
+        self.load()
+        key = (uid, token_hash)
+        self.records.pop(key, None)
+        self.by_bot.get(token_hash, {}).pop(uid, None)
+        self.dirty.discard(key)
+        self.deleted.add(key)
+        self._notify(token_hash, uid, None)
+
+    async def delete_user(self, uid):
+        """
+        删除该玩家在所有 Bot 下的存档。内存里只有本进程加载的部分，
+        其余 (未加载的 Bot、未认领的旧档) 直接在库里删除。
+        """
+        for key in [k for k in self.records if k[0] == uid]:
+            self.delete(*key)
+        self.legacy.discard(uid)
+        await run_io(self.store.delete_user, uid)
+
+    def list_bot(self, token_hash):
+        self.load()
+        return list(self.by_bot.get(token_hash, {}).items())
+
+    def query_bot(self, token_hash, sort="gold", desc=True, q="", page=1, per_page=50):
+        """
+        后台分页查询：只扫描该 Bot 的索引，按 UID/名片搜索，
+        用堆只取到当前页为止的前 page*per_page 条，不对全部玩家排序。
+        """
+        self.load()
+        items = self.by_bot.get(token_hash, {}).items()
+        if q:
+            q = q.strip().lower()
+            items = [(uid, p) for uid, p in items if q in uid or q in p.card.lower()]
+        per_page = max(1, min(MAX_PAGE_SIZE, per_page))
+        total = len(items)
+        pages = max(1, -(-total // per_page))
+        page = max(1, min(page, pages))
+        field = SORT_KEYS.get(sort, SORT_KEYS["gold"])
+        pick = heapq.nlargest if desc else heapq.nsmallest
+        top = pick(page * per_page, items, key=lambda it: (field(it[1]), it[0]))[(page - 1) * per_page:]
+        return {"total": total, "page": page, "pages": pages, "per_page": per_page, "items": [player_summary(uid, d) for uid, d in top]}
+
+    async def flush(self):
+        """
+        把所有脏记录合并写入数据库；失败时保留脏标记，下次重试。
+        记录在事件循环里 encode 成快照 (不会拿到协程改了一半的对象)，JSON 序列化与写库在持久化线程。
+        """
+        if not self.dirty and not self.deleted: return 0
+        dirty, deleted = self.dirty, self.deleted
+        self.dirty, self.deleted = set(), set()
+        upserts = {k: self.records[k].encode() for k in dirty if k in self.records}
+        try:
+            sizes = await run_io(self.store.write_batch, upserts, deleted)
+        except Exception as e:
+            print(f"Player flush failed: {e}")
+            self.dirty |= dirty - self.deleted
+            self.deleted |= deleted - self.dirty
+            return 0
+        for token_hash, size in sizes.items(): WRITE_BYTES.observe(size, os.path.basename(self.store.path), token_hash)
+        return len(dirty) + len(deleted)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def start(self, scoped=False):
+        # 读库放到持久化线程，不阻塞事件循环；等待期间若已被兜底加载则丢弃这次结果
+        if not self.loaded:
+            records = {} if scoped else await run_io(self.store.load_all)
+            legacy = await run_io(self.store.legacy_uids)
+            if not self.loaded:
+                self._index(records)
+                self.legacy = legacy
+                self.loaded = True
+        if scoped and self.scope is None: self.scope = {}
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """关闭时强制落盘"""
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+player_cache = PlayerCache(player_store)
+
+FILE_BYTES = gauge("data_file_bytes", "数据文件大小", ("file",), merge="max")
+CACHE_PLAYERS = gauge("player_cache_records", "内存中的玩家存档数", ("bot",), merge="max")
+CACHE_DIRTY = gauge("player_cache_dirty", "等待批量落盘的玩家存档数")
+
+def _collect():
+    for path in (player_store.path, player_store.path + "-wal", CONFIG_FILE):
+        try: FILE_BYTES.set(os.path.getsize(path), os.path.basename(path))
+        except OSError: pass
+    CACHE_PLAYERS.clear()
+    for token_hash, players in player_cache.by_bot.items(): CACHE_PLAYERS.set(len(players), token_hash)
+    CACHE_DIRTY.set(len(player_cache.dirty) + len(player_cache.deleted))
+
+add_collector(_collect)
+
+def get_player_data(uid, bot_token):
+    """
+    核心隔离函数：获取指定用户在指定Bot下的数据 (直接读内存缓存)。
+    返回的是缓存里的那个 PlayerRecord 本身 (不是副本)；该玩家第一次访问时会认领旧档或新建一份并标记落盘。
+    调用方不要直接修改返回值——那样既绕过了 mutate_player 的玩家锁，也不会被标记为脏；
+    需要修改时一律走 mutate_player。跨 await 使用时，拿到的也始终是最新的值。
+    """
+    uid = str(uid)
+    token_hash = get_token_hash(bot_token)
+
+    target_data = player_cache.get(uid, token_hash)
+    if target_data is None:
+        # 兼容性处理：旧版未隔离的存档归档到第一个访问它的 Bot 下 (在库里原子认领，多个工作进程不会各拿一份)
+        target_data = player_cache.claim_legacy(uid, token_hash) or PlayerRecord()
+        player_cache.put(uid, token_hash, target_data)
+    return target_data
+
+def peek_player_data(uid, bot_token):
+    """只查不建：该玩家在该 Bot 下还没有存档时返回 None (不认领旧档、不新建记录)"""
+    return player_cache.get(str(uid), get_token_hash(bot_token))
+
+def save_player_data(uid, bot_token, data):
+    player_cache.put(str(uid), get_token_hash(bot_token), data)
+
+# 每个 (uid, token_hash) 一把锁；没有协程持有时自动回收
+_player_locks = weakref.WeakValueDictionary()
+
+def _player_lock(key):
+    lock = _player_locks.get(key)
+    if lock is None:
+        lock = asyncio.Lock()
+        _player_locks[key] = lock
+    return lock
+
+async def mutate_player(uid, bot_token, fn):
+    """
+    原子地读-改-写某个玩家的存档：在该玩家的锁内取最新数据，调用 fn(record) 原地修改，然后标记落盘。
+    返回 fn 的返回值。fn 应只做数值计算，不要在里面等待网络请求。
+    """
+    async with _player_lock((str(uid), get_token_hash(bot_token))):
+        data = get_player_data(uid, bot_token)
+        result = fn(data)
+        if inspect.isawaitable(result): result = await result
+        save_player_data(uid, bot_token, data)
+        return result
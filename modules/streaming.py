@@ -0,0 +1,67 @@
+# modules/streaming.py
+import re
+import asyncio
+
+FAV_TAG = re.compile(r'\[FAVORABILITY:([+-]?\d+)\]')
+_TAG_PREFIX = "[FAVORABILITY:"
+
+# Discord 单频道编辑限额约 5 次 / 5 秒，留一点余量
+STREAM_EDIT_INTERVAL = 1.2
+SPLIT_SIZE = 1900
+# 模型什么都没输出 (或只输出了好感度标签) 时发送的文本，保证延迟响应的交互总能收到回复
+EMPTY_REPLY = "……"
+
+def visible_text(text, final=False):
+    """去掉好感度标签；流式过程中还要隐藏末尾尚未输出完整的半个标签"""
+    text = FAV_TAG.sub("", text)
+    if not final:
+        cut = text.rfind("[")
+        if cut != -1 and _TAG_PREFIX.startswith(text[cut:cut + len(_TAG_PREFIX)]) and "]" not in text[cut:]:
+            text = text[:cut]
+    return text.strip()
+
+async def stream_reply(chunks, send, render=None, split=SPLIT_SIZE, interval=STREAM_EDIT_INTERVAL, empty=EMPTY_REPLY):
+    """
+    消费 ask_ai_stream 的增量输出：拿到第一段文字就立刻发消息，之后按 interval 节流编辑。
+    send(**kwargs) 负责发出新消息并返回 Message；render(text) 把文本转成 send/edit 的参数 (默认 content=)。
+    超过 split 字符时自动分页为多条消息；split=None 表示只用一条消息 (例如 Embed)。
+    输出为空时以 empty 作为最终内容，至少发出一条消息。
+    返回完整的原始回复 (包含好感度标签，便于调用方解析)。
+    """
+    render = render or (lambda t: {"content": t})
+    loop = asyncio.get_running_loop()
+    messages, shown = [], []
+    full = ""
+    last_sync = 0.0
+
+    async def sync(text):
+        pages = [text[i:i + split] for i in range(0, len(text), split)] if split else [text]
+        for i, page in enumerate(pages):
+            if not page: continue
+            if i < len(messages):
+                if shown[i] != page:
+                    await messages[i].edit(**render(page))
+                    shown[i] = page
+            else:
+                messages.append(await send(**render(page)))
+                shown.append(page)
+
+    async for chunk in chunks:
+        full += chunk
+        now = loop.time()
+        # 第一条消息尽快发出，之后按节流间隔编辑
+        if messages and now - last_sync < interval: continue
+        text = visible_text(full)
+        if not text: continue
+        await sync(text)
+        last_sync = now
+
+    await sync(visible_text(full, final=True) or empty)
+    return full
+
+def embed_renderer(embed, limit=4096):
+    """把流式文本写进 Embed 的描述，用于 /探索、/总结 这类以 Embed 展示的回复"""
+    def render(text):
+        embed.description = text[:limit]
+        return {"embed": embed}
+    return render
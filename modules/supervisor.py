@@ -0,0 +1,312 @@
+# modules/supervisor.py
+import os
+import sys
+import json
+import asyncio
+import hashlib
+from .config import get_token_hash
+from .storage import player_cache
+from .http_pool import http_pool
+from .balancer import balancer
+from .scheduler import llm_scheduler
+from .response_cache import response_cache
+from .discord_bot import start_bot, stop_bot, send_as_bot, bot_status, active_bots
+from .leaderboard import leaderboard, FIELDS
+from .metrics import gauge, counter, add_collector
+
+# Bot 工作进程数：0 = 所有 Bot 与后台面板跑在同一个进程里 (默认)
+WORKER_COUNT = int(os.environ.get('BOT_WORKERS', 0))
+# 工作进程崩溃后的重启退避 (秒)；稳定运行超过 STABLE_AFTER 秒后退避清零
+RESTART_BACKOFF = 1
+MAX_BACKOFF = 60
+STABLE_AFTER = 60
+# 单次 IPC 调用的超时 (秒)
+IPC_TIMEOUT = 10
+# 单行 IPC 消息的上限
+IPC_LINE_LIMIT = 16 * 1024 * 1024
+
+WORKER_UP = gauge("bot_worker_up", "工作进程是否存活 (1/0)", ("worker",))
+WORKER_RESTARTS = counter("bot_worker_restarts_total", "工作进程崩溃重启次数", ("worker",))
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 熔断状态从好到坏，汇总时取最差的
+HEALTH_ORDER = {"closed": 0, "half_open": 1, "open": 2}
+
+def llm_stats(apis):
+    """本进程 LLM 链路的运行状态：连接池、各端点/Key 健康度 (与 apis 一一对应)、调度器、回复缓存"""
+    return {
+        "http_pool": http_pool.stats(),
+        "balancer": [balancer.snapshot(api) for api in apis],
+        "scheduler": llm_scheduler.stats(),
+        "response_cache": response_cache.stats(),
+    }
+
+def _sum(parts):
+    """逐字段相加 (嵌套 dict 递归)；非数值字段取第一个进程的值"""
+    merged = {}
+    for part in parts:
+        for k, v in part.items():
+            if k not in merged: merged[k] = v
+            elif isinstance(v, dict): merged[k] = _sum([merged[k], v])
+            elif isinstance(v, (int, float)) and not isinstance(v, bool): merged[k] += v
+    return merged
+
+def _weighted(parts, field, weight):
+    samples = [(p[field], p[weight]) for p in parts if p[field] is not None]
+    total = sum(w for _, w in samples)
+    if not samples: return None
+    return sum(v * w for v, w in samples) / total if total else samples[0][0]
+
+def _merge_health(parts):
+    """每个进程各自判断健康度：计数相加，延迟/错误率按请求数加权，熔断状态取最差的"""
+    merged = _sum(parts)
+    latency = _weighted(parts, "latency_ms", "requests")
+    merged["latency_ms"] = round(latency) if latency is not None else None
+    merged["error_rate"] = round(_weighted(parts, "error_rate", "requests"), 3)
+    merged["state"] = max((p["state"] for p in parts), key=HEALTH_ORDER.get)
+    merged["retry_after"] = max(p["retry_after"] for p in parts)
+    merged["open_for"] = max(p["open_for"] for p in parts)
+    if "keys" in merged: merged["keys"] = [_merge_health(list(keys)) for keys in zip(*(p["keys"] for p in parts))]
+    return merged
+
+def merge_llm_stats(parts):
+    """把各工作进程的 llm_stats 汇总成单进程的格式，比率类字段按汇总后的计数重新计算"""
+    pool = {}
+    for origin, c in _sum([p["http_pool"] for p in parts]).items():
+        pool[origin] = dict(c, utilisation=round(c["in_flight"] / c["limit_per_host"], 3) if c["limit_per_host"] else 0.0)
+    sched = _sum([p["scheduler"] for p in parts])
+    sched["avg_wait_ms"] = round(sum(p["scheduler"]["avg_wait_ms"] * p["scheduler"]["granted"] for p in parts) / sched["granted"]) if sched["granted"] else 0
+    cache = _sum([p["response_cache"] for p in parts])
+    lookups = cache["hits"] + cache["misses"] + cache["coalesced"]
+    cache["hit_rate"] = round((cache["hits"] + cache["coalesced"]) / lookups, 3) if lookups else 0.0
+    return {
+        "http_pool": pool,
+        "balancer": [_merge_health(list(eps)) for eps in zip(*(p["balancer"] for p in parts))],
+        "scheduler": sched,
+        "response_cache": cache,
+    }
+
+class LocalRunner:
+    """在当前进程内运行 Bot (默认模式)，也是每个工作进程内部的实际执行者"""
+    def __init__(self, scoped=False):
+        # 工作进程里为 True：玩家存档只加载本进程负责的 Bot
+        self.scoped = scoped
+
+    async def open(self, config, tokens):
+        # 加载玩家存档到内存，并启动后台落盘任务
+        await player_cache.start(self.scoped)
+        # 建立 LLM 请求的长连接池
+        await http_pool.open(config.get("http_pool"))
+        llm_scheduler.configure(config.get("llm_scheduler"))
+        for token in tokens:
+            await self.start(token)
+
+    async def start(self, token):
+        # 后台启动，不等待 Bot 登录完成
+        asyncio.create_task(self._start(token))
+
+    async def _start(self, token):
+        await player_cache.attach(get_token_hash(token))
+        await start_bot(token)
+
+    async def stop(self, token):
+        await stop_bot(token)
+
+    async def say(self, token_mask, channel_id, message):
+        return await send_as_bot(token_mask, channel_id, message)
+
+    async def status(self):
+        return {token: bot_status(token) for token in list(active_bots)}
+
+    async def query_players(self, token, params):
+        # 停止中的 Bot 也能在后台查看存档
+        await player_cache.attach(get_token_hash(token))
+        return player_cache.query_bot(get_token_hash(token), **params)
+
+    async def delete_user(self, uid):
+        await player_cache.delete_user(uid)
+
+    async def leaderboards(self, token, n):
+        """{字段: [(名次, uid, 分数)]}"""
+        await player_cache.attach(get_token_hash(token))
+        return {field: leaderboard.top(get_token_hash(token), field, n) for field in FIELDS}
+
+    async def llm_stats(self, apis):
+        return llm_stats(apis)
+
+    async def metrics(self):
+        """其他进程的指标快照；单进程模式下全部指标都在本进程，/metrics 直接采集"""
+        return []
+
+    async def close(self):
+        # 先停掉所有 Bot，不再产生新的存档修改；最后强制落盘，避免丢失尚未写入的存档
+        for token in list(active_bots): await self.stop(token)
+        await http_pool.close()
+        await player_cache.close()
+
+class WorkerError(Exception):
+    """工作进程不在线、超时或执行出错"""
+
+def worker_index(token, count):
+    """Token → 工作进程的固定分配 (重启后不变)"""
+    return int(hashlib.md5(token.strip().encode()).hexdigest(), 16) % count
+
+class Worker:
+    """一个 Bot 工作进程 (python -m modules.worker)，stdin/stdout 上逐行收发 JSON 指令"""
+    def __init__(self, index):
+        self.index = index
+        self.tokens = set()
+        self.proc = None
+        self.pending = {}
+        self.seq = 0
+        self.restarts = 0
+        self.backoff = RESTART_BACKOFF
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    async def spawn(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "modules.worker", str(self.index),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            cwd=ROOT_DIR, limit=IPC_LINE_LIMIT, env=dict(os.environ, BOT_WORKERS="0")
+        )
+
+    async def read_replies(self):
+        async for line in self.proc.stdout:
+            try: msg = json.loads(line)
+            except ValueError: continue
+            fut = self.pending.pop(msg.get("id"), None)
+            if fut is None or fut.done(): continue
+            if "error" in msg: fut.set_exception(WorkerError(msg["error"]))
+            else: fut.set_result(msg.get("result"))
+        # 进程退出：所有等待中的调用立即失败
+        for fut in self.pending.values():
+            if not fut.done(): fut.set_exception(WorkerError(f"worker {self.index} exited"))
+        self.pending.clear()
+
+    async def call(self, op, **args):
+        if not self.alive: raise WorkerError(f"worker {self.index} offline")
+        self.seq += 1
+        call_id = self.seq
+        fut = self.pending[call_id] = asyncio.get_running_loop().create_future()
+        try:
+            self.proc.stdin.write((json.dumps({"id": call_id, "op": op, "args": args}, ensure_ascii=False) + "\n").encode("utf-8"))
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            # 进程刚退出、还没被 _run 发现
+            self.pending.pop(call_id, None)
+            raise WorkerError(f"worker {self.index} pipe closed: {e}")
+        try:
+            return await asyncio.wait_for(fut, IPC_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise WorkerError(f"worker {self.index} timed out on {op}")
+        finally:
+            self.pending.pop(call_id, None)
+
+class Supervisor:
+    """
+    多进程模式：把 bot_tokens 按哈希固定分配到 WORKER_COUNT 个工作进程，
+    本进程只跑后台面板，通过 IPC 转发启动/停止/代发言等操作；工作进程崩溃后带退避自动重启。
+    """
+    def __init__(self, count):
+        self.workers = [Worker(i) for i in range(count)]
+        self.tasks = []
+        self.closing = False
+        add_collector(self._collect_metrics)
+
+    def _collect_metrics(self):
+        for w in self.workers:
+            WORKER_UP.set(int(w.alive), w.index)
+            WORKER_RESTARTS.set_total(w.restarts, w.index)
+
+    def _worker(self, token):
+        return self.workers[worker_index(token, len(self.workers))]
+
+    async def open(self, config, tokens):
+        for token in tokens:
+            self._worker(token).tokens.add(token)
+        self.tasks = [asyncio.create_task(self._run(w)) for w in self.workers]
+
+    async def _run(self, worker):
+        loop = asyncio.get_running_loop()
+        while not self.closing:
+            started = loop.time()
+            try:
+                await worker.spawn()
+                reader = asyncio.create_task(worker.read_replies())
+                for token in list(worker.tokens):
+                    try: await worker.call("start", token=token)
+                    except WorkerError as e: print(f"⚠️ {e}")
+                code = await worker.proc.wait()
+                await reader
+            except Exception as e:
+                code = f"spawn failed: {e}"
+            if self.closing: return
+            if loop.time() - started > STABLE_AFTER: worker.backoff = RESTART_BACKOFF
+            worker.restarts += 1
+            print(f"💥 Bot worker {worker.index} exited ({code}), restarting in {worker.backoff}s")
+            await asyncio.sleep(worker.backoff)
+            worker.backoff = min(MAX_BACKOFF, worker.backoff * 2)
+
+    async def _broadcast(self, op, **args):
+        results = await asyncio.gather(*(w.call(op, **args) for w in self.workers), return_exceptions=True)
+        return [r for r in results if not isinstance(r, Exception)]
+
+    async def start(self, token):
+        worker = self._worker(token)
+        worker.tokens.add(token)
+        try: await worker.call("start", token=token)
+        except WorkerError as e: print(f"⚠️ {e}")
+
+    async def stop(self, token):
+        worker = self._worker(token)
+        worker.tokens.discard(token)
+        try: await worker.call("stop", token=token)
+        except WorkerError as e: print(f"⚠️ {e}")
+
+    async def say(self, token_mask, channel_id, message):
+        return any(await self._broadcast("say", token_mask=token_mask, channel_id=channel_id, message=message))
+
+    async def status(self):
+        merged = {}
+        for part in await self._broadcast("status"): merged.update(part)
+        return merged
+
+    async def query_players(self, token, params):
+        try: return await self._worker(token).call("query_players", token=token, params=params)
+        except WorkerError: return {"total": 0, "page": 1, "pages": 1, "per_page": params.get("per_page", 50), "items": []}
+
+    async def delete_user(self, uid):
+        # 每个工作进程只缓存自己负责的 Bot 的存档，各自从内存里删除 (库里的行由任意一个进程删掉即可)
+        await self._broadcast("delete_user", uid=uid)
+
+    async def leaderboards(self, token, n):
+        try: return await self._worker(token).call("leaderboards", token=token, n=n)
+        except WorkerError: return {}
+
+    async def llm_stats(self, apis):
+        # LLM 请求都在工作进程里发出，本进程的连接池/均衡器/调度器没有流量
+        return merge_llm_stats(await self._broadcast("llm_stats", apis=apis) or [llm_stats(apis)])
+
+    async def metrics(self):
+        # 没有响应的工作进程直接跳过，由 bot_worker_up 反映
+        return await self._broadcast("metrics")
+
+    def workers_status(self):
+        return [{"index": w.index, "alive": w.alive, "pid": w.proc.pid if w.proc else None, "tokens": len(w.tokens), "restarts": w.restarts} for w in self.workers]
+
+    async def close(self):
+        """关闭 stdin 通知工作进程落盘退出，超时未退出的强制结束"""
+        self.closing = True
+        for w in self.workers:
+            if w.alive: w.proc.stdin.close()
+        for w in self.workers:
+            if w.proc is None: continue
+            try: await asyncio.wait_for(w.proc.wait(), 15)
+            except asyncio.TimeoutError: w.proc.kill()
+        for task in self.tasks: task.cancel()
+
+bot_runner = Supervisor(WORKER_COUNT) if WORKER_COUNT > 0 else LocalRunner()
@@ -0,0 +1,39 @@
+# modules/tokens.py
+import re
+
+# 中日韩字符大约一个字一个 token，其余文本大约 4 个字符一个 token
+_CJK = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]')
+
+def heuristic_tokens(text):
+    """快速估算文本的 token 数 (不依赖分词器)"""
+    if not text: return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+_counter = heuristic_tokens
+
+def set_tokenizer(counter):
+    """替换 token 计数函数 counter(text) -> int；传 None 恢复启发式估算"""
+    global _counter
+    _counter = counter or heuristic_tokens
+
+def estimate_tokens(text):
+    return _counter(text) if text else 0
+
+def truncate_to_tokens(text, max_tokens, suffix="…"):
+    """把文本截断到大约 max_tokens 个 token 以内"""
+    if estimate_tokens(text) <= max_tokens: return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens: lo = mid
+        else: hi = mid - 1
+    return text[:lo] + suffix
+
+# 装了 tiktoken 就用真实分词器计数
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+    set_tokenizer(lambda text: len(_encoding.encode(text, disallowed_special=())))
+except Exception:
+    pass
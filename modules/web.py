@@ -1,8 +1,10 @@
 import os
-import asyncio
 from quart import Quart, render_template, request, redirect, url_for
-from .config import load_config, save_config, load_user_data, save_user_data, get_bot_config, MODULE_DEFINITIONS, get_token_hash
-from .discord_bot import start_bot, active_bots
+from .config import get_config, load_config, save_config, get_bot_config, MODULE_DEFINITIONS
+from .http_pool import http_pool
+from .supervisor import bot_runner
+from .leaderboard import FIELD_LABELS
+from .metrics import snapshot, render
 
 app = Quart(__name__, template_folder='../templates')
 app.secret_key = os.environ.get('QUART_SECRET_KEY', 'zeabur_secret_key_change_me')
@@ -20,23 +22,31 @@ async def index():
         selected_token = 'default'
         current_conf = config['default_settings']
 
+    # 多进程模式下通过 IPC 向各工作进程汇总运行状态
+    running = await bot_runner.status()
+    llm = await bot_runner.llm_stats(config['api_configs'])
+    leaderboards = await bot_runner.leaderboards(selected_token, 5) if selected_token != 'default' else {}
     bot_status = []
     for t in config['bot_tokens']:
-        status = "🟢 运行中" if t in active_bots else "🔴 已停止"
-        user_name = active_bots[t]['bot'].user.name if (t in active_bots and active_bots[t]['bot'].user) else "Bot"
-        bot_status.append({"token_mask": t[:6]+"...", "full_token": t, "status": status, "user": user_name})
+        info = running.get(t)
+        status = "🟢 运行中" if info else "🔴 已停止"
+        info = info or {"user": "Bot", "history": None, "prompt": None, "shards": [], "output": None}
+        bot_status.append(dict(info, token_mask=t[:6]+"...", full_token=t, status=status))
 
-    users = load_user_data()
-    # 传递 module_defs 和 hash 函数给前端，用于渲染精细化控制面板和隔离数据展示
+    # 传递 module_defs 给前端，用于渲染精细化控制面板
     return await render_template('index.html', 
                                  bots=bot_status, 
                                  apis=config['api_configs'], 
+                                 api_stats=[http_pool.stats_for(api['url'], llm["http_pool"]) for api in config['api_configs']],
+                                 api_health=llm["balancer"],
+                                 scheduler=llm["scheduler"],
+                                 leaderboards=leaderboards,
+                                 leaderboard_labels=FIELD_LABELS,
+                                 response_cache=llm["response_cache"],
                                  config=current_conf, 
                                  selected_token=selected_token, 
                                  all_tokens=config['bot_tokens'], 
-                                 users=users,
-                                 module_defs=MODULE_DEFINITIONS,
-                                 get_token_hash=get_token_hash)
+                                 module_defs=MODULE_DEFINITIONS)
 
 @app.route('/manage_bot', methods=['POST'])
 async def manage_bot():
@@ -48,19 +58,14 @@ async def manage_bot():
         new = form.get('new_token').strip()
         if new and new not in config['bot_tokens']:
             config['bot_tokens'].append(new)
-            save_config(config)
-            asyncio.create_task(start_bot(new))
-    elif action == 'start': asyncio.create_task(start_bot(token))
-    elif action == 'stop':
-        if token in active_bots:
-            await active_bots[token]["bot"].close()
-            del active_bots[token]
+            await save_config(config)
+            await bot_runner.start(new)
+    elif action == 'start': await bot_runner.start(token)
+    elif action == 'stop': await bot_runner.stop(token)
     elif action == 'delete':
-        if token in active_bots:
-            await active_bots[token]["bot"].close()
-            del active_bots[token]
+        await bot_runner.stop(token)
         if token in config['bot_tokens']: config['bot_tokens'].remove(token)
-        save_config(config)
+        await save_config(config)
     return redirect(url_for('index'))
 
 @app.route('/save_bot_settings', methods=['POST'])
@@ -86,6 +91,13 @@ async def save_bot_settings():
     new_settings = {
         "system_prompts": prompts,
         "temperature": float(form.get('temperature', 0.7)),
+        "stream_replies": form.get('stream_replies') == 'on',
+        "rolling_summary": form.get('rolling_summary') == 'on',
+        "shard_count": int(form.get('shard_count') or 1),
+        "knowledge_top_k": int(form.get('knowledge_top_k') or 5),
+        "knowledge_token_budget": int(form.get('knowledge_token_budget') or 800),
+        "context_token_budget": int(form.get('context_token_budget') or 1500),
+        "summary_token_budget": int(form.get('summary_token_budget') or 3000),
         "knowledge": [],
         "custom_events": [],
         "enabled_commands": enabled_commands # 保存为具体的指令列表
@@ -94,11 +106,13 @@ async def save_bot_settings():
     old_conf = config['bot_settings'].get(target_token, config['default_settings']) if target_token != 'default' else config['default_settings']
     new_settings['knowledge'] = old_conf.get('knowledge', [])
     new_settings['custom_events'] = old_conf.get('custom_events', [])
+    # 自定义好感度阶段表只能在配置文件里编辑，表单保存时原样保留
+    if old_conf.get('favorability_stages'): new_settings['favorability_stages'] = old_conf['favorability_stages']
 
     if target_token == 'default': config['default_settings'] = new_settings
     else: config['bot_settings'][target_token] = new_settings
     
-    save_config(config)
+    await save_config(config)
     return redirect(url_for('index', bot=target_token, tab='brain'))
 
 @app.route('/api/knowledge/add', methods=['POST'])
@@ -110,7 +124,7 @@ async def api_add_knowledge():
     target = config['default_settings'] if token == 'default' else config['bot_settings'].setdefault(token, config['default_settings'].copy())
     if "knowledge" not in target: target["knowledge"] = []
     target["knowledge"].append(content)
-    save_config(config)
+    await save_config(config)
     return redirect(url_for('index', bot=token, tab='brain'))
 
 @app.route('/api/knowledge/delete', methods=['POST'])
@@ -122,7 +136,7 @@ async def api_del_knowledge():
     target = config['default_settings'] if token == 'default' else config['bot_settings'].get(token, {})
     if "knowledge" in target and 0 <= idx < len(target["knowledge"]):
         target["knowledge"].pop(idx)
-        save_config(config)
+        await save_config(config)
     return redirect(url_for('index', bot=token, tab='brain'))
 
 @app.route('/update_api', methods=['POST'])
@@ -131,7 +145,7 @@ async def update_api():
     config = load_config()
     keys = [k.strip() for k in form.get('keys').split('\n') if k.strip()]
     config['api_configs'].append({"url": form.get('url'),"keys": keys,"model": form.get('model')})
-    save_config(config)
+    await save_config(config)
     return redirect(url_for('index', tab='api'))
 
 @app.route('/delete_api', methods=['POST'])
@@ -140,19 +154,55 @@ async def delete_api():
     config = load_config()
     if 0 <= idx < len(config['api_configs']):
         config['api_configs'].pop(idx)
-        save_config(config)
+        await save_config(config)
     return redirect(url_for('index', tab='api'))
 
+# 多进程模式下 LLM 请求都在工作进程里，以下面板数据经 IPC 汇总
+@app.route('/api/http_pool')
+async def api_http_pool():
+    return (await bot_runner.llm_stats(get_config()['api_configs']))["http_pool"]
+
+@app.route('/api/scheduler')
+async def api_scheduler():
+    return (await bot_runner.llm_stats(get_config()['api_configs']))["scheduler"]
+
+@app.route('/api/response_cache')
+async def api_response_cache():
+    return (await bot_runner.llm_stats(get_config()['api_configs']))["response_cache"]
+
+@app.route('/api/workers')
+async def api_workers():
+    workers = bot_runner.workers_status() if hasattr(bot_runner, "workers_status") else []
+    return {"mode": "supervisor" if workers else "local", "workers": workers}
+
+@app.route('/metrics')
+async def metrics():
+    """Prometheus 抓取入口：本进程 + 各工作进程的指标汇总"""
+    body = render([snapshot()] + await bot_runner.metrics())
+    return body, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route('/api/balancer')
+async def api_balancer():
+    return {"endpoints": (await bot_runner.llm_stats(get_config()['api_configs']))["balancer"]}
+
+@app.route('/api/players')
+async def api_players():
+    """玩家存档分页查询：?bot=&page=&per_page=&sort=gold|favorability|hp|lv&order=desc|asc&q="""
+    args = request.args
+    token = args.get('bot', '')
+    if token not in get_config()['bot_tokens']: return {"error": "unknown bot"}, 404
+    try: page, per_page = int(args.get('page', 1)), int(args.get('per_page', 50))
+    except ValueError: return {"error": "bad page"}, 400
+    params = {"sort": args.get('sort', 'gold'), "desc": args.get('order', 'desc') != 'asc', "q": args.get('q', ''), "page": page, "per_page": per_page}
+    return await bot_runner.query_players(token, params)
+
 @app.route('/user_cards')
 async def user_cards_page(): return redirect(url_for('index') + "#content-players")
 
 @app.route('/delete_card', methods=['POST'])
 async def delete_card():
     uid = (await request.form).get('uid')
-    data = load_user_data()
-    if uid in data:
-        del data[uid]
-        save_user_data(data)
+    if uid: await bot_runner.delete_user(uid)
     return redirect(url_for('index') + "#content-players")
 
 @app.route('/admin_say', methods=['POST'])
@@ -161,12 +211,5 @@ async def admin_say():
     token_mask = form.get('bot_token_mask')
     channel_id = int(form.get('channel_id'))
     message = form.get('message')
-    target_bot = None
-    for token, data in active_bots.items():
-        if token.startswith(token_mask.split('.')[0]):
-            target_bot = data['bot']
-            break
-    if target_bot:
-        try: await target_bot.get_channel(channel_id).send(message)
-        except: pass
+    await bot_runner.say(token_mask, channel_id, message)
     return redirect(url_for('index'))
\ No newline at end of file
@@ -0,0 +1,55 @@
+# modules/worker.py
+# Bot 工作进程入口：python -m modules.worker <编号>，由 supervisor.Supervisor 启动
+import os
+import sys
+import json
+import asyncio
+from .config import get_config
+from .supervisor import LocalRunner
+from .metrics import snapshot
+
+async def handle(runner, msg, out):
+    args = msg.get("args", {})
+    op = msg.get("op")
+    try:
+        if op == "start": result = await runner.start(args["token"])
+        elif op == "stop": result = await runner.stop(args["token"])
+        elif op == "say": result = await runner.say(args["token_mask"], args["channel_id"], args["message"])
+        elif op == "status": result = await runner.status()
+        elif op == "query_players": result = await runner.query_players(args["token"], args["params"])
+        elif op == "delete_user": result = await runner.delete_user(args["uid"])
+        elif op == "leaderboards": result = await runner.leaderboards(args["token"], args["n"])
+        elif op == "llm_stats": result = await runner.llm_stats(args["apis"])
+        elif op == "metrics": result = snapshot()
+        else: raise ValueError(f"unknown op {op}")
+        reply = {"id": msg.get("id"), "result": result}
+    except Exception as e:
+        reply = {"id": msg.get("id"), "error": f"{type(e).__name__}: {e}"}
+    out.write(json.dumps(reply, ensure_ascii=False) + "\n")
+    out.flush()
+
+async def main(index):
+    # 协议走原来的 stdout；print 输出改到 stderr，避免混进 IPC 通道
+    out = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+    os.dup2(2, 1)
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    runner = LocalRunner(scoped=True)
+    await runner.open(get_config(), [])
+    print(f"🧵 Bot worker {index} ready (pid {os.getpid()})")
+    tasks = set()
+    async for line in reader:
+        try: msg = json.loads(line)
+        except ValueError: continue
+        task = asyncio.create_task(handle(runner, msg, out))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    # stdin 关闭：主进程要求退出 (close 会先停掉本进程的 Bot 再落盘)
+    await runner.close()
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 0))